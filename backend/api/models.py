@@ -2,7 +2,7 @@
 Modelos Pydantic para request/response de la API
 """
 from pydantic import BaseModel, field_validator
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
 from enum import Enum
 
 
@@ -147,6 +147,25 @@ class DownloadZipRequest(BaseModel):
     """Request para descarga de ZIP con filtros"""
     project_code: Optional[str] = None
     document_type: Optional[str] = None
+    # Varios tipos a la vez (como document_types en /download/zip/project)
+    document_types: Optional[List[str]] = None
     start_date: Optional[str] = None
     end_date: Optional[str] = None
     document_ids: Optional[List[str]] = None
+
+class ZipJobResponse(BaseModel):
+    """Estado de un trabajo de ZIP en segundo plano"""
+    job_id: str
+    status: str
+    project_code: Optional[str] = None
+    total_documents: int
+    processed_documents: int
+    failed_documents: int
+    bytes_written: int
+    eta_seconds: Optional[float] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Bytes ahorrados y CPU gastada por la compresión (al terminar)
+    compression: Optional[Dict[str, Any]] = None
@@ -1,9 +1,14 @@
 """
 Endpoints FastAPI para TaleDownload
 """
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
-from typing import Optional
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from typing import Callable, Iterator, Optional
 from backend.api.models import (
     DocumentListResponse,
     ProjectListResponse,
@@ -12,6 +17,7 @@ from backend.api.models import (
     HealthResponse,
     FilterOptionsResponse,
     DownloadZipRequest,
+    ZipJobResponse,
     DocumentModel,
     ProjectSummaryModel,
     ProjectModel,
@@ -23,10 +29,19 @@ from backend.api.models import (
 )
 from backend.services.redshift_service import redshift_service
 from backend.services.download_service import download_service
-from backend.services.pdf_service import pdf_service
+from backend.services.conversion_executor import conversion_executor
+from backend.services.document_cache import document_cache
 from backend.services.zip_service import zip_service
+from backend.services.archive_cache import archive_cache
+from backend.services.zip_pipeline import ZipPipeline
+from backend.services.zip_planner import zip_planner
+from backend.services.zip_compression import compression_policy
+from backend.services.zip_jobs import zip_jobs, load_documents, PROJECT_DOCUMENTS_LIMIT
 from backend.utils.file_naming import generate_filename
+from backend.utils.zip_stream import iter_chunks
+from backend.core.cancellation import CancelToken, cancellation_metrics
 from backend.core.config import settings
+from backend.core.memory_budget import zip_memory_budget
 
 router = APIRouter(prefix="/api", tags=["TaleDownload"])
 
@@ -40,6 +55,23 @@ async def health_check():
         redshift_connected=redshift_connected
     )
 
+@router.get("/metrics")
+async def get_metrics():
+    """Métricas internas de los servicios de descarga y generación de ZIP"""
+    return {
+        "downloads": download_service.stats(),
+        "zip_memory_budget": zip_memory_budget.stats(),
+        "zip_pipelines": ZipPipeline.active_stats(),
+        "zip_planner": zip_planner.stats(),
+        "zip_compression": compression_policy.stats(),
+        "conversion": conversion_executor.stats(),
+        "document_cache": document_cache.stats(),
+        "archive_cache": archive_cache.stats(),
+        "redshift_queries": redshift_service.query_flight.stats(),
+        "zip_jobs": zip_jobs.stats(),
+        "cancellation": cancellation_metrics.stats(),
+    }
+
 @router.get("/debug/columns")
 async def get_table_columns():
     """DEBUG: Obtiene las columnas de la tabla archivos"""
@@ -193,22 +225,32 @@ async def get_documents(
 @router.get("/download/document/{codigo_proforma}")
 async def download_document(codigo_proforma: str):
     """Descarga un documento individual, ya sea convertido a PDF o en su formato original."""
+    download = None
+    cached = None
     try:
         doc = redshift_service.get_document_by_codigo(codigo_proforma)
         if not doc:
             raise HTTPException(status_code=404, detail="Document not found")
 
-        content = download_service.download_file(doc["url"])
-        if not content:
+        # Descarga asyncio (no bloquea el event loop); los archivos grandes van a disco.
+        # Si la caché tiene una copia, el GET es condicional y un 304 la reutiliza.
+        download = await document_cache.fetch_async(doc["url"])
+        if download is None or download.size == 0:
             raise HTTPException(status_code=500, detail="Failed to download document from URL")
+        content = download.buffer()
 
         # Extraemos el nombre original del archivo desde la URL para el fallback de extensión.
         original_filename = doc["url"].split("/")[-1].split("?")[0] # Limpia query strings
 
         # La función ahora devuelve un diccionario con el modo de manejo.
-        result = pdf_service.convert_to_pdf(content, original_filename)
+        # Las imágenes se convierten en el pool de procesos sin bloquear el event loop,
+        # o se toman ya convertidas de la caché de documentos.
+        result = await run_in_threadpool(
+            document_cache.convert_to_pdf, content, original_filename, doc["url"], download.validators
+        )
         if not result:
             raise HTTPException(status_code=500, detail=f"Failed to process document: {original_filename}")
+        cached = result.get("payload")
 
         # --- Lógica de respuesta según el modo ---
         file_content = result["content"]
@@ -236,11 +278,15 @@ async def download_document(codigo_proforma: str):
         else:
             raise HTTPException(status_code=500, detail="Unknown processing mode")
 
-        return StreamingResponse(
-            iter([file_content]),
+        response = StreamingResponse(
+            iter_chunks(file_content),
             media_type=media_type,
-            headers={"Content-Disposition": f"attachment; filename=\"{filename}\""}
+            headers={"Content-Disposition": f"attachment; filename=\"{filename}\""},
+            background=BackgroundTask(_close_payloads, download, cached),
         )
+        # La respuesta libera la descarga (y la entrada de caché) cuando termina de enviarse
+        download = cached = None
+        return response
 
     except HTTPException:
         raise
@@ -249,38 +295,77 @@ async def download_document(codigo_proforma: str):
         import traceback
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+    finally:
+        _close_payloads(download, cached)
+
+def _close_payloads(*payloads) -> None:
+    for payload in payloads:
+        if payload is not None:
+            payload.close()
+
+_STREAM_END = object()
+
+# Cada next() de un ZIP en streaming espera al pipeline: con threads propios no
+# ocupa el executor por defecto del loop (getaddrinfo, run_in_executor de otros)
+_zip_stream_executor = ThreadPoolExecutor(max_workers=settings.ZIP_STREAM_THREADS, thread_name_prefix="zip-stream")
+
+async def _stream_until_disconnect(chunks: Iterator[bytes], on_disconnect: Callable[[], None]):
+    """
+    Recorre un generador de ZIP en los threads de _zip_stream_executor y
+    reacciona si el cliente se desconecta.
+    
+    StreamingResponse cancela la iteración al recibir http.disconnect, pero el
+    next() en curso sigue en su thread. on_disconnect() se llama de inmediato
+    (cancela el token de la construcción) y el generador se cierra en cuanto
+    ese next() vuelve, lo que detiene el pipeline y libera lo retenido.
+    """
+    loop = asyncio.get_running_loop()
+    pending = None
+    finished = False
+    try:
+        while True:
+            pending = loop.run_in_executor(_zip_stream_executor, next, chunks, _STREAM_END)
+            chunk = await asyncio.shield(pending)
+            pending = None
+            if chunk is _STREAM_END:
+                finished = True
+                return
+            yield chunk
+    finally:
+        if not finished:
+            on_disconnect()
+            if pending is None:
+                threading.Thread(target=chunks.close, name="zip-cancel", daemon=True).start()
+            else:
+                pending.add_done_callback(lambda done: _close_after_next(done, chunks))
+
+def _close_after_next(done: asyncio.Future, chunks: Iterator[bytes]) -> None:
+    """Cierra el generador cuando el next() que quedó en curso termina"""
+    if not done.cancelled():
+        done.exception()  # el Cancelled esperado: no es un error de la respuesta
+    threading.Thread(target=chunks.close, name="zip-cancel", daemon=True).start()
 
 @router.post("/download/zip")
 async def download_zip(request: DownloadZipRequest):
     """Descarga ZIP con documentos filtrados"""
     try:
-        if request.document_ids:
-            documents_data = [
-                redshift_service.get_document_by_codigo(doc_id)
-                for doc_id in request.document_ids
-            ]
-            documents_data = [d for d in documents_data if d is not None]
-        else:
-            if not any([request.project_code, request.document_type, request.start_date, request.end_date]):
-                raise HTTPException(status_code=400, detail="At least one filter is required")
-            
-            documents_data = redshift_service.get_documents(
-                project_code=request.project_code,
-                document_type=request.document_type,
-                start_date=request.start_date,
-                end_date=request.end_date,
-                limit=1000
-            )
+        try:
+            documents_data = load_documents(request.model_dump())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         if not documents_data:
             raise HTTPException(status_code=404, detail="No documents found matching filters")
         
-        zip_buffer = zip_service.create_zip(documents_data, project_code=request.project_code)
+        # El ZIP se genera en streaming: cada documento se envía apenas está listo.
+        # Si el cliente se desconecta, se cancelan las descargas y conversiones pendientes.
+        cancel_token = CancelToken()
+        zip_stream = zip_service.stream_zip(documents_data, project_code=request.project_code, cancel_token=cancel_token)
         
         filename = f"{request.project_code or 'tale_documents'}.zip"
         
         return StreamingResponse(
-            zip_buffer,
+            _stream_until_disconnect(zip_stream, cancel_token.cancel),
             media_type="application/zip",
             headers={"Content-Disposition": f'attachment; filename="{filename}"'}
         )
@@ -289,6 +374,60 @@ async def download_zip(request: DownloadZipRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating ZIP: {str(e)}")
 
+@router.post("/jobs/zip", response_model=ZipJobResponse, status_code=202)
+async def create_zip_job(request: DownloadZipRequest):
+    """
+    Crea un trabajo de ZIP en segundo plano con los mismos filtros que /download/zip
+    
+    El avance se consulta en GET /jobs/zip/{job_id} y el resultado se descarga
+    en GET /jobs/zip/{job_id}/download cuando el estado es "completed".
+    """
+    try:
+        return await run_in_threadpool(zip_jobs.submit, request.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/jobs/zip/{job_id}", response_model=ZipJobResponse)
+async def get_zip_job(job_id: str):
+    """Estado de un trabajo de ZIP: documentos procesados, fallidos, bytes y tiempo estimado"""
+    job = await run_in_threadpool(zip_jobs.status, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"ZIP job {job_id} not found")
+    return job
+
+@router.delete("/jobs/zip/{job_id}", response_model=ZipJobResponse)
+async def cancel_zip_job(job_id: str):
+    """Cancela un trabajo de ZIP en cola o en curso (termina como "failed" con error "Cancelled")"""
+    job = await run_in_threadpool(zip_jobs.cancel, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"ZIP job {job_id} not found")
+    return job
+
+@router.get("/jobs/zip/{job_id}/download")
+async def download_zip_job(job_id: str):
+    """Descarga el ZIP de un trabajo terminado (con soporte de Range)"""
+    job = await run_in_threadpool(zip_jobs.status, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"ZIP job {job_id} not found")
+    path = await run_in_threadpool(zip_jobs.artifact, job_id)
+    if path is None:
+        raise HTTPException(status_code=409, detail=f"ZIP job {job_id} is {job['status']}")
+    filename = f"{job['project_code'] or 'tale_documents'}.zip"
+    return FileResponse(path, media_type="application/zip", filename=filename)
+
+class _PinnedFileResponse(FileResponse):
+    """FileResponse que llama a unpin() al terminar, también si el cliente se desconecta o falla el envío"""
+
+    def __init__(self, unpin: Callable[[], None], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._unpin = unpin
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._unpin()
+
 @router.get("/download/zip/project/{project_code}")
 async def download_project_zip(
     project_code: str,
@@ -316,18 +455,39 @@ async def download_project_zip(
             document_types=doc_type_list,
             start_date=start_date,
             end_date=end_date,
-            limit=100000
+            limit=PROJECT_DOCUMENTS_LIMIT
         )
         
         if not documents_data:
             raise HTTPException(status_code=404, detail=f"No documents found for project {project_code}")
         
-        zip_buffer = zip_service.create_zip(documents_data, project_code=project_code)
-        
         filename = f"{project_code}.zip"
         
+        # Mismos filtros y mismos documentos (MAX(fecha_carga) y cantidad): se sirve el ZIP ya generado
+        archive_key = archive_cache.archive_key(project_code, doc_type_list, start_date, end_date, documents_data)
+        # stat/utime/lock de la caché fuera del event loop; la entrada queda fijada hasta terminar el envío
+        cached_path = await run_in_threadpool(archive_cache.pin, archive_key)
+        if cached_path is not None:
+            return _PinnedFileResponse(
+                lambda: archive_cache.unpin(archive_key), cached_path, media_type="application/zip", filename=filename
+            )
+        
+        # El ZIP se genera en streaming: cada documento se envía apenas está listo.
+        # Solo queda guardado si no falta ningún documento: uno omitido por la caché
+        # negativa puede volver a estar disponible cuando esta vence, antes que
+        # cambie la marca de agua del ZIP.
+        # Si el cliente se desconecta y nadie más espera este ZIP, se cancela su generación.
+        summary = {}
+        cancel_token = CancelToken()
+        zip_stream = archive_cache.store(
+            archive_key,
+            zip_service.stream_zip(documents_data, project_code=project_code, summary=summary, cancel_token=cancel_token),
+            cacheable=lambda: summary.get("failed") == 0,
+            project_code=project_code,
+        )
+        
         return StreamingResponse(
-            zip_buffer,
+            _stream_until_disconnect(zip_stream, lambda: archive_cache.abandon(archive_key, cancel_token.cancel)),
             media_type="application/zip",
             headers={"Content-Disposition": f'attachment; filename="{filename}"'}
         )
@@ -335,3 +495,14 @@ async def download_project_zip(
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating project ZIP: {str(e)}")
+
+@router.delete("/admin/archive-cache")
+async def purge_archive_cache(project_code: Optional[str] = None):
+    """
+    Elimina los ZIPs de proyecto guardados en la caché
+    
+    Args:
+        project_code: Solo los de este proyecto (sin indicar = todos)
+    """
+    purged = await run_in_threadpool(archive_cache.purge, project_code)
+    return {"purged": purged, "archive_cache": archive_cache.stats()}
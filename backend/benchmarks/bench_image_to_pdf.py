@@ -0,0 +1,63 @@
+"""
+Benchmark de conversión JPEG → PDF: incrustación DCTDecode vs. recodificación PNG
+
+Compara, para fotos JPEG sintéticas que no requieren resize:
+- Ruta anterior: decodificar, convertir a RGB, recodificar como PNG y dibujar con reportlab
+- Ruta rápida: incrustar el stream JPEG original en el PDF (DCTDecode)
+
+Uso:
+    python -m backend.benchmarks.bench_image_to_pdf [repeticiones]
+"""
+import io
+import sys
+import time
+
+from PIL import Image, ImageFilter
+
+from backend.services.pdf_service import PDFService
+
+# (ancho, alto) típicos de vouchers fotografiados y escaneados
+SIZES = [(1024, 768), (1600, 1200), (2480, 3508)]
+
+
+def make_photo_jpeg(width: int, height: int, quality: int = 85) -> bytes:
+    """Genera un JPEG con ruido y gradientes, con entropía similar a una foto real"""
+    noise = Image.effect_noise((width, height), 48).filter(ImageFilter.GaussianBlur(1))
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def measure(func, repetitions: int):
+    """Devuelve (segundos de CPU por llamada, tamaño de la salida)"""
+    output = func()
+    start = time.process_time()
+    for _ in range(repetitions):
+        func()
+    return (time.process_time() - start) / repetitions, len(output)
+
+
+def main() -> int:
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print(f"{'Imagen':>11} {'JPEG':>9} | {'PNG CPU':>9} {'PNG PDF':>10} | {'DCT CPU':>9} {'DCT PDF':>10} | {'Speedup':>7} {'Tamaño':>7}")
+    print("-" * 88)
+    for width, height in SIZES:
+        jpeg = make_photo_jpeg(width, height)
+        reencoded_cpu, reencoded_size = measure(
+            lambda: PDFService._render_image_to_pdf(Image.open(io.BytesIO(jpeg))), repetitions
+        )
+        passthrough_cpu, passthrough_size = measure(lambda: PDFService.image_to_pdf(jpeg), repetitions)
+        print(
+            f"{width:>5}x{height:<5} {len(jpeg) / 1024:>7.0f}KB | "
+            f"{reencoded_cpu * 1000:>7.1f}ms {reencoded_size / 1024:>8.0f}KB | "
+            f"{passthrough_cpu * 1000:>7.1f}ms {passthrough_size / 1024:>8.0f}KB | "
+            f"{reencoded_cpu / max(passthrough_cpu, 1e-9):>6.0f}x {reencoded_size / passthrough_size:>6.1f}x"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Cancelación cooperativa del trabajo de una petición
+
+Cuando el cliente cierra la pestaña a mitad de un ZIP, el servidor seguía
+descargando y convirtiendo cientos de archivos para nadie. La ruta crea un
+CancelToken y lo cancela al detectar la desconexión; el pipeline lo activa en
+sus threads (cancel_scope) y las etapas lo consultan:
+
+- El pipeline deja de entregar resultados y descarta lo pendiente.
+- Las descargas en curso se cortan en el siguiente fragmento recibido.
+- Las conversiones aún en cola del pool de procesos se cancelan.
+
+Cancelled deriva de BaseException para que no se confunda con un fallo del
+documento: no cuenta como error, no se reintenta y, en una operación compartida
+(SingleFlight), los demás participantes la reintentan por su cuenta.
+
+cancellation_metrics acumula el trabajo evitado para /api/metrics.
+"""
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+class Cancelled(BaseException):
+    """El trabajo se canceló porque ya nadie espera su resultado"""
+
+
+class CancelToken:
+    """Señal de cancelación compartida entre threads, con callbacks"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """Cancela (idempotente) y ejecuta los callbacks registrados"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise Cancelled()
+
+    def wait(self, timeout: float) -> bool:
+        """Espera hasta timeout segundos; True si se canceló"""
+        return self._event.wait(timeout)
+
+    @contextmanager
+    def on_cancel(self, callback: Callable[[], None]) -> Iterator[None]:
+        """Ejecuta callback si se cancela mientras dura el bloque"""
+        with self._lock:
+            registered = not self._event.is_set()
+            if registered:
+                self._callbacks.append(callback)
+        if not registered:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+_current: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar("cancel_token", default=None)
+
+
+@contextmanager
+def cancel_scope(token: Optional[CancelToken]) -> Iterator[None]:
+    """Activa token para el thread (y las tareas asyncio que cree) durante el bloque"""
+    reset = _current.set(token)
+    try:
+        yield
+    finally:
+        _current.reset(reset)
+
+
+def current_token() -> Optional[CancelToken]:
+    """Token activo en este contexto, o None"""
+    return _current.get()
+
+
+def cancel_requested() -> bool:
+    token = _current.get()
+    return token is not None and token.cancelled
+
+
+class CancellationMetrics:
+    """Contadores del trabajo evitado por cancelaciones"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            "builds_cancelled": 0,
+            "documents_skipped": 0,
+            "documents_discarded": 0,
+            "downloads_aborted": 0,
+            "download_bytes_avoided": 0,
+            "conversions_cancelled": 0,
+        }
+
+    def count(self, key: str, delta: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += delta
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
+
+
+cancellation_metrics = CancellationMetrics()
@@ -0,0 +1,108 @@
+"""
+Circuit breaker por host para las descargas
+
+Si un host acumula CIRCUIT_BREAKER_FAILURE_THRESHOLD fallos transitorios
+seguidos, el circuito se abre y las descargas hacia ese host fallan de
+inmediato durante CIRCUIT_BREAKER_RESET_SECONDS, en lugar de retener a cada
+worker hasta su timeout. Pasado ese tiempo se deja pasar una sola petición de
+prueba (half-open): si responde, el circuito se cierra; si falla, se reabre.
+"""
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from backend.core.config import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Estado del circuito de un host, seguro entre threads"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.opened_total = 0
+        self.rejected_total = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """True si se puede enviar una petición al host ahora"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected_total += 1
+            return False
+
+    def record_success(self) -> None:
+        """El host respondió (aunque sea con un 4xx): cierra el circuito"""
+        with self._lock:
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        """Fallo transitorio (5xx, timeout, conexión): puede abrir el circuito"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened_total += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def abandon(self) -> None:
+        """El intento terminó sin resultado (cancelado, error local): libera la prueba"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "opened_total": self.opened_total,
+                "rejected_total": self.rejected_total,
+            }
+
+
+class HostCircuitBreakers:
+    """Un CircuitBreaker por host, creado en el primer uso"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self._breakers[host] = breaker
+            return breaker
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Estado del circuito de cada host"""
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {host: breaker.stats() for host, breaker in breakers.items()}
+
+
+download_circuit_breakers = HostCircuitBreakers(
+    failure_threshold=settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.CIRCUIT_BREAKER_RESET_SECONDS,
+)
@@ -19,6 +19,84 @@ class Settings:
     # Configuración general
     DEBUG: bool = os.getenv("DEBUG", "False").lower() == "true"
     MAX_FILE_SIZE_MB: int = int(os.getenv("MAX_FILE_SIZE_MB", "500"))
+    # Máximo de píxeles (ancho x alto) de una imagen a convertir
+    MAX_IMAGE_PIXELS: int = int(os.getenv("MAX_IMAGE_PIXELS", "100000000"))
+    
+    # Descargas: conexiones keep-alive por host y timeouts (conexión / lectura)
+    DOWNLOAD_POOL_SIZE: int = int(os.getenv("DOWNLOAD_POOL_SIZE", "32"))
+    DOWNLOAD_CONNECT_TIMEOUT_SECONDS: float = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT_SECONDS", "10"))
+    # Descargas mayores a este tamaño se escriben a disco mientras llegan
+    DOWNLOAD_MEMORY_THRESHOLD_MB: int = int(os.getenv("DOWNLOAD_MEMORY_THRESHOLD_MB", "16"))
+    # Timeouts aprendidos por host: EWMA de TTFB y bytes/s, con factor de seguridad y límites
+    DOWNLOAD_EWMA_ALPHA: float = float(os.getenv("DOWNLOAD_EWMA_ALPHA", "0.2"))
+    DOWNLOAD_TIMEOUT_SAFETY_FACTOR: float = float(os.getenv("DOWNLOAD_TIMEOUT_SAFETY_FACTOR", "4"))
+    DOWNLOAD_MIN_TIMEOUT_SECONDS: float = float(os.getenv("DOWNLOAD_MIN_TIMEOUT_SECONDS", "5"))
+    DOWNLOAD_MAX_TIMEOUT_SECONDS: float = float(os.getenv("DOWNLOAD_MAX_TIMEOUT_SECONDS", "120"))
+    # Hedged requests: segundo GET si el primero no responde en el percentil de TTFB del host
+    DOWNLOAD_HEDGING: bool = os.getenv("DOWNLOAD_HEDGING", "False").lower() == "true"
+    DOWNLOAD_HEDGE_PERCENTILE: float = float(os.getenv("DOWNLOAD_HEDGE_PERCENTILE", "0.95"))
+    DOWNLOAD_HEDGE_MIN_SAMPLES: int = int(os.getenv("DOWNLOAD_HEDGE_MIN_SAMPLES", "20"))
+    DOWNLOAD_HEDGE_BUDGET_RATIO: float = float(os.getenv("DOWNLOAD_HEDGE_BUDGET_RATIO", "0.05"))
+    DOWNLOAD_HEDGE_MAX_IN_FLIGHT: int = int(os.getenv("DOWNLOAD_HEDGE_MAX_IN_FLIGHT", "4"))
+    # Archivos mayores a este tamaño se descargan con N Range requests en paralelo (0 = desactivado)
+    DOWNLOAD_RANGED_THRESHOLD_MB: int = int(os.getenv("DOWNLOAD_RANGED_THRESHOLD_MB", "32"))
+    DOWNLOAD_RANGED_PARTS: int = int(os.getenv("DOWNLOAD_RANGED_PARTS", "4"))
+    # Reintentos de fallos transitorios (intentos totales, backoff exponencial con jitter)
+    DOWNLOAD_RETRY_ATTEMPTS: int = int(os.getenv("DOWNLOAD_RETRY_ATTEMPTS", "3"))
+    DOWNLOAD_RETRY_BASE_DELAY_SECONDS: float = float(os.getenv("DOWNLOAD_RETRY_BASE_DELAY_SECONDS", "0.5"))
+    DOWNLOAD_RETRY_MAX_DELAY_SECONDS: float = float(os.getenv("DOWNLOAD_RETRY_MAX_DELAY_SECONDS", "8"))
+    # Circuit breaker por host: fallos seguidos para abrirlo y segundos que permanece abierto
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+    CIRCUIT_BREAKER_RESET_SECONDS: float = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+    # Caché negativa de URLs con 403/404/410 (0 segundos = desactivada)
+    NEGATIVE_CACHE_TTL_SECONDS: float = float(os.getenv("NEGATIVE_CACHE_TTL_SECONDS", "3600"))
+    NEGATIVE_CACHE_MAX_ENTRIES: int = int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", "10000"))
+    
+    # Generación de ZIP
+    # Presupuesto de memoria compartido por todos los ZIPs en curso
+    ZIP_INFLIGHT_BUDGET_MB: int = int(os.getenv("ZIP_INFLIGHT_BUDGET_MB", "512"))
+    # Segundos que un worker espera presupuesto antes de derivar a disco
+    ZIP_BUDGET_WAIT_SECONDS: float = float(os.getenv("ZIP_BUDGET_WAIT_SECONDS", "5"))
+    # Pipeline por etapas: workers de descarga (I/O), de conversión (CPU) y capacidad de colas
+    ZIP_DOWNLOAD_WORKERS: int = int(os.getenv("ZIP_DOWNLOAD_WORKERS", "10"))
+    ZIP_CONVERT_WORKERS: int = int(os.getenv("ZIP_CONVERT_WORKERS", str(os.cpu_count() or 2)))
+    ZIP_QUEUE_DEPTH: int = int(os.getenv("ZIP_QUEUE_DEPTH", "20"))
+    # Etapa de descarga con asyncio (un thread, ZIP_DOWNLOAD_WORKERS descargas concurrentes)
+    ZIP_ASYNC_DOWNLOADS: bool = os.getenv("ZIP_ASYNC_DOWNLOADS", "False").lower() == "true"
+    # Threads propios para enviar ZIPs en streaming (máximo de ZIPs avanzando a la vez)
+    ZIP_STREAM_THREADS: int = int(os.getenv("ZIP_STREAM_THREADS", "16"))
+    # Conversión imagen → PDF en pool de procesos (0 procesos = convertir en el mismo proceso)
+    CONVERSION_PROCESSES: int = int(os.getenv("CONVERSION_PROCESSES", str(os.cpu_count() or 2)))
+    CONVERSION_MAX_TASKS_PER_CHILD: int = int(os.getenv("CONVERSION_MAX_TASKS_PER_CHILD", "100"))
+    CONVERSION_WORKER_MEMORY_MB: int = int(os.getenv("CONVERSION_WORKER_MEMORY_MB", "1536"))
+    CONVERSION_TIMEOUT_SECONDS: float = float(os.getenv("CONVERSION_TIMEOUT_SECONDS", "120"))
+    # Directorio para archivos temporales (vacío = directorio temporal del sistema)
+    SPOOL_DIR: str = os.getenv("SPOOL_DIR", "")
+    # Caché en disco de documentos convertidos (vacío = tale_document_cache en el directorio temporal; 0 MB = desactivada)
+    DOCUMENT_CACHE_DIR: str = os.getenv("DOCUMENT_CACHE_DIR", "")
+    DOCUMENT_CACHE_MAX_MB: int = int(os.getenv("DOCUMENT_CACHE_MAX_MB", "2048"))
+    # Caché en disco de ZIPs de proyecto terminados (vacío = tale_archive_cache en el directorio temporal; 0 MB = desactivada)
+    ARCHIVE_CACHE_DIR: str = os.getenv("ARCHIVE_CACHE_DIR", "")
+    ARCHIVE_CACHE_MAX_MB: int = int(os.getenv("ARCHIVE_CACHE_MAX_MB", "10240"))
+    # Trabajos de ZIP en segundo plano (vacío = tale_zip_jobs en el directorio temporal)
+    ZIP_JOBS_DIR: str = os.getenv("ZIP_JOBS_DIR", "")
+    ZIP_JOB_WORKERS: int = int(os.getenv("ZIP_JOB_WORKERS", "2"))
+    ZIP_JOB_RETENTION_HOURS: float = float(os.getenv("ZIP_JOB_RETENTION_HOURS", "24"))
+    # Planificador global: descargas simultáneas en todo el proceso y por host (0 = sin límite por host)
+    DOWNLOAD_MAX_CONCURRENCY: int = int(os.getenv("DOWNLOAD_MAX_CONCURRENCY", "32"))
+    DOWNLOAD_MAX_PER_HOST: int = int(os.getenv("DOWNLOAD_MAX_PER_HOST", "16"))
+    # Peso de los trabajos en segundo plano frente a un ZIP interactivo (peso 1)
+    ZIP_JOB_WEIGHT: float = float(os.getenv("ZIP_JOB_WEIGHT", "0.5"))
+    # Planificación del ZIP: el documento más grande primero, con tamaños de la caché o de HEADs
+    ZIP_SIZE_HINTS: bool = os.getenv("ZIP_SIZE_HINTS", "True").lower() == "true"
+    ZIP_SIZE_HINT_WORKERS: int = int(os.getenv("ZIP_SIZE_HINT_WORKERS", "16"))
+    ZIP_SIZE_HINT_TIMEOUT_SECONDS: float = float(os.getenv("ZIP_SIZE_HINT_TIMEOUT_SECONDS", "3"))
+    # Compresión de las entradas del ZIP: auto (según una muestra de cada entrada), deflate o store
+    ZIP_COMPRESSION: str = os.getenv("ZIP_COMPRESSION", "auto").lower()
+    ZIP_COMPRESSION_LEVEL: int = int(os.getenv("ZIP_COMPRESSION_LEVEL", "6"))
+    ZIP_COMPRESSION_SAMPLE_KB: int = int(os.getenv("ZIP_COMPRESSION_SAMPLE_KB", "64"))
+    # Ahorro mínimo de la muestra (fracción) para comprimir una entrada
+    ZIP_COMPRESSION_MIN_SAVINGS: float = float(os.getenv("ZIP_COMPRESSION_MIN_SAVINGS", "0.05"))
     
     # Versión
     VERSION: str = "1.0.0"
@@ -0,0 +1,70 @@
+"""
+Presupuesto global de hedged requests
+
+Un hedge es un segundo GET del mismo archivo cuando el primero no respondió
+dentro del p95 de TTFB del host: gana la primera respuesta y la otra se cancela.
+Para que los hedges no dupliquen la carga sobre un S3 que ya está lento, cada
+petición aporta DOWNLOAD_HEDGE_BUDGET_RATIO tokens y cada hedge consume uno;
+además hay un máximo de hedges simultáneos.
+"""
+import threading
+from typing import Dict, Any
+
+from backend.core.config import settings
+
+
+class HedgeBudget:
+    """
+    Token bucket de hedges, seguro entre threads.
+
+    Args:
+        ratio: Hedges permitidos por petición (0.05 = hasta 5% de peticiones extra)
+        max_in_flight: Hedges simultáneos como máximo (también tope de tokens acumulados)
+    """
+
+    def __init__(self, ratio: float, max_in_flight: int):
+        self.ratio = max(0.0, ratio)
+        self.max_in_flight = max(0, max_in_flight)
+        self._tokens = 0.0
+        self._in_flight = 0
+        self.issued_total = 0
+        self.rejected_total = 0
+        self._lock = threading.Lock()
+
+    def record_request(self) -> None:
+        """Cada petición normal suma ratio tokens"""
+        with self._lock:
+            self._tokens = min(float(self.max_in_flight), self._tokens + self.ratio)
+
+    def try_acquire(self) -> bool:
+        """True si se puede lanzar un hedge ahora (consume un token)"""
+        with self._lock:
+            if self._tokens < 1 or self._in_flight >= self.max_in_flight:
+                self.rejected_total += 1
+                return False
+            self._tokens -= 1
+            self._in_flight += 1
+            self.issued_total += 1
+            return True
+
+    def release(self) -> None:
+        """El hedge terminó (ganó, perdió o falló)"""
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "tokens": round(self._tokens, 2),
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "ratio": self.ratio,
+                "issued_total": self.issued_total,
+                "rejected_total": self.rejected_total,
+            }
+
+
+download_hedge_budget = HedgeBudget(
+    ratio=settings.DOWNLOAD_HEDGE_BUDGET_RATIO,
+    max_in_flight=settings.DOWNLOAD_HEDGE_MAX_IN_FLIGHT,
+)
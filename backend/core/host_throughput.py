@@ -0,0 +1,142 @@
+"""
+Estimación por host de la latencia y el ancho de banda de las descargas
+
+Por cada host se lleva una media móvil exponencial (EWMA) del tiempo hasta el
+primer byte (TTFB) y de los bytes/segundo observados. De ahí salen los timeouts
+de cada archivo, multiplicados por un factor de seguridad:
+
+- conexión y espera de datos: factor x TTFB
+- transferencia completa: factor x (TTFB + tamaño / bytes por segundo)
+
+Con el enlace sano, un archivo que se estanca se corta pronto; con el enlace
+congestionado, las estimaciones bajan y cada archivo recibe más tiempo.
+
+También se guardan los últimos TTFB de cada host para calcular percentiles
+(p. ej. el p95 que dispara los hedged requests).
+"""
+import math
+import threading
+from collections import deque
+from typing import Dict, Any, Optional, Tuple
+
+from backend.core.config import settings
+
+# Cuerpos menores a esto no se usan para estimar el ancho de banda (domina la latencia)
+MIN_THROUGHPUT_SAMPLE_BYTES = 64 * 1024
+
+# TTFB recientes que se guardan por host para los percentiles
+TTFB_WINDOW = 200
+
+
+class HostEstimate:
+    """EWMA de TTFB y ancho de banda de un host"""
+
+    def __init__(self):
+        self.ttfb_seconds: Optional[float] = None
+        self.bytes_per_second: Optional[float] = None
+        self.samples = 0
+        self.recent_ttfb: deque = deque(maxlen=TTFB_WINDOW)
+
+    def ttfb_percentile(self, percentile: float) -> Optional[float]:
+        if not self.recent_ttfb:
+            return None
+        ordered = sorted(self.recent_ttfb)
+        index = min(len(ordered) - 1, max(0, math.ceil(percentile * len(ordered)) - 1))
+        return ordered[index]
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.ttfb_percentile(0.95)
+        return {
+            "ttfb_seconds": round(self.ttfb_seconds, 4) if self.ttfb_seconds is not None else None,
+            "ttfb_p95_seconds": round(p95, 4) if p95 is not None else None,
+            "bytes_per_second": round(self.bytes_per_second) if self.bytes_per_second is not None else None,
+            "samples": self.samples,
+        }
+
+
+def _ewma(previous: Optional[float], sample: float, alpha: float) -> float:
+    return sample if previous is None else alpha * sample + (1 - alpha) * previous
+
+
+class HostThroughput:
+    """
+    Estimaciones por host y timeouts derivados.
+
+    Args:
+        alpha: Peso de cada observación nueva en la EWMA (0-1)
+        safety_factor: Margen sobre el tiempo estimado antes de cortar
+        min_timeout: Timeout mínimo en segundos
+        max_timeout: Timeout máximo en segundos
+    """
+
+    def __init__(self, alpha: float, safety_factor: float, min_timeout: float, max_timeout: float):
+        self.alpha = min(1.0, max(0.01, alpha))
+        self.safety_factor = max(1.0, safety_factor)
+        self.min_timeout = min_timeout
+        self.max_timeout = max(min_timeout, max_timeout)
+        self._hosts: Dict[str, HostEstimate] = {}
+        self._lock = threading.Lock()
+
+    def _clamp(self, seconds: float) -> float:
+        return min(self.max_timeout, max(self.min_timeout, seconds))
+
+    def observe(self, host: str, ttfb: float, nbytes: int, transfer_seconds: float) -> None:
+        """Registra una descarga completa del host"""
+        with self._lock:
+            estimate = self._hosts.setdefault(host, HostEstimate())
+            estimate.ttfb_seconds = _ewma(estimate.ttfb_seconds, ttfb, self.alpha)
+            estimate.recent_ttfb.append(ttfb)
+            if nbytes >= MIN_THROUGHPUT_SAMPLE_BYTES and transfer_seconds > 0:
+                estimate.bytes_per_second = _ewma(estimate.bytes_per_second, nbytes / transfer_seconds, self.alpha)
+            estimate.samples += 1
+
+    def timeouts(self, host: str, default_connect: float, default_read: float) -> Tuple[float, float]:
+        """
+        (conexión, lectura) para una petición al host.
+
+        Sin observaciones previas se usan los valores por defecto.
+        """
+        with self._lock:
+            estimate = self._hosts.get(host)
+            ttfb = estimate.ttfb_seconds if estimate else None
+        if ttfb is None:
+            return default_connect, default_read
+        wait = self._clamp(self.safety_factor * ttfb)
+        return min(wait, default_connect), wait
+
+    def transfer_timeout(self, host: str, content_length: int) -> float:
+        """
+        Segundos máximos para recibir un cuerpo de content_length bytes.
+
+        Sin estimación de ancho de banda se usa la regla fija de 1 segundo por
+        cada 200 KB (mínimo 10 s, máximo 120 s).
+        """
+        with self._lock:
+            estimate = self._hosts.get(host)
+            ttfb = estimate.ttfb_seconds if estimate else None
+            bytes_per_second = estimate.bytes_per_second if estimate else None
+        if bytes_per_second is None:
+            return max(10, min(120, content_length // 200000))
+        expected = (ttfb or 0.0) + content_length / bytes_per_second
+        return self._clamp(self.safety_factor * expected)
+
+    def ttfb_percentile(self, host: str, percentile: float, min_samples: int = 1) -> Optional[float]:
+        """Percentil de los TTFB recientes del host (None si hay menos de min_samples)"""
+        with self._lock:
+            estimate = self._hosts.get(host)
+            if estimate is None or len(estimate.recent_ttfb) < max(1, min_samples):
+                return None
+            return estimate.ttfb_percentile(percentile)
+
+    def stats(self) -> Dict[str, Any]:
+        """Estimaciones vigentes por host"""
+        with self._lock:
+            return {host: estimate.stats() for host, estimate in self._hosts.items()}
+
+
+download_throughput = HostThroughput(
+    alpha=settings.DOWNLOAD_EWMA_ALPHA,
+    safety_factor=settings.DOWNLOAD_TIMEOUT_SAFETY_FACTOR,
+    min_timeout=settings.DOWNLOAD_MIN_TIMEOUT_SECONDS,
+    max_timeout=settings.DOWNLOAD_MAX_TIMEOUT_SECONDS,
+)
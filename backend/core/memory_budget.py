@@ -0,0 +1,94 @@
+"""
+Presupuesto global de bytes en memoria para la generación de ZIPs
+
+Todas las construcciones de ZIP en curso comparten un mismo presupuesto: cada
+archivo procesado que espera ser escrito reserva sus bytes y los libera al
+escribirse. Cuando el presupuesto se agota, los workers esperan (backpressure)
+o derivan el contenido a disco (ver backend.core.spool).
+"""
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from backend.core.config import settings
+
+
+class ByteBudget:
+    """Semáforo por cantidad de bytes, seguro entre threads"""
+
+    def __init__(self, limit_bytes: int):
+        self.limit_bytes = max(0, int(limit_bytes))
+        self._in_use = 0
+        self._peak = 0
+        self._waiting = 0
+        self._acquired_total = 0
+        self._rejected_total = 0
+        self._wait_seconds_total = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int, timeout: Optional[float] = None) -> bool:
+        """
+        Reserva nbytes del presupuesto, esperando hasta timeout segundos.
+
+        Args:
+            nbytes: Bytes a reservar
+            timeout: Segundos máximos de espera (None = sin límite, 0 = no esperar)
+
+        Returns:
+            True si se reservó, False si no hubo espacio a tiempo
+        """
+        nbytes = max(0, int(nbytes))
+        # Un bloque mayor al presupuesto completo nunca cabría: se rechaza de inmediato
+        if nbytes > self.limit_bytes:
+            with self._condition:
+                self._rejected_total += 1
+            return False
+
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._condition:
+            self._waiting += 1
+            try:
+                while self._in_use + nbytes > self.limit_bytes:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._rejected_total += 1
+                        return False
+                    self._condition.wait(remaining)
+
+                self._in_use += nbytes
+                self._peak = max(self._peak, self._in_use)
+                self._acquired_total += 1
+                return True
+            finally:
+                self._waiting -= 1
+                self._wait_seconds_total += time.monotonic() - start
+
+    def release(self, nbytes: int) -> None:
+        """Libera nbytes previamente reservados"""
+        with self._condition:
+            self._in_use = max(0, self._in_use - max(0, int(nbytes)))
+            self._condition.notify_all()
+
+    @property
+    def in_use(self) -> int:
+        """Bytes reservados actualmente"""
+        return self._in_use
+
+    def stats(self) -> Dict[str, Any]:
+        """Uso actual del presupuesto para métricas"""
+        with self._condition:
+            return {
+                "limit_bytes": self.limit_bytes,
+                "in_use_bytes": self._in_use,
+                "peak_bytes": self._peak,
+                "usage_pct": round(100 * self._in_use / self.limit_bytes, 1) if self.limit_bytes else 0.0,
+                "waiting_workers": self._waiting,
+                "acquired_total": self._acquired_total,
+                "rejected_total": self._rejected_total,
+                "wait_seconds_total": round(self._wait_seconds_total, 3),
+            }
+
+
+# Presupuesto compartido por todas las construcciones de ZIP del proceso
+zip_memory_budget = ByteBudget(settings.ZIP_INFLIGHT_BUDGET_MB * 1024 * 1024)
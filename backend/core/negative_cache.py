@@ -0,0 +1,89 @@
+"""
+Caché negativa de URLs que fallaron de forma permanente
+
+Los mismos objetos de S3 con 403 Forbidden (minutas, cronogramas) fallan en cada
+exportación del proyecto. Mientras la entrada no expire, la descarga falla sin
+tocar la red y el ZIP los registra en FAILED_FILES.txt de inmediato.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from backend.core.config import settings
+
+# Códigos HTTP que se recuerdan: reintentar no cambia el resultado
+NEGATIVE_CACHE_STATUS_CODES = {403, 404, 410}
+
+
+class NegativeCache:
+    """
+    URL -> código HTTP del fallo, con expiración (TTL) y tamaño máximo (LRU).
+
+    Args:
+        ttl_seconds: Segundos que se recuerda un fallo (0 = caché desactivada)
+        max_entries: Entradas máximas; al superarlas se descarta la más antigua
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def get(self, url: str) -> Optional[int]:
+        """Código HTTP recordado para la URL, o None si no hay entrada vigente"""
+        if not self.enabled or not url:
+            return None
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._entries[url]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry[0]
+
+    def add(self, url: str, status_code: int) -> None:
+        """Recuerda el fallo de la URL si su código es permanente"""
+        if not self.enabled or status_code not in NEGATIVE_CACHE_STATUS_CODES:
+            return
+        with self._lock:
+            self._entries[url] = (status_code, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, url: str) -> None:
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+download_negative_cache = NegativeCache(
+    ttl_seconds=settings.NEGATIVE_CACHE_TTL_SECONDS,
+    max_entries=settings.NEGATIVE_CACHE_MAX_ENTRIES,
+)
@@ -0,0 +1,59 @@
+"""
+Política de reintentos con backoff exponencial y jitter
+
+Se reintentan solo los fallos transitorios (5xx, 429, timeouts, conexiones
+reseteadas). Los 4xx como 403/404 fallan de inmediato: reintentarlos no cambia
+el resultado y solo retiene al worker.
+"""
+import random
+from typing import Dict, Any
+
+from backend.core.config import settings
+
+# Códigos 4xx que indican un fallo transitorio (los 5xx se reintentan todos)
+RETRYABLE_CLIENT_STATUS_CODES = {408, 429}
+
+
+class RetryPolicy:
+    """
+    Cuántas veces reintentar y cuánto esperar entre intentos.
+
+    Args:
+        max_attempts: Intentos totales (1 = sin reintentos)
+        base_delay: Espera base en segundos antes del primer reintento
+        max_delay: Tope de la espera en segundos
+    """
+
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = max(0.0, base_delay)
+        self.max_delay = max(self.base_delay, max_delay)
+
+    @staticmethod
+    def is_retryable_status(status_code: int) -> bool:
+        """True si el código HTTP es un fallo transitorio"""
+        return status_code >= 500 or status_code in RETRYABLE_CLIENT_STATUS_CODES
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Segundos de espera tras el intento número attempt (desde 1).
+
+        "Full jitter": un valor aleatorio entre 0 y el backoff exponencial, para que
+        los workers que fallaron a la vez no reintenten todos al mismo tiempo.
+        """
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_attempts": self.max_attempts,
+            "base_delay_seconds": self.base_delay,
+            "max_delay_seconds": self.max_delay,
+        }
+
+
+download_retry_policy = RetryPolicy(
+    max_attempts=settings.DOWNLOAD_RETRY_ATTEMPTS,
+    base_delay=settings.DOWNLOAD_RETRY_BASE_DELAY_SECONDS,
+    max_delay=settings.DOWNLOAD_RETRY_MAX_DELAY_SECONDS,
+)
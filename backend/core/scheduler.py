@@ -0,0 +1,330 @@
+"""
+Planificador global con colas justas ponderadas (weighted fair queueing)
+
+Cada ZIP tenía sus propios workers de descarga: tres exportaciones a la vez eran
+30 conexiones sin coordinación y un ZIP de 5 documentos competía de igual a
+igual con uno de 10.000. FairScheduler reparte un número fijo de cupos para
+todo el proceso:
+
+- Límite global de operaciones simultáneas y, opcionalmente, por host.
+- Cada trabajo (Flow) tiene su cola; cuando se libera un cupo se atiende al
+  flujo con menor tiempo virtual, que avanza cost / weight con cada cupo
+  concedido. Con pesos iguales, dos ZIPs se reparten los cupos a medias sin
+  importar cuántos documentos tenga cada uno: el pequeño termina enseguida.
+- Un flujo que empieza (o vuelve tras estar inactivo) parte del tiempo virtual
+  actual: no acumula crédito ni queda detrás de todo lo encolado.
+
+El flujo se toma del contexto (flow_scope), como el token de cancelación: el
+pipeline lo activa en sus threads y las descargas y conversiones lo heredan.
+Sin flujo activo, cada operación es un flujo propio (p. ej. la descarga de un
+documento individual), que entra con prioridad frente a los trabajos largos.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional
+
+from backend.core.cancellation import Cancelled, current_token
+from backend.core.config import settings
+
+
+class Flow:
+    """
+    Un trabajo que compite por cupos (p. ej. un ZIP).
+
+    Solo identifica al trabajo y su peso: cada FairScheduler guarda su propia
+    cola y tiempo virtual por flujo, así el mismo flujo puede pedir cupos de
+    descarga y de conversión a la vez.
+
+    Args:
+        name: Nombre para métricas
+        weight: Parte de los cupos relativa a los demás flujos (2.0 = el doble)
+    """
+
+    def __init__(self, name: str, weight: float = 1.0):
+        self.name = name
+        self.weight = max(0.01, weight)
+
+
+class _FlowState:
+    """Estado de un flujo dentro de un FairScheduler (sin referenciar al Flow)"""
+
+    def __init__(self, flow: Flow):
+        self.name = flow.name
+        self.weight = flow.weight
+        self.vtime = 0.0
+        self.active = 0
+        self.granted = 0
+        self.waiting: Deque["_Waiter"] = deque()
+
+
+class _Waiter:
+    """Una petición de cupo en espera"""
+
+    def __init__(self, flow: Flow, host: Optional[str], cost: float):
+        self.flow = flow
+        self.state: Optional[_FlowState] = None
+        self.host = host
+        self.cost = cost
+        self.queued_at = time.monotonic()
+        self.granted = False
+        self.withdrawn = False
+        self.event = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.future: Optional[asyncio.Future] = None
+
+    def wake(self) -> None:
+        self.event.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+_current_flow: contextvars.ContextVar[Optional[Flow]] = contextvars.ContextVar("scheduler_flow", default=None)
+
+
+@contextmanager
+def flow_scope(flow: Optional[Flow]) -> Iterator[None]:
+    """Activa flow para el thread (y las tareas asyncio que cree) durante el bloque"""
+    reset = _current_flow.set(flow)
+    try:
+        yield
+    finally:
+        _current_flow.reset(reset)
+
+
+class FairScheduler:
+    """
+    Cupos compartidos por todo el proceso, repartidos entre flujos con WFQ.
+
+    Args:
+        name: Nombre para métricas
+        max_concurrency: Cupos simultáneos en total
+        max_per_host: Cupos simultáneos por host (0 = sin límite)
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_per_host: int = 0):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_per_host = max(0, max_per_host)
+        self._lock = threading.Lock()
+        # Estado por flujo; se descarta solo cuando el flujo deja de existir
+        self._states: "weakref.WeakKeyDictionary[Flow, _FlowState]" = weakref.WeakKeyDictionary()
+        # Flujos con pedidos en espera
+        self._flows: List[_FlowState] = []
+        self._in_use = 0
+        self._per_host: Dict[str, int] = {}
+        self._virtual_time = 0.0
+        self._stats = {
+            "grants": 0,
+            "queued": 0,
+            "withdrawn": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    # Reparto
+    # ------------------------------------------------------------------
+
+    def _host_full(self, host: Optional[str]) -> bool:
+        return bool(host and self.max_per_host and self._per_host.get(host, 0) >= self.max_per_host)
+
+    def _grant(self, waiter: _Waiter) -> None:
+        """Concede un cupo (con el lock tomado)"""
+        state = waiter.state
+        self._virtual_time = max(self._virtual_time, state.vtime)
+        state.vtime += waiter.cost / state.weight
+        state.active += 1
+        state.granted += 1
+        self._in_use += 1
+        if waiter.host:
+            self._per_host[waiter.host] = self._per_host.get(waiter.host, 0) + 1
+        waiter.granted = True
+        waited = time.monotonic() - waiter.queued_at
+        self._stats["grants"] += 1
+        self._stats["wait_seconds"] += waited
+        self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+        waiter.wake()
+
+    def _dispatch(self) -> None:
+        """Concede cupos libres al flujo con menor tiempo virtual (con el lock tomado)"""
+        while self._in_use < self.max_concurrency:
+            best = best_waiter = None
+            for state in self._flows:
+                # El primer pedido del flujo cuyo host tenga cupo
+                waiter = next((w for w in state.waiting if not self._host_full(w.host)), None)
+                if waiter is not None and (best is None or state.vtime < best.vtime):
+                    best, best_waiter = state, waiter
+            if best is None:
+                return
+            best.waiting.remove(best_waiter)
+            if not best.waiting:
+                self._flows.remove(best)
+            self._grant(best_waiter)
+
+    def _state_for(self, flow: Flow) -> _FlowState:
+        """Estado del flujo en este planificador (con el lock tomado)"""
+        state = self._states.get(flow)
+        if state is None:
+            state = self._states[flow] = _FlowState(flow)
+        if not state.waiting and not state.active:
+            # Un flujo que (re)empieza no acumula crédito del tiempo inactivo
+            state.vtime = max(state.vtime, self._virtual_time)
+        return state
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        with self._lock:
+            state = waiter.state = self._state_for(waiter.flow)
+            if not state.waiting:
+                self._flows.append(state)
+            state.waiting.append(waiter)
+            self._dispatch()
+            if not waiter.granted:
+                self._stats["queued"] += 1
+
+    def _withdraw(self, waiter: _Waiter) -> bool:
+        """Retira un pedido que ya no espera; False si ya tenía cupo (hay que liberarlo)"""
+        with self._lock:
+            if waiter.granted:
+                return False
+            if not waiter.withdrawn:
+                waiter.withdrawn = True
+                waiter.state.waiting.remove(waiter)
+                if not waiter.state.waiting:
+                    self._flows.remove(waiter.state)
+                self._stats["withdrawn"] += 1
+                waiter.wake()
+            return True
+
+    def _release(self, waiter: _Waiter) -> None:
+        with self._lock:
+            self._in_use -= 1
+            waiter.state.active -= 1
+            if waiter.host:
+                remaining = self._per_host[waiter.host] - 1
+                if remaining:
+                    self._per_host[waiter.host] = remaining
+                else:
+                    del self._per_host[waiter.host]
+            self._dispatch()
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    @contextmanager
+    def slot(self, host: Optional[str] = None, cost: float = 1.0) -> Iterator[None]:
+        """
+        Espera un cupo para el flujo activo y lo libera al salir del bloque.
+
+        Raises:
+            Cancelled: Si el token de cancelación activo se cancela durante la espera
+        """
+        waiter = _Waiter(_current_flow.get() or Flow("adhoc"), host, cost)
+        self._enqueue(waiter)
+        if not waiter.granted:
+            token = current_token()
+            if token is None:
+                waiter.event.wait()
+            else:
+                with token.on_cancel(lambda: self._withdraw(waiter)):
+                    waiter.event.wait()
+                if not waiter.granted:
+                    raise Cancelled()
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    @asynccontextmanager
+    async def slot_async(self, host: Optional[str] = None, cost: float = 1.0) -> AsyncIterator[None]:
+        """Como slot(), sin bloquear el event loop"""
+        waiter = _Waiter(_current_flow.get() or Flow("adhoc"), host, cost)
+        waiter.loop = asyncio.get_running_loop()
+        waiter.future = waiter.loop.create_future()
+        self._enqueue(waiter)
+        if not waiter.granted:
+            token = current_token()
+            try:
+                if token is None:
+                    await waiter.future
+                else:
+                    with token.on_cancel(lambda: self._withdraw(waiter)):
+                        await waiter.future
+            except BaseException:
+                if not self._withdraw(waiter):
+                    self._release(waiter)
+                raise
+            if not waiter.granted:
+                raise Cancelled()
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    @contextmanager
+    def spare_slots(self, host: Optional[str], count: int) -> Iterator[int]:
+        """
+        Toma hasta count cupos libres sin esperar y los libera al salir del bloque.
+
+        Solo usa cupos que nadie espera: con pedidos en cola no toma ninguno.
+        Sirve para trabajo opcional que se reparte según lo disponible (p. ej.
+        las partes extra de una descarga por rangos).
+
+        Yields:
+            Cupos obtenidos (0 si no hay libres)
+        """
+        granted: List[_Waiter] = []
+        with self._lock:
+            flow = _current_flow.get() or Flow("adhoc")
+            while (
+                len(granted) < count and not self._flows
+                and self._in_use < self.max_concurrency and not self._host_full(host)
+            ):
+                waiter = _Waiter(flow, host, 1.0)
+                waiter.state = self._state_for(flow)
+                self._grant(waiter)
+                granted.append(waiter)
+        try:
+            yield len(granted)
+        finally:
+            for waiter in granted:
+                self._release(waiter)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "max_concurrency": self.max_concurrency,
+                "max_per_host": self.max_per_host,
+                "in_use": self._in_use,
+                "waiting": sum(len(state.waiting) for state in self._flows),
+                "per_host": dict(self._per_host),
+                "flows": [
+                    {
+                        "name": state.name,
+                        "weight": state.weight,
+                        "waiting": len(state.waiting),
+                        "active": state.active,
+                    }
+                    for state in self._flows
+                ],
+            })
+        stats["wait_seconds"] = round(stats["wait_seconds"], 3)
+        stats["max_wait_seconds"] = round(stats["max_wait_seconds"], 3)
+        return stats
+
+
+download_scheduler = FairScheduler(
+    "downloads",
+    max_concurrency=settings.DOWNLOAD_MAX_CONCURRENCY,
+    max_per_host=settings.DOWNLOAD_MAX_PER_HOST,
+)
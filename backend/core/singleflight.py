@@ -0,0 +1,164 @@
+"""
+Coalescencia de operaciones idénticas concurrentes (singleflight)
+
+Cuando varias personas abren el mismo proyecto a la vez, las mismas consultas,
+descargas y conversiones se ejecutaban en paralelo. Con SingleFlight, el primer
+llamador de una clave (líder) ejecuta la operación y los que llegan mientras
+está en curso (seguidores) esperan y reciben el mismo resultado.
+
+Si el resultado tiene dueño (p. ej. un SpooledPayload que el llamador cierra),
+share(resultado) crea una copia independiente para cada participante; el último
+en recogerlo se queda con el original. Si el líder se cancela (no falla), los
+seguidores vuelven a intentarlo por su cuenta.
+
+Funciona entre threads y entre event loops: los seguidores async esperan el
+concurrent.futures.Future del líder sin bloquear su loop.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class _Abandoned(Exception):
+    """El líder se canceló antes de terminar: el seguidor debe reintentar"""
+
+
+class _Call:
+    """Una operación en curso y sus participantes"""
+
+    def __init__(self):
+        self.future: Future = Future()
+        self.participants = 1
+        self.lock = threading.Lock()
+
+
+class SingleFlight:
+    """
+    Operaciones en curso por clave, seguro entre threads.
+
+    Args:
+        name: Nombre para métricas y logs
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def _join(self, key: Hashable):
+        """(llamada, True si es el líder)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.participants += 1
+                self.followers += 1
+                return call, False
+            call = _Call()
+            self._calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def _finish(self, key: Hashable, call: _Call, result: Any = None, error: BaseException = None) -> None:
+        """Publica el resultado; desde ahora los nuevos llamadores inician otra operación"""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    @staticmethod
+    def _collect(call: _Call, share: Optional[Callable[[Any], Any]]) -> Any:
+        """Resultado para un participante (copia con share, salvo para el último)"""
+        result = call.future.result()
+        with call.lock:
+            call.participants -= 1
+            if share is None or result is None or call.participants == 0:
+                return result
+            return share(result)
+
+    def do(self, key: Hashable, fn: Callable[[], Any], share: Optional[Callable[[Any], Any]] = None) -> Any:
+        """
+        Ejecuta fn() una sola vez por clave entre los llamadores concurrentes.
+
+        Args:
+            key: Identidad de la operación
+            fn: Operación a ejecutar (solo la ejecuta el líder)
+            share: Copia independiente del resultado para cada participante
+
+        Returns:
+            Resultado de fn() (o su copia); las excepciones se propagan a todos
+        """
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                try:
+                    result = fn()
+                except Exception as e:
+                    self._finish(key, call, error=e)
+                except BaseException:
+                    self._finish(key, call, error=_Abandoned())
+                    raise
+                else:
+                    self._finish(key, call, result)
+            try:
+                return self._collect(call, share)
+            except _Abandoned:
+                continue
+
+    async def do_async(
+        self,
+        key: Hashable,
+        fn: Callable[[], Awaitable[Any]],
+        share: Optional[Callable[[Any], Any]] = None,
+    ) -> Any:
+        """Igual que do(), para corrutinas: fn() devuelve el awaitable a ejecutar"""
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                try:
+                    result = await fn()
+                except Exception as e:
+                    self._finish(key, call, error=e)
+                except BaseException:
+                    # Cancelación del líder: los seguidores reintentan
+                    self._finish(key, call, error=_Abandoned())
+                    raise
+                else:
+                    self._finish(key, call, result)
+            else:
+                try:
+                    await asyncio.shield(asyncio.wrap_future(call.future))
+                except _Abandoned:
+                    continue
+                except BaseException:
+                    if not call.future.done():
+                        # Seguidor cancelado mientras esperaba: ceder su parte al terminar
+                        call.future.add_done_callback(lambda _: self._release(call, share))
+                        raise
+            try:
+                return self._collect(call, share)
+            except _Abandoned:
+                continue
+
+    def _release(self, call: _Call, share: Optional[Callable[[Any], Any]]) -> None:
+        """Un participante que ya no espera: recoge y libera su parte"""
+        try:
+            result = self._collect(call, share)
+        except BaseException:
+            return
+        close = getattr(result, "close", None)
+        if share is not None and close is not None:
+            close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "followers": self.followers,
+            }
@@ -0,0 +1,350 @@
+"""
+Contenedor de contenido en memoria o en disco (spill) con reserva de presupuesto
+
+Un SpooledPayload mantiene los bytes de un archivo ya procesado hasta que se
+escriben en el ZIP. Si el presupuesto de memoria lo permite, quedan en RAM;
+si no, se derivan a un archivo temporal y se leen con mmap (sin copiarlos).
+
+SpoolWriter arma un SpooledPayload a partir de un contenido que llega por
+partes (p. ej. una descarga): lo acumula en memoria hasta un umbral y, si lo
+supera o el presupuesto se agota, continúa en un archivo temporal.
+
+RangedSpoolFile es un archivo temporal de tamaño conocido que varios threads o
+tareas escriben por posición (descargas por rangos en paralelo).
+"""
+import mmap
+import os
+import tempfile
+import threading
+from typing import Dict, Optional, Union
+
+from backend.core.config import settings
+from backend.core.memory_budget import ByteBudget
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+# Granularidad con la que SpoolWriter reserva presupuesto mientras crece
+RESERVE_STEP = 1024 * 1024
+
+
+def spool_dir() -> Optional[str]:
+    """Directorio para archivos temporales (None = el del sistema)"""
+    return settings.SPOOL_DIR or None
+
+
+class _Reservation:
+    """Bytes reservados en un presupuesto, compartidos por los payloads que leen el mismo buffer"""
+
+    def __init__(self, budget: ByteBudget, nbytes: int):
+        self._budget = budget
+        self._nbytes = nbytes
+        self._holders = 1
+        self._lock = threading.Lock()
+
+    def retain(self) -> None:
+        with self._lock:
+            self._holders += 1
+
+    def release(self) -> None:
+        """Devuelve los bytes al presupuesto cuando lo suelta el último payload"""
+        with self._lock:
+            self._holders -= 1
+            if self._holders:
+                return
+        self._budget.release(self._nbytes)
+
+
+class SpooledPayload:
+    """
+    Bytes en memoria (reservados en un presupuesto) o en un archivo temporal.
+
+    Con owns_file=False el archivo es de otro (p. ej. una entrada de caché):
+    se lee igual, pero close() no lo elimina.
+
+    Las descargas completan validators (ETag / Last-Modified de la respuesta) y
+    marcan not_modified cuando un GET condicional respondió 304 (payload vacío).
+    """
+
+    validators: Optional[Dict[str, str]] = None
+    not_modified: bool = False
+
+    def __init__(
+        self,
+        data: Optional[BytesLike] = None,
+        path: Optional[str] = None,
+        size: int = 0,
+        budget: Optional[ByteBudget] = None,
+        reserved: int = 0,
+        owns_file: bool = True,
+    ):
+        self._data = data
+        self._path = path
+        self._owns_file = owns_file
+        self._size = size
+        self._reservation = _Reservation(budget, reserved) if budget is not None and reserved else None
+        self._file = None
+        self._mmap = None
+
+    @classmethod
+    def hold(cls, data: BytesLike, budget: ByteBudget, timeout: Optional[float]) -> "SpooledPayload":
+        """
+        Retiene el contenido en memoria si hay presupuesto; si no, lo deriva a disco.
+
+        Args:
+            data: Contenido a retener
+            budget: Presupuesto compartido donde reservar los bytes
+            timeout: Segundos de espera por presupuesto antes de derivar a disco
+        """
+        size = memoryview(data).nbytes
+        if size == 0 or budget.acquire(size, timeout=timeout):
+            return cls(data=data, size=size, budget=budget, reserved=size)
+        return cls.spill(data)
+
+    @classmethod
+    def spill(cls, data: BytesLike) -> "SpooledPayload":
+        """Escribe el contenido en un archivo temporal y lo retiene desde disco"""
+        fd, path = tempfile.mkstemp(prefix="tale_spool_", dir=spool_dir())
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except Exception:
+            os.unlink(path)
+            raise
+        return cls(path=path, size=memoryview(data).nbytes)
+
+    @property
+    def size(self) -> int:
+        """Tamaño del contenido en bytes"""
+        return self._size
+
+    @property
+    def spilled(self) -> bool:
+        """True si el contenido está en disco"""
+        return self._path is not None
+
+    def buffer(self) -> BytesLike:
+        """Devuelve el contenido como buffer (bytes en memoria o mmap del archivo)"""
+        if self._path is None:
+            return self._data if self._data is not None else b""
+        if self._mmap is None:
+            self._file = open(self._path, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def share(self) -> "SpooledPayload":
+        """
+        Otro payload sobre el mismo contenido, que se cierra por separado.
+
+        En memoria comparte los bytes y su reserva: el presupuesto la recupera
+        cuando se cierra el último de los payloads que los leen. En disco abre ya
+        su propio mmap, así que sigue siendo legible aunque el original se cierre
+        y elimine el archivo.
+        """
+        if self._path is None:
+            shared = SpooledPayload(data=self._data, size=self._size)
+            if self._reservation is not None:
+                self._reservation.retain()
+                shared._reservation = self._reservation
+        else:
+            shared = SpooledPayload(path=self._path, size=self._size, owns_file=False)
+            shared.buffer()
+        shared.validators = self.validators
+        shared.not_modified = self.not_modified
+        return shared
+
+    def close(self) -> None:
+        """Libera la memoria reservada o elimina el archivo temporal"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._path is not None and self._owns_file:
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+        self._path = None
+        if self._reservation is not None:
+            self._reservation.release()
+            self._reservation = None
+        self._data = None
+
+    def __enter__(self) -> "SpooledPayload":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class SpoolWriter:
+    """
+    Acumula un contenido recibido por partes: en memoria hasta memory_limit
+    (con reserva en el presupuesto, si se indica) y luego en un archivo temporal.
+
+    Args:
+        memory_limit: Bytes máximos que se acumulan en memoria
+        budget: Presupuesto donde reservar los bytes en memoria (sin espera:
+            si no hay espacio, se deriva a disco de inmediato)
+    """
+
+    def __init__(self, memory_limit: int, budget: Optional[ByteBudget] = None):
+        self.memory_limit = max(0, memory_limit)
+        self._budget = budget
+        self._reserved = 0
+        self._buffer = bytearray()
+        self._file = None
+        self._path: Optional[str] = None
+        self.size = 0
+
+    @property
+    def spilled(self) -> bool:
+        """True si el contenido ya se está escribiendo en disco"""
+        return self._path is not None
+
+    def _fits_in_memory(self, total: int) -> bool:
+        if total > self.memory_limit:
+            return False
+        if self._budget is None or total <= self._reserved:
+            return True
+        step = min(max(total - self._reserved, RESERVE_STEP), self.memory_limit - self._reserved)
+        if self._budget.acquire(step, timeout=0):
+            self._reserved += step
+            return True
+        return False
+
+    def _spill(self) -> None:
+        fd, self._path = tempfile.mkstemp(prefix="tale_spool_", dir=spool_dir())
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(self._buffer)
+        self._buffer = bytearray()
+        self._release_budget()
+
+    def _release_budget(self) -> None:
+        if self._budget is not None and self._reserved:
+            self._budget.release(self._reserved)
+            self._reserved = 0
+
+    def write(self, chunk: BytesLike) -> None:
+        """Agrega un fragmento al contenido"""
+        size = memoryview(chunk).nbytes
+        if self._file is None and not self._fits_in_memory(self.size + size):
+            self._spill()
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._buffer += chunk
+        self.size += size
+
+    def finish(self) -> SpooledPayload:
+        """Cierra la escritura y entrega el contenido como SpooledPayload"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            payload = SpooledPayload(path=self._path, size=self.size)
+            self._path = None
+            return payload
+
+        # Ajustar la reserva al tamaño final y transferirla al payload
+        if self._reserved > self.size:
+            self._budget.release(self._reserved - self.size)
+            self._reserved = self.size
+        payload = SpooledPayload(data=self._buffer, size=self.size, budget=self._budget, reserved=self._reserved)
+        self._buffer = bytearray()
+        self._reserved = 0
+        return payload
+
+    def discard(self) -> None:
+        """Descarta lo acumulado (no hace nada tras finish())"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._path is not None:
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+            self._path = None
+        self._buffer = bytearray()
+        self._release_budget()
+
+    def __enter__(self) -> "SpoolWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.discard()
+
+
+class RangedSpoolFile:
+    """
+    Archivo temporal de tamaño fijo que se escribe por posiciones, desde varios
+    threads a la vez, y se entrega como SpooledPayload.
+
+    Args:
+        size: Tamaño final del contenido en bytes
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.aborted = False
+        fd, self._path = tempfile.mkstemp(prefix="tale_spool_", dir=spool_dir())
+        self._fd: Optional[int] = fd
+        self._lock = threading.Lock()
+        try:
+            os.ftruncate(fd, size)
+        except Exception:
+            self.discard()
+            raise
+
+    def write_at(self, offset: int, data: BytesLike) -> None:
+        """Escribe data a partir de offset"""
+        view = memoryview(data)
+        if offset < 0 or offset + view.nbytes > self.size:
+            raise ValueError(f"Write of {view.nbytes} bytes at {offset} exceeds size {self.size}")
+        with self._lock:
+            if self._fd is None:
+                raise ValueError("RangedSpoolFile is closed")
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            while view:
+                written = os.write(self._fd, view)
+                view = view[written:]
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        """Lee length bytes a partir de offset"""
+        with self._lock:
+            if self._fd is None:
+                raise ValueError("RangedSpoolFile is closed")
+            return os.pread(self._fd, length, offset)
+
+    def abort(self) -> None:
+        """Señala a los escritores en curso que dejen de escribir"""
+        self.aborted = True
+
+    def finish(self) -> SpooledPayload:
+        """Cierra el archivo y lo entrega como SpooledPayload"""
+        with self._lock:
+            os.close(self._fd)
+            self._fd = None
+        payload = SpooledPayload(path=self._path, size=self.size)
+        self._path = None
+        return payload
+
+    def discard(self) -> None:
+        """Cierra y elimina el archivo (no hace nada tras finish())"""
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        if self._path is not None:
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+            self._path = None
+
+    def __enter__(self) -> "RangedSpoolFile":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.discard()
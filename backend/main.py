@@ -52,6 +52,10 @@ async def startup_event():
     print(f"🔧 Debug mode: {settings.DEBUG}")
     print(f"📁 Max file size: {settings.MAX_FILE_SIZE_MB}MB")
     print("=" * 80)
+    
+    # Reanudar los trabajos de ZIP interrumpidos por el reinicio
+    from backend.services.zip_jobs import zip_jobs
+    zip_jobs.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -60,8 +64,18 @@ async def shutdown_event():
     print("🛑 TaleDownload Backend Shutting Down...")
     print("=" * 80)
     
+    from backend.services.zip_jobs import zip_jobs
+    zip_jobs.shutdown()
+    
     from backend.services.redshift_service import redshift_service
     redshift_service.close()
+    
+    from backend.services.conversion_executor import conversion_executor
+    conversion_executor.shutdown()
+    
+    from backend.services.download_service import download_service
+    await download_service.aclose()
+    download_service.shutdown()
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8010"))
@@ -0,0 +1,484 @@
+"""
+Caché en disco de ZIPs de proyecto terminados
+
+Los equipos descargan el mismo ZIP de proyecto varias veces al día y cada vez se
+reconstruía completo. El ZIP se guarda en disco mientras se envía por primera
+vez; las siguientes peticiones con los mismos filtros se sirven desde el archivo
+(FileResponse, con soporte de Range).
+
+La clave combina los filtros normalizados (proyecto, tipos, fechas) con la marca
+de agua del resultado: MAX(fecha_carga) y cantidad de documentos. Un documento
+nuevo cambia la clave y el ZIP se reconstruye.
+
+- Escrituras atómicas: el ZIP se escribe en un temporal y se renombra solo si
+  se generó completo, sin ningún documento faltante.
+- Tamaño máximo (ARCHIVE_CACHE_MAX_MB) con desalojo LRU.
+- Entradas fijadas (pin/unpin) mientras se envían: si se desalojan o se purgan
+  entretanto, salen del índice pero el archivo se borra al terminar el envío.
+- Construcciones compartidas: si llega una petición con la misma clave mientras
+  el ZIP se está generando, no lo genera otra vez; lee el archivo en escritura a
+  medida que el primero avanza. Si el primer cliente corta la descarga y hay
+  otros esperando, la generación sigue en segundo plano.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Iterator, Callable, Tuple
+
+from backend.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Prefijo de los ZIPs en escritura (se eliminan al cargar la caché)
+TMP_PREFIX = ".tmp-"
+
+# Tamaño de lectura al servir un ZIP guardado o en construcción
+READ_CHUNK = 256 * 1024
+
+
+class _Build:
+    """Un ZIP en construcción: el archivo temporal y cuánto lleva escrito"""
+
+    def __init__(self, tmp_path: str, file):
+        self.tmp_path = tmp_path
+        self.file = file
+        self.size = 0
+        self.followers = 0
+        self.failed = False
+        self.done = False
+        self.complete = False
+        self.condition = threading.Condition()
+
+
+def default_cache_dir() -> str:
+    return settings.ARCHIVE_CACHE_DIR or os.path.join(tempfile.gettempdir(), "tale_archive_cache")
+
+
+class ArchiveCache:
+    """
+    ZIPs terminados por clave, con desalojo LRU.
+
+    Args:
+        directory: Directorio de la caché (se crea en el primer uso)
+        max_bytes: Tamaño máximo total (0 = caché desactivada)
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max(0, max_bytes)
+        # clave -> (proyecto, tamaño)
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        # clave -> ZIP en construcción
+        self._building: Dict[str, _Build] = {}
+        # clave -> envíos en curso del ZIP guardado; y las quitadas del índice mientras se enviaban
+        self._pins: Dict[str, int] = {}
+        self._doomed: set = set()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "handoffs": 0,
+            "stores": 0,
+            "discarded": 0,
+            "evictions": 0,
+            "purged": 0,
+            "errors": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def archive_key(
+        project_code: str,
+        document_types: Optional[List[str]],
+        start_date: Optional[str],
+        end_date: Optional[str],
+        documents: List[Dict[str, Any]],
+    ) -> str:
+        """
+        Clave de un ZIP: filtros normalizados + MAX(fecha_carga) y cantidad de documentos.
+
+        El orden y los duplicados de document_types no cambian la clave.
+        """
+        normalized = {
+            "project": (project_code or "").strip(),
+            "types": sorted({t.strip() for t in document_types or [] if t and t.strip()}),
+            "start": (start_date or "").strip() or None,
+            "end": (end_date or "").strip() or None,
+            "watermark": max((doc.get("fecha_carga") or "" for doc in documents), default=""),
+            "count": len(documents),
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _zip_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.zip")
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _ensure_loaded(self) -> None:
+        """Indexa los ZIPs existentes, del menos al más reciente (con el lock tomado)"""
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(TMP_PREFIX):
+                os.unlink(entry.path)
+                continue
+            if not entry.name.endswith(".json"):
+                continue
+            key = entry.name[:-len(".json")]
+            try:
+                with open(entry.path, "rb") as f:
+                    meta = json.load(f)
+                stat = os.stat(self._zip_path(key))
+            except (OSError, ValueError):
+                os.unlink(entry.path)
+                continue
+            found.append((stat.st_mtime, key, meta.get("project_code", ""), stat.st_size))
+        for _, key, project_code, size in sorted(found):
+            self._entries[key] = (project_code, size)
+            self._total_bytes += size
+        self._loaded = True
+        self._evict()
+
+    def _remove(self, key: str) -> None:
+        """Elimina una entrada del índice y del disco, o al terminar sus envíos (con el lock tomado)"""
+        _, size = self._entries.pop(key)
+        self._total_bytes -= size
+        if self._pins.get(key):
+            self._doomed.add(key)
+        else:
+            self._unlink(key)
+
+    def _unlink(self, key: str) -> None:
+        for path in (self._meta_path(key), self._zip_path(key)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        """Desaloja los ZIPs menos usados hasta entrar en max_bytes (con el lock tomado)"""
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        """Ruta del ZIP guardado para la clave, o None"""
+        return self._lookup(key, pin=False)
+
+    def pin(self, key: str) -> Optional[str]:
+        """
+        Como get(), pero el archivo no se borra hasta unpin(key).
+
+        Para servir el ZIP (FileResponse lo abre recién al enviarlo): un
+        desalojo o una purga en el medio no lo eliminan bajo la respuesta.
+        """
+        return self._lookup(key, pin=True)
+
+    def unpin(self, key: str) -> None:
+        """Termina un envío de pin(); borra el archivo si la entrada se quitó entretanto"""
+        with self._lock:
+            remaining = self._pins.get(key, 0) - 1
+            if remaining > 0:
+                self._pins[key] = remaining
+                return
+            self._pins.pop(key, None)
+            if key in self._doomed:
+                self._doomed.discard(key)
+                self._unlink(key)
+
+    def _lookup(self, key: str, pin: bool) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                self._ensure_loaded()
+            except OSError as e:
+                self._stats["errors"] += 1
+                logger.warning(f"[ARCHIVE] Could not load archive cache at {self.directory}: {e}")
+                return None
+            if key not in self._entries:
+                self._stats["misses"] += 1
+                return None
+            path = self._zip_path(key)
+            try:
+                os.utime(path)
+            except OSError:
+                self._remove(key)
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            if pin:
+                self._pins[key] = self._pins.get(key, 0) + 1
+            return path
+
+    def store(
+        self,
+        key: str,
+        chunks: Iterator[bytes],
+        cacheable: Callable[[], bool],
+        project_code: str = "",
+    ) -> Iterator[bytes]:
+        """
+        Reenvía los fragmentos del ZIP y a la vez los escribe en la caché.
+
+        El ZIP queda guardado solo si el stream termina y cacheable() es True al
+        final. Si ya hay una construcción en curso con la misma clave, chunks no
+        se consume: se sirve lo que escribe la otra (y el ZIP guardado si terminó
+        entretanto). Un error de disco deja de escribir en la caché sin afectar
+        al stream del primero.
+        """
+        if not self.enabled:
+            yield from chunks
+            return
+
+        build = reader = None
+        with self._lock:
+            try:
+                self._ensure_loaded()
+                build = self._building.get(key)
+                if build is not None:
+                    # Otra petición ya genera este ZIP: leer su archivo en escritura
+                    reader = open(build.tmp_path, "rb")
+                    build.followers += 1
+                    self._stats["coalesced"] += 1
+                elif key in self._entries:
+                    # Terminó entre get() y ahora
+                    reader = open(self._zip_path(key), "rb")
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                else:
+                    fd, tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+                    build = _Build(tmp_path, os.fdopen(fd, "wb"))
+                    self._building[key] = build
+            except OSError as e:
+                self._stats["errors"] += 1
+                logger.warning(f"[ARCHIVE] Could not start caching {key}: {e}")
+                build = reader = None
+
+        if build is None and reader is None:
+            yield from chunks
+        elif build is None:
+            with reader:
+                yield from iter(lambda: reader.read(READ_CHUNK), b"")
+        elif reader is not None:
+            yield from self._follow(key, build, reader)
+        else:
+            yield from self._lead(key, build, chunks, cacheable, project_code)
+
+    def _lead(
+        self,
+        key: str,
+        build: _Build,
+        chunks: Iterator[bytes],
+        cacheable: Callable[[], bool],
+        project_code: str,
+    ) -> Iterator[bytes]:
+        """Genera el ZIP, lo escribe para los seguidores y lo reenvía"""
+        completed = handed_off = False
+        try:
+            for chunk in chunks:
+                self._append(key, build, chunk)
+                try:
+                    yield chunk
+                except GeneratorExit:
+                    # El cliente cortó: si otros esperan este ZIP, seguir en segundo plano
+                    with self._lock:
+                        handed_off = build.followers > 0
+                        if handed_off:
+                            self._stats["handoffs"] += 1
+                        else:
+                            self._building.pop(key, None)
+                    if handed_off:
+                        threading.Thread(
+                            target=self._drain,
+                            args=(key, build, chunks, cacheable, project_code),
+                            name="archive-build",
+                            daemon=True,
+                        ).start()
+                    raise
+            completed = True
+        finally:
+            if not handed_off:
+                self._finish(key, build, completed, cacheable, project_code)
+
+    def _drain(
+        self,
+        key: str,
+        build: _Build,
+        chunks: Iterator[bytes],
+        cacheable: Callable[[], bool],
+        project_code: str,
+    ) -> None:
+        """Termina en segundo plano un ZIP cuyo primer cliente cortó la descarga"""
+        completed = False
+        try:
+            for chunk in chunks:
+                self._append(key, build, chunk)
+            completed = True
+        except Exception as e:
+            logger.warning(f"[ARCHIVE] Background build of {key} failed: {e}")
+        finally:
+            self._finish(key, build, completed, cacheable, project_code)
+
+    def _append(self, key: str, build: _Build, chunk: bytes) -> None:
+        """Escribe un fragmento y avisa a los seguidores"""
+        if build.failed:
+            return
+        try:
+            build.file.write(chunk)
+            build.file.flush()
+        except OSError as e:
+            logger.warning(f"[ARCHIVE] Not caching {key}: {e}")
+            self._count("errors")
+            build.failed = True
+        with build.condition:
+            build.size += len(chunk)
+            build.condition.notify_all()
+
+    def _finish(
+        self,
+        key: str,
+        build: _Build,
+        completed: bool,
+        cacheable: Callable[[], bool],
+        project_code: str,
+    ) -> None:
+        """Guarda o descarta el ZIP y despierta a los seguidores"""
+        with self._lock:
+            if self._building.get(key) is build:
+                del self._building[key]
+        build.file.close()
+        if completed and not build.failed and build.size <= self.max_bytes and cacheable():
+            self._commit(key, build.tmp_path, build.size, project_code)
+        else:
+            try:
+                os.unlink(build.tmp_path)
+            except FileNotFoundError:
+                pass
+            if not build.failed:
+                self._count("discarded")
+        with build.condition:
+            build.done = True
+            build.complete = completed and not build.failed
+            build.condition.notify_all()
+
+    def _follow(self, key: str, build: _Build, reader) -> Iterator[bytes]:
+        """Sirve un ZIP que genera otra petición, a medida que se escribe"""
+        position = 0
+        try:
+            while True:
+                with build.condition:
+                    while build.size <= position and not build.done and not build.failed:
+                        build.condition.wait()
+                    available, done, complete = build.size, build.done, build.complete
+                if build.failed or (done and not complete):
+                    raise RuntimeError(f"Shared build of archive {key} failed")
+                while position < available:
+                    data = reader.read(min(READ_CHUNK, available - position))
+                    if not data:
+                        raise RuntimeError(f"Shared build of archive {key} was truncated")
+                    position += len(data)
+                    yield data
+                if done:
+                    return
+        finally:
+            reader.close()
+            with self._lock:
+                build.followers -= 1
+
+    def abandon(self, key: str, cancel: Callable[[], None]) -> bool:
+        """
+        El cliente que genera este ZIP se desconectó: llama a cancel() salvo que
+        otras peticiones lo estén leyendo (entonces la generación sigue).
+
+        Returns:
+            True si se canceló
+        """
+        with self._lock:
+            build = self._building.get(key)
+            if build is not None:
+                if build.followers > 0:
+                    return False
+                # Las peticiones nuevas ya no se suman a esta construcción
+                del self._building[key]
+        cancel()
+        return True
+
+    def _commit(self, key: str, tmp_path: str, size: int, project_code: str) -> None:
+        """Publica un ZIP ya escrito: primero el archivo, luego sus metadatos"""
+        meta = json.dumps({"project_code": project_code, "size": size, "created": time.time()}).encode("utf-8")
+        try:
+            os.replace(tmp_path, self._zip_path(key))
+            fd, meta_tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(meta)
+            os.replace(meta_tmp, self._meta_path(key))
+        except OSError as e:
+            self._count("errors")
+            logger.warning(f"[ARCHIVE] Could not store {key}: {e}")
+            return
+        with self._lock:
+            if key in self._entries:
+                _, previous = self._entries.pop(key)
+                self._total_bytes -= previous
+            # El archivo ya es el nuevo: no borrarlo cuando terminen los envíos del anterior
+            self._doomed.discard(key)
+            self._entries[key] = (project_code, size)
+            self._total_bytes += size
+            self._stats["stores"] += 1
+            self._evict()
+        logger.info(f"[ARCHIVE] Cached {project_code or 'archive'} ({size / (1024 * 1024):.1f} MB)")
+
+    def purge(self, project_code: Optional[str] = None) -> int:
+        """
+        Elimina los ZIPs guardados de un proyecto (o todos).
+
+        Returns:
+            Cantidad de ZIPs eliminados
+        """
+        with self._lock:
+            self._ensure_loaded()
+            keys = [key for key, (project, _) in self._entries.items() if project_code is None or project == project_code]
+            for key in keys:
+                self._remove(key)
+            self._stats["purged"] += len(keys)
+        return len(keys)
+
+    def _count(self, key: str, delta: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += delta
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "building": len(self._building),
+                "pinned": sum(self._pins.values()),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "directory": self.directory,
+            })
+        return stats
+
+
+archive_cache = ArchiveCache(
+    directory=default_cache_dir(),
+    max_bytes=settings.ARCHIVE_CACHE_MAX_MB * 1024 * 1024,
+)
@@ -0,0 +1,250 @@
+"""
+Ejecutor de conversiones imagen → PDF en un pool de procesos
+
+Las conversiones de imagen (decodificación, resize LANCZOS, codificación) son
+trabajo de CPU que bajo el GIL no escala con threads. Este ejecutor las envía a
+un pool de procesos:
+
+- Cada worker tiene un límite de memoria (RLIMIT_AS): una imagen desmesurada
+  provoca MemoryError dentro de su propio worker y solo falla ese documento.
+- Los workers se reciclan cada CONVERSION_MAX_TASKS_PER_CHILD conversiones.
+- Si un worker muere (p. ej. lo mata el kernel), el pool se reconstruye y las
+  conversiones afectadas se reintentan una vez.
+- Si una conversión supera CONVERSION_TIMEOUT_SECONDS, su worker sigue ocupado
+  (cancelar el future no detiene una tarea en curso): el pool se reemplaza y sus
+  workers se terminan, de modo que la conversión colgada no retiene un proceso.
+  Las demás conversiones en curso en ese pool se reintentan una vez en el nuevo.
+
+Los PDF, los formatos passthrough y los JPEG que se incrustan sin recodificar
+se resuelven en el proceso actual, sin copiar su contenido a otro proceso.
+
+Los envíos al pool pasan por un planificador con un cupo por proceso (ver
+backend.core.scheduler): la cola de espera se reparte con colas justas entre
+los ZIPs en curso en lugar de atenderse por orden de llegada, y el timeout de
+una conversión empieza a contar cuando tiene un worker libre.
+"""
+import logging
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any
+
+from backend.core.cancellation import Cancelled, cancellation_metrics, current_token
+from backend.core.config import settings
+from backend.core.scheduler import FairScheduler
+from backend.services.pdf_service import PDFService, IMAGE_EXTENSIONS
+from backend.utils.content_sniffer import sniff_content
+
+logger = logging.getLogger(__name__)
+
+# Reintentos de una conversión cuando el pool se rompe por la caída de un worker
+CRASH_RETRIES = 1
+
+
+def _init_worker(memory_limit_mb: int) -> None:
+    """Inicializa un worker: aplica el límite de memoria del proceso"""
+    if memory_limit_mb <= 0:
+        return
+    try:
+        import resource
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError) as e:
+        print(f"⚠️  Could not set worker memory limit: {e}")
+
+
+def _convert_in_worker(content: bytes, original_filename: Optional[str]) -> Optional[dict]:
+    """Punto de entrada dentro del worker"""
+    try:
+        return PDFService.convert_to_pdf(content, original_filename)
+    except MemoryError:
+        print(f"❌ Conversion exceeded worker memory limit: {original_filename}")
+        return None
+
+
+def _mp_context():
+    """forkserver en Linux (sin heredar el estado de la app); spawn en el resto"""
+    if sys.platform.startswith("linux"):
+        ctx = multiprocessing.get_context("forkserver")
+        # Precargar solo este módulo: evita re-importar la app (y su pool de Redshift)
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+class ConversionExecutor:
+    """Pool de procesos para convertir imágenes a PDF con aislamiento por worker"""
+
+    def __init__(
+        self,
+        processes: int,
+        max_tasks_per_child: int,
+        memory_limit_mb: int,
+        timeout: float,
+    ):
+        self.processes = max(0, processes)
+        self.max_tasks_per_child = max(1, max_tasks_per_child)
+        self.memory_limit_mb = memory_limit_mb
+        self.timeout = timeout
+        self.scheduler = FairScheduler("conversion", max_concurrency=self.processes)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "inline": 0,
+            "in_flight": 0,
+            "worker_crashes": 0,
+            "pool_restarts": 0,
+            "timeouts": 0,
+            "cancelled": 0,
+        }
+
+    def _count(self, key: str, delta: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[key] += delta
+
+    def _get_pool(self):
+        """Crea el pool en el primer uso; devuelve (pool, generación)"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=_mp_context(),
+                    initializer=_init_worker,
+                    initargs=(self.memory_limit_mb,),
+                    max_tasks_per_child=self.max_tasks_per_child,
+                )
+                self._generation += 1
+                logger.info(
+                    f"[CONVERT] Process pool started: {self.processes} workers, "
+                    f"recycle every {self.max_tasks_per_child} tasks, {self.memory_limit_mb} MB per worker"
+                )
+            return self._pool, self._generation
+
+    def _restart_pool(self, generation: int, terminate: bool = False) -> None:
+        """
+        Reemplaza el pool (solo una vez por generación).
+
+        Con terminate, además termina sus workers: uno puede seguir colgado en
+        una conversión que ya superó su timeout.
+        """
+        with self._lock:
+            if self._pool is None or self._generation != generation:
+                return
+            pool, self._pool = self._pool, None
+            # shutdown() olvida los procesos: se toman antes para poder terminarlos
+            workers = list((getattr(pool, "_processes", None) or {}).values())
+            pool.shutdown(wait=False, cancel_futures=True)
+            self._count("pool_restarts")
+            if terminate:
+                for worker in workers:
+                    worker.terminate()
+                logger.warning(f"[CONVERT] Terminated {len(workers)} workers after a conversion timeout; restarting pool")
+            else:
+                logger.warning("[CONVERT] Process pool broken by a worker crash; restarting")
+
+    def convert_to_pdf(self, content: bytes, original_filename: str = None) -> Optional[dict]:
+        """
+        Igual que PDFService.convert_to_pdf, pero las imágenes se convierten en el pool.
+
+        Returns:
+            Diccionario {"mode", "content", "extension"} o None si falla.
+        """
+        info = sniff_content(content)
+        ext = PDFService.resolve_extension(content, original_filename, info)
+        # PDFs, passthrough y JPEGs incrustables cuestan menos que enviarlos a otro proceso
+        if self.processes == 0 or ext not in IMAGE_EXTENSIONS or PDFService.can_embed_jpeg(info):
+            self._count("inline")
+            return PDFService.convert_to_pdf(content, original_filename)
+
+        # Las dimensiones vienen de la cabecera: una imagen desmesurada ni se envía al pool
+        if info.pixels is not None and info.pixels > settings.MAX_IMAGE_PIXELS:
+            print(f"❌ Image too large: {info.width}x{info.height} ({original_filename})")
+            self._count("failed")
+            return None
+
+        self._count("submitted")
+        self._count("in_flight")
+        try:
+            for attempt in range(CRASH_RETRIES + 1):
+                pool, generation = self._get_pool()
+                try:
+                    with self.scheduler.slot():
+                        future = pool.submit(_convert_in_worker, bytes(content), original_filename)
+                        result = self._wait(future)
+                    self._count("completed" if result else "failed")
+                    return result
+                except RuntimeError as e:
+                    if isinstance(e, BrokenProcessPool):
+                        self._count("worker_crashes")
+                    # Pool roto, o reemplazado por otro thread entre _get_pool() y submit()
+                    self._restart_pool(generation)
+                    logger.warning(
+                        f"[CONVERT] Process pool unavailable converting {original_filename}: {e} "
+                        f"(attempt {attempt + 1}/{CRASH_RETRIES + 1})"
+                    )
+                except FutureTimeoutError:
+                    # El worker sigue con la tarea (cancel() no la detiene): se termina con su pool
+                    self._restart_pool(generation, terminate=True)
+                    self._count("timeouts")
+                    logger.warning(f"[CONVERT] Conversion timed out after {self.timeout}s: {original_filename}")
+                    break
+            self._count("failed")
+            return None
+        finally:
+            self._count("in_flight", -1)
+
+    def _wait(self, future):
+        """
+        Resultado de una conversión enviada al pool.
+
+        Si el token de cancelación activo se cancela mientras la conversión
+        sigue en cola, se retira de la cola y se lanza Cancelled (una que ya
+        está en un worker termina y su resultado se descarta).
+        """
+        token = current_token()
+        if token is None:
+            return future.result(timeout=self.timeout)
+        try:
+            with token.on_cancel(future.cancel):
+                return future.result(timeout=self.timeout)
+        except CancelledError:
+            if not token.cancelled:
+                raise
+            self._count("cancelled")
+            cancellation_metrics.count("conversions_cancelled")
+            raise Cancelled()
+
+    def stats(self) -> Dict[str, Any]:
+        """Métricas del ejecutor de conversión"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({
+            "processes": self.processes,
+            "max_tasks_per_child": self.max_tasks_per_child,
+            "memory_limit_mb": self.memory_limit_mb,
+            "pool_running": self._pool is not None,
+            "scheduler": self.scheduler.stats(),
+        })
+        return stats
+
+    def shutdown(self) -> None:
+        """Detiene el pool de procesos"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
+
+
+conversion_executor = ConversionExecutor(
+    processes=settings.CONVERSION_PROCESSES,
+    max_tasks_per_child=settings.CONVERSION_MAX_TASKS_PER_CHILD,
+    memory_limit_mb=settings.CONVERSION_WORKER_MEMORY_MB,
+    timeout=settings.CONVERSION_TIMEOUT_SECONDS,
+)
@@ -0,0 +1,438 @@
+"""
+Caché en disco de documentos convertidos
+
+Los documentos no cambian una vez subidos, pero cada descarga individual y cada
+ZIP volvían a convertirlos. El resultado de cada conversión se guarda en disco
+con una clave derivada del contenido original (SHA-256): una imagen que ya se
+convirtió se sirve desde la caché sin pasar por el pool de procesos.
+
+- Escrituras atómicas: archivo temporal en el mismo directorio + os.replace, de
+  modo que nunca se lee una entrada a medio escribir.
+- Tamaño máximo (DOCUMENT_CACHE_MAX_MB) con desalojo LRU; el orden sobrevive a
+  un reinicio porque cada acierto actualiza la fecha de modificación del archivo.
+- Las entradas se leen con mmap: desalojar una entrada que alguien está
+  enviando no la corta.
+
+Revalidación: cuando la descarga trae ETag/Last-Modified, se guarda también el
+resultado de PDFs y passthrough, y junto a él (validators/) los validadores de
+la URL. La siguiente descarga de esa URL es un GET condicional: con un 304 se
+usa directamente la entrada guardada, sin transferir ni convertir nada.
+
+Coalescencia: descargas concurrentes de la misma URL y conversiones concurrentes
+de la misma imagen se ejecutan una sola vez (SingleFlight); el resto de los
+llamadores espera y recibe su propia copia del resultado.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+from backend.core.config import settings
+from backend.core.memory_budget import ByteBudget
+from backend.core.singleflight import SingleFlight
+from backend.core.spool import BytesLike, SpooledPayload
+from backend.services.conversion_executor import conversion_executor
+from backend.services.download_service import download_service
+from backend.services.pdf_service import PDFService, IMAGE_EXTENSIONS
+from backend.utils.content_sniffer import sniff_content
+
+logger = logging.getLogger(__name__)
+
+# Cambiar al modificar la conversión: invalida las entradas anteriores
+CACHE_FORMAT_VERSION = b"1"
+
+# Prefijo de las escrituras en curso (se eliminan al cargar la caché)
+TMP_PREFIX = ".tmp-"
+
+# Largo de una clave (SHA-256 en hexadecimal)
+KEY_LENGTH = 64
+
+# Subdirectorio con los validadores HTTP de cada URL
+VALIDATORS_DIR = "validators"
+
+
+def default_cache_dir() -> str:
+    return settings.DOCUMENT_CACHE_DIR or os.path.join(tempfile.gettempdir(), "tale_document_cache")
+
+
+class DocumentCache:
+    """
+    Entradas clave -> (extensión, tamaño) en un directorio, con desalojo LRU.
+
+    Args:
+        directory: Directorio de la caché (se crea en el primer uso)
+        max_bytes: Tamaño máximo total (0 = caché desactivada)
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max(0, max_bytes)
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.download_flight = SingleFlight("downloads")
+        self.conversion_flight = SingleFlight("conversions")
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "errors": 0,
+            "revalidations": 0,
+            "not_modified_hits": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def content_key(content: BytesLike) -> str:
+        """Clave de un contenido original"""
+        digest = hashlib.sha256(CACHE_FORMAT_VERSION + b"\0")
+        digest.update(content)
+        return digest.hexdigest()
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}{extension}")
+
+    def _validators_path(self, url: str) -> str:
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, VALIDATORS_DIR, f"{name}.json")
+
+    @staticmethod
+    def _write_atomic(path: str, content: BytesLike) -> None:
+        """Escribe en un temporal del mismo directorio y lo renombra sobre path"""
+        fd, tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _ensure_loaded(self) -> None:
+        """Indexa las entradas existentes, de la menos a la más reciente (con el lock tomado)"""
+        if self._loaded:
+            return
+        os.makedirs(os.path.join(self.directory, VALIDATORS_DIR), exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.startswith(TMP_PREFIX):
+                # Escritura interrumpida (p. ej. un reinicio a mitad de put)
+                os.unlink(entry.path)
+                continue
+            key, extension = entry.name[:KEY_LENGTH], entry.name[KEY_LENGTH:]
+            if len(key) != KEY_LENGTH or not extension.startswith("."):
+                continue
+            stat = entry.stat()
+            found.append((stat.st_mtime, key, extension, stat.st_size))
+        for _, key, extension, size in sorted(found):
+            self._entries[key] = (extension, size)
+            self._total_bytes += size
+        self._loaded = True
+        self._evict()
+
+    def _evict(self) -> None:
+        """Desaloja las entradas menos usadas hasta entrar en max_bytes (con el lock tomado)"""
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, (extension, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self._stats["evictions"] += 1
+            try:
+                os.unlink(self._path(key, extension))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[Tuple[SpooledPayload, str]]:
+        """
+        Abre una entrada.
+
+        Returns:
+            (payload, extensión) o None si no está. El payload lee el archivo de la
+            caché con mmap y el llamador debe cerrarlo (no elimina la entrada).
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                self._ensure_loaded()
+            except OSError as e:
+                self._stats["errors"] += 1
+                logger.warning(f"[CACHE] Could not load document cache at {self.directory}: {e}")
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            extension, size = entry
+            path = self._path(key, extension)
+            payload = SpooledPayload(path=path, size=size, owns_file=False)
+            try:
+                # Abrir ya (con el lock) para que un desalojo no lo elimine antes
+                payload.buffer()
+                os.utime(path)
+            except (OSError, ValueError):
+                payload.close()
+                del self._entries[key]
+                self._total_bytes -= size
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return payload, extension
+
+    def put(self, key: str, content: BytesLike, extension: str) -> bool:
+        """
+        Guarda una entrada (escritura atómica). Un error de disco no se propaga:
+        la caché es solo una optimización.
+
+        Returns:
+            True si quedó guardada
+        """
+        size = memoryview(content).nbytes
+        if not self.enabled or size == 0 or size > self.max_bytes:
+            return False
+        try:
+            with self._lock:
+                self._ensure_loaded()
+            self._write_atomic(self._path(key, extension), content)
+        except OSError as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            logger.warning(f"[CACHE] Could not store {key}{extension}: {e}")
+            return False
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous[1]
+            self._entries[key] = (extension, size)
+            self._total_bytes += size
+            self._stats["stores"] += 1
+            self._evict()
+        return True
+
+    def clear(self) -> None:
+        """Elimina todas las entradas y los validadores"""
+        with self._lock:
+            max_bytes, self.max_bytes = self.max_bytes, 0
+            self._evict()
+            self.max_bytes = max_bytes
+            validators_dir = os.path.join(self.directory, VALIDATORS_DIR)
+            if os.path.isdir(validators_dir):
+                for entry in os.scandir(validators_dir):
+                    os.unlink(entry.path)
+
+    # ------------------------------------------------------------------
+    # Revalidación por URL
+    # ------------------------------------------------------------------
+
+    def _read_url_entry(self, url: str) -> Optional[Dict[str, Any]]:
+        """Validadores y entrada de la URL, si la entrada sigue en la caché"""
+        if not self.enabled or not url:
+            return None
+        path = self._validators_path(url)
+        try:
+            with open(path, "rb") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            try:
+                self._ensure_loaded()
+            except OSError:
+                return None
+            if record.get("url") == url and record.get("key") in self._entries:
+                return record
+        # La entrada fue desalojada: los validadores ya no sirven
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return None
+
+    def validators_for(self, url: str) -> Optional[Dict[str, str]]:
+        """{"etag", "last_modified"} para un GET condicional de la URL, o None"""
+        record = self._read_url_entry(url)
+        if record is None:
+            return None
+        return {"etag": record.get("etag"), "last_modified": record.get("last_modified")}
+
+    def open_url(self, url: str) -> Optional[SpooledPayload]:
+        """Entrada guardada de la URL (tras un 304), o None si ya no está"""
+        record = self._read_url_entry(url)
+        cached = self.get(record["key"]) if record is not None else None
+        if cached is None:
+            return None
+        with self._lock:
+            self._stats["not_modified_hits"] += 1
+        return cached[0]
+
+    def size_hint(self, url: str) -> Optional[int]:
+        """Tamaño de la entrada guardada de la URL (sin leerla), o None si no hay"""
+        record = self._read_url_entry(url)
+        if record is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(record["key"])
+        return entry[1] if entry is not None else None
+
+    def _remember_url(self, url: str, validators: Dict[str, str], key: str, extension: str) -> None:
+        """Asocia la URL y sus validadores a una entrada"""
+        record = {
+            "url": url,
+            "etag": validators.get("etag"),
+            "last_modified": validators.get("last_modified"),
+            "key": key,
+            "extension": extension,
+        }
+        try:
+            self._write_atomic(self._validators_path(url), json.dumps(record).encode("utf-8"))
+        except OSError as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            logger.warning(f"[CACHE] Could not store validators for {url}: {e}")
+
+    def _resolve_download(self, url: str, download: Optional[SpooledPayload]) -> Tuple[Optional[SpooledPayload], bool]:
+        """(entrada guardada si la descarga fue un 304, True si hay que descargar de nuevo)"""
+        if download is None or not download.not_modified:
+            return download, False
+        cached = self.open_url(url)
+        # Desalojada entre el GET condicional y ahora: descargar de nuevo
+        return cached, cached is None
+
+    def fetch(self, url: str, budget: Optional[ByteBudget] = None) -> Optional[SpooledPayload]:
+        """
+        Descarga la URL revalidando la copia guardada.
+
+        Las descargas concurrentes de la misma URL (también desde fetch_async)
+        se hacen una sola vez; cada llamador recibe su propio payload. Los que
+        quedan en memoria comparten los bytes y su reserva en budget, que se
+        libera al cerrarse el último.
+
+        Returns:
+            La descarga (con sus validadores), la entrada guardada si el servidor
+            respondió 304, o None si falla. El llamador debe cerrarla.
+        """
+        return self.download_flight.do(url, lambda: self._fetch(url, budget), share=SpooledPayload.share)
+
+    def _fetch(self, url: str, budget: Optional[ByteBudget]) -> Optional[SpooledPayload]:
+        validators = self._start_revalidation(url)
+        payload, retry = self._resolve_download(url, download_service.download(url, budget=budget, validators=validators))
+        if retry:
+            payload = download_service.download(url, budget=budget)
+        return payload
+
+    async def fetch_async(self, url: str, budget: Optional[ByteBudget] = None) -> Optional[SpooledPayload]:
+        """Igual que fetch(), con el motor asyncio de download_service"""
+        return await self.download_flight.do_async(url, lambda: self._fetch_async(url, budget), share=SpooledPayload.share)
+
+    async def _fetch_async(self, url: str, budget: Optional[ByteBudget]) -> Optional[SpooledPayload]:
+        validators = self._start_revalidation(url)
+        download = await download_service.download_async(url, budget=budget, validators=validators)
+        payload, retry = self._resolve_download(url, download)
+        if retry:
+            payload = await download_service.download_async(url, budget=budget)
+        return payload
+
+    def _start_revalidation(self, url: str) -> Optional[Dict[str, str]]:
+        """Validadores para el GET condicional de la URL (y cuenta la revalidación)"""
+        validators = self.validators_for(url)
+        if validators is not None:
+            with self._lock:
+                self._stats["revalidations"] += 1
+        return validators
+
+    def convert_to_pdf(
+        self,
+        content: BytesLike,
+        original_filename: str = None,
+        url: str = None,
+        validators: Optional[Dict[str, str]] = None,
+    ) -> Optional[dict]:
+        """
+        conversion_executor.convert_to_pdf con caché.
+
+        Sin validadores solo se guardan las conversiones que producen un
+        contenido nuevo (imágenes → PDF). Con url y validators (descarga con
+        ETag/Last-Modified) se guarda también el resultado de PDFs y passthrough
+        y se asocia a la URL para revalidarla con un GET condicional.
+
+        Returns:
+            Diccionario {"mode", "content", "extension"} o None si falla. En un
+            acierto incluye además "payload": el SpooledPayload de la entrada, cuyo
+            buffer es "content" (el llamador debe cerrarlo).
+        """
+        if not self.enabled:
+            return conversion_executor.convert_to_pdf(content, original_filename)
+        remember = bool(url and validators)
+        extension = PDFService.resolve_extension(content, original_filename, sniff_content(content))
+        if extension not in IMAGE_EXTENSIONS and not remember:
+            return conversion_executor.convert_to_pdf(content, original_filename)
+
+        key = self.content_key(content)
+        cached = self.get(key)
+        if cached is not None:
+            payload, cached_extension = cached
+            if remember:
+                self._remember_url(url, validators, key, cached_extension)
+            mode = "pdf" if cached_extension == ".pdf" else "passthrough"
+            return {"mode": mode, "content": payload.buffer(), "extension": cached_extension, "payload": payload}
+
+        if extension not in IMAGE_EXTENSIONS:
+            # PDF / passthrough: el resultado es el propio buffer del llamador, no se comparte
+            result, stored = self._convert_and_store(key, content, original_filename, True)
+        else:
+            # Una misma imagen que llega a la vez por varias peticiones se convierte una vez
+            result, stored = self.conversion_flight.do(
+                key,
+                lambda: self._convert_and_store(key, content, original_filename, remember),
+                share=lambda outcome: (dict(outcome[0]) if outcome[0] else None, outcome[1]),
+            )
+        if stored and remember:
+            self._remember_url(url, validators, key, result["extension"])
+        return result
+
+    def _convert_and_store(
+        self,
+        key: str,
+        content: BytesLike,
+        original_filename: Optional[str],
+        store_identity: bool,
+    ) -> Tuple[Optional[dict], bool]:
+        """(resultado de la conversión, True si quedó guardado en la caché)"""
+        result = conversion_executor.convert_to_pdf(content, original_filename)
+        stored = False
+        if result and (store_identity or result["content"] is not content):
+            stored = self.put(key, result["content"], result["extension"])
+        return result, stored
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "directory": self.directory,
+            })
+        stats["coalesced_downloads"] = self.download_flight.stats()
+        stats["coalesced_conversions"] = self.conversion_flight.stats()
+        return stats
+
+
+document_cache = DocumentCache(
+    directory=default_cache_dir(),
+    max_bytes=settings.DOCUMENT_CACHE_MAX_MB * 1024 * 1024,
+)
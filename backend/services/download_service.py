@@ -1,73 +1,1057 @@
 """
 Servicio de descarga de archivos desde URLs públicas
+
+Todas las descargas comparten una sesión HTTP con pool de conexiones keep-alive:
+los archivos de un mismo host (sperant.s3.amazonaws.com) reutilizan conexiones
+TCP+TLS en lugar de abrir una nueva por archivo.
+
+Hay dos motores con el mismo comportamiento (límite de tamaño, spill a disco):
+- download(): bloqueante (requests), para los threads del pipeline de ZIP.
+- download_async(): asyncio (httpx), para las rutas async sin bloquear el event loop.
+
+Con DOWNLOAD_HEDGING, si un GET no responde dentro del p95 de TTFB del host se
+lanza un segundo GET (dentro del presupuesto global de hedges): gana la primera
+respuesta y la otra se cancela o se cierra al llegar.
+
+Los archivos mayores a DOWNLOAD_RANGED_THRESHOLD_MB cuyo servidor anuncia
+Accept-Ranges se descargan en hasta DOWNLOAD_RANGED_PARTS rangos en paralelo,
+escritos por posición en un archivo temporal: el GET original aporta la primera
+parte y cada rango extra ocupa un cupo libre del planificador (sin cupos libres,
+no se parte). Si algún rango falla, el servidor lo ignora o el cuerpo excede su
+Content-Length, se sigue leyendo el GET original.
+
+Cada descarga lleva los validadores de la respuesta (ETag, Last-Modified). Con
+validators, el GET es condicional (If-None-Match / If-Modified-Since) y un 304
+devuelve un payload vacío con not_modified=True: el llamador reutiliza su copia.
+
+Si el token de cancelación activo (ver backend.core.cancellation) se cancela, la
+descarga se corta en el siguiente fragmento con Cancelled, sin contar como fallo
+del host ni reintentarse.
+
+Cada intento espera un cupo del planificador global (backend.core.scheduler):
+el total de descargas simultáneas del proceso y por host está acotado, y los
+cupos se reparten con colas justas entre los ZIPs en curso.
 """
+import asyncio
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
+from http.cookiejar import DefaultCookiePolicy
+from typing import Optional, Dict, Any, AsyncIterator, Iterator, List, Tuple
+from urllib.parse import urlsplit
+
+import httpx
 import requests
-from typing import Optional
-import io
+from requests.adapters import HTTPAdapter
+
+from backend.core.cancellation import Cancelled, cancel_requested, cancellation_metrics, current_token
+from backend.core.circuit_breaker import CircuitBreaker, HostCircuitBreakers, download_circuit_breakers
 from backend.core.config import settings
+from backend.core.hedging import HedgeBudget, download_hedge_budget
+from backend.core.host_throughput import HostThroughput, download_throughput
+from backend.core.memory_budget import ByteBudget
+from backend.core.negative_cache import NegativeCache, download_negative_cache
+from backend.core.retry import RetryPolicy, download_retry_policy
+from backend.core.scheduler import FairScheduler, download_scheduler
+from backend.core.spool import RangedSpoolFile, SpooledPayload, SpoolWriter
+
+# Tamaño de cada lectura del cuerpo de la respuesta
+CHUNK_SIZE = 64 * 1024
+
+Validators = Dict[str, str]
+
+
+class _RangeNotHonored(Exception):
+    """El servidor respondió un Range con algo distinto al rango pedido"""
+
+
+class _BodyTooLong(Exception):
+    """El GET original trajo más bytes que su Content-Length"""
+
+    def __init__(self, offset: int, chunk: bytes):
+        super().__init__(offset)
+        self.offset = offset
+        self.chunk = chunk
+
+
+class _TransferTooSlow(Exception):
+    """Una descarga por rangos superó su plazo de transferencia"""
+
+    def __init__(self, received: int):
+        super().__init__(received)
+        self.received = received
+
+
+def _build_session(pool_size: int) -> requests.Session:
+    """Sesión compartida entre threads: pool dimensionado y sin estado de cookies"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Sin cookies, la sesión no guarda estado mutable entre peticiones concurrentes
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
 
 class DownloadService:
     """Servicio para descargar archivos desde URLs públicas"""
-    
+
+    def __init__(
+        self,
+        pool_size: int = None,
+        connect_timeout: float = None,
+        memory_threshold_mb: int = None,
+        retry_policy: RetryPolicy = None,
+        circuit_breakers: HostCircuitBreakers = None,
+        negative_cache: NegativeCache = None,
+        throughput: HostThroughput = None,
+        hedging: bool = None,
+        hedge_budget: HedgeBudget = None,
+        ranged_threshold_mb: int = None,
+        ranged_parts: int = None,
+        scheduler: FairScheduler = None,
+    ):
+        self.pool_size = pool_size or settings.DOWNLOAD_POOL_SIZE
+        self.connect_timeout = connect_timeout or settings.DOWNLOAD_CONNECT_TIMEOUT_SECONDS
+        self.memory_threshold = (memory_threshold_mb or settings.DOWNLOAD_MEMORY_THRESHOLD_MB) * 1024 * 1024
+        self.retry_policy = retry_policy or download_retry_policy
+        self.circuit_breakers = circuit_breakers or download_circuit_breakers
+        self.negative_cache = negative_cache or download_negative_cache
+        self.throughput = throughput or download_throughput
+        self.hedging = settings.DOWNLOAD_HEDGING if hedging is None else hedging
+        self.hedge_budget = hedge_budget or download_hedge_budget
+        threshold_mb = settings.DOWNLOAD_RANGED_THRESHOLD_MB if ranged_threshold_mb is None else ranged_threshold_mb
+        self.ranged_threshold = threshold_mb * 1024 * 1024
+        self.ranged_parts = max(2, ranged_parts or settings.DOWNLOAD_RANGED_PARTS)
+        self.scheduler = scheduler or download_scheduler
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.session = _build_session(self.pool_size)
+        # Un cliente async por event loop (un cliente httpx no se comparte entre loops)
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "downloads": 0,
+            "failed": 0,
+            "too_large": 0,
+            "spilled": 0,
+            "bytes_downloaded": 0,
+            "async_downloads": 0,
+            "retries": 0,
+            "circuit_rejected": 0,
+            "negative_cache_hits": 0,
+            "deadline_exceeded": 0,
+            "hedges": 0,
+            "hedges_won": 0,
+            "ranged_downloads": 0,
+            "ranged_parts": 0,
+            "ranged_fallbacks": 0,
+            "not_modified": 0,
+            "size_probes": 0,
+        }
+
+    def _count(self, key: str, delta: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[key] += delta
+
+    # ------------------------------------------------------------------
+    # Hedged requests
+    # ------------------------------------------------------------------
+
+    def _hedge_delay(self, host: str) -> Optional[float]:
+        """Segundos sin respuesta tras los que se lanza un hedge (None = sin hedging)"""
+        if not self.hedging:
+            return None
+        return self.throughput.ttfb_percentile(
+            host, settings.DOWNLOAD_HEDGE_PERCENTILE, settings.DOWNLOAD_HEDGE_MIN_SAMPLES
+        )
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Threads auxiliares para hedges y rangos en paralelo"""
+        with self._async_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size + self.hedge_budget.max_in_flight,
+                    thread_name_prefix="download-aux",
+                )
+            return self._executor
+
+    def _open(
+        self, url: str, timeouts: Tuple[float, float], headers: Optional[Dict[str, str]] = None
+    ) -> Tuple[requests.Response, float]:
+        """Envía el GET y espera los encabezados; devuelve (respuesta, TTFB)"""
+        started = time.monotonic()
+        response = self.session.get(url, headers=headers, timeout=timeouts, stream=True)
+        return response, time.monotonic() - started
+
+    @staticmethod
+    def _discard_response_future(future) -> None:
+        """Cancela el GET perdedor; si ya está en curso, cierra su respuesta al llegar"""
+        def close(done):
+            if not done.cancelled() and done.exception() is None:
+                done.result()[0].close()
+        if not future.cancel():
+            future.add_done_callback(close)
+
+    def _open_hedged(
+        self, url: str, host: str, timeouts: Tuple[float, float], headers: Optional[Dict[str, str]] = None
+    ) -> Tuple[requests.Response, float]:
+        """Como _open, con un hedge si el GET no responde dentro del p95 de TTFB del host"""
+        delay = self._hedge_delay(host)
+        if delay is None:
+            return self._open(url, timeouts, headers)
+
+        self.hedge_budget.record_request()
+        executor = self._get_executor()
+        primary = executor.submit(self._open, url, timeouts, headers)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        if not self.hedge_budget.try_acquire():
+            return primary.result()
+
+        self._count("hedges")
+        hedge = executor.submit(self._open, url, timeouts, headers)
+        hedge.add_done_callback(lambda _: self.hedge_budget.release())
+        errors = []
+        for future in as_completed([primary, hedge]):
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            self._discard_response_future(hedge if future is primary else primary)
+            if future is hedge:
+                self._count("hedges_won")
+            return result
+        raise errors[0]
+
+    async def _open_async(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        request_timeout: httpx.Timeout,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[httpx.Response, float]:
+        """Envía el GET y espera los encabezados; devuelve (respuesta, TTFB)"""
+        started = time.monotonic()
+        request = client.build_request("GET", url, headers=headers, timeout=request_timeout)
+        response = await client.send(request, stream=True)
+        return response, time.monotonic() - started
+
+    @staticmethod
+    async def _discard_task(task: asyncio.Task) -> None:
+        """Cancela el GET perdedor y cierra su respuesta si llegó a obtenerla"""
+        task.cancel()
+        outcome = (await asyncio.gather(task, return_exceptions=True))[0]
+        if isinstance(outcome, tuple):
+            await outcome[0].aclose()
+
+    async def _open_hedged_async(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        host: str,
+        request_timeout: httpx.Timeout,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[httpx.Response, float]:
+        """Como _open_async, con un hedge si el GET no responde dentro del p95 de TTFB del host"""
+        delay = self._hedge_delay(host)
+        if delay is None:
+            return await self._open_async(client, url, request_timeout, headers)
+
+        self.hedge_budget.record_request()
+        tasks = [asyncio.ensure_future(self._open_async(client, url, request_timeout, headers))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.hedge_budget.try_acquire():
+                self._count("hedges")
+                hedge = asyncio.ensure_future(self._open_async(client, url, request_timeout, headers))
+                hedge.add_done_callback(lambda _: self.hedge_budget.release())
+                tasks.append(hedge)
+
+            pending, errors = set(tasks), []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not tasks[0]:
+                            self._count("hedges_won")
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    await self._discard_task(task)
+
+    # ------------------------------------------------------------------
+    # Descarga por rangos en paralelo
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _raise_if_cancelled(headers, received: int) -> None:
+        """Corta la descarga si se canceló, contando los bytes que se evitan"""
+        if not cancel_requested():
+            return
+        cancellation_metrics.count("downloads_aborted")
+        content_length_str = headers.get("content-length") if headers is not None else None
+        if content_length_str and content_length_str.isdigit():
+            cancellation_metrics.count("download_bytes_avoided", max(0, int(content_length_str) - received))
+        raise Cancelled()
+
+    def _ranged_size(self, headers) -> Optional[int]:
+        """Tamaño del archivo si conviene descargarlo por rangos, o None"""
+        if self.ranged_threshold <= 0 or headers.get("content-encoding"):
+            return None
+        if headers.get("accept-ranges", "").lower() != "bytes":
+            return None
+        content_length_str = headers.get("content-length")
+        if not content_length_str or not content_length_str.isdigit():
+            return None
+        size = int(content_length_str)
+        return size if size > self.ranged_threshold else None
+
+    @staticmethod
+    def _split_ranges(size: int, parts: int) -> List[Tuple[int, int]]:
+        """Rangos (inicio, fin inclusive) de igual tamaño que cubren el archivo"""
+        part_size = -(-size // parts)
+        return [(start, min(size, start + part_size) - 1) for start in range(0, size, part_size)]
+
+    @staticmethod
+    def _check_range(status_code: int, headers, start: int, end: int, size: int) -> None:
+        """Valida que la respuesta sea exactamente el rango pedido"""
+        content_range = headers.get("content-range", "")
+        if status_code != 206 or content_range != f"bytes {start}-{end}/{size}" or headers.get("content-encoding"):
+            raise _RangeNotHonored(f"Range {start}-{end} answered with HTTP {status_code} ({content_range or 'no Content-Range'})")
+
     @staticmethod
-    def download_file(url: str, timeout: int = 30) -> Optional[bytes]:
+    def _write_range_chunk(target: RangedSpoolFile, offset: int, end: int, chunk: bytes) -> int:
+        if offset + len(chunk) > end + 1:
+            raise _RangeNotHonored(f"Range ending at {end} received past its end")
+        target.write_at(offset, chunk)
+        return offset + len(chunk)
+
+    def _ranged_fallback(self, url: str, error: BaseException) -> None:
+        print(f"⚠️ Ranged download of {url} failed ({error}), continuing with the full GET")
+        self._count("ranged_fallbacks")
+
+    def _fetch_range(
+        self, url: str, start: int, end: int, target: RangedSpoolFile, timeouts: Tuple[float, float]
+    ) -> None:
+        """Descarga los bytes start-end y los escribe en su posición de target"""
+        headers = {"Range": f"bytes={start}-{end}"}
+        with self.session.get(url, headers=headers, timeout=timeouts, stream=True) as response:
+            self._check_range(response.status_code, response.headers, start, end, target.size)
+            offset = start
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if target.aborted:
+                    return
+                offset = self._write_range_chunk(target, offset, end, chunk)
+        if offset != end + 1:
+            raise _RangeNotHonored(f"Range {start}-{end} ended at {offset}")
+
+    @staticmethod
+    def _copy_chunks(chunks, target: RangedSpoolFile, offset: int, end: int, deadline: float) -> int:
         """
-        Descarga un archivo desde una URL con un timeout adaptativo inteligente.
+        Escribe los chunks del GET original desde offset hasta alcanzar end; devuelve el offset final.
+
+        Raises:
+            _BodyTooLong: Si un chunk pasa del tamaño declarado
         """
+        for chunk in chunks:
+            DownloadService._raise_if_cancelled(None, offset)
+            if offset + len(chunk) > target.size:
+                raise _BodyTooLong(offset, chunk)
+            target.write_at(offset, chunk)
+            offset += len(chunk)
+            if time.monotonic() > deadline:
+                raise _TransferTooSlow(offset)
+            if offset >= end:
+                break
+        return offset
+
+    @staticmethod
+    def _spill_prefix(target: RangedSpoolFile, error: _BodyTooLong, writer: SpoolWriter) -> None:
+        """Pasa a writer lo recibido del GET original (y el chunk que desbordó) para seguir sin rangos"""
+        for offset in range(0, error.offset, CHUNK_SIZE):
+            writer.write(target.read_at(offset, min(CHUNK_SIZE, error.offset - offset)))
+        writer.write(error.chunk)
+
+    def _download_ranged(
+        self,
+        url: str,
+        chunks: Iterator[bytes],
+        size: int,
+        timeouts: Tuple[float, float],
+        deadline: float,
+        writer: SpoolWriter,
+    ) -> Optional[SpooledPayload]:
+        """
+        Descarga el archivo en rangos paralelos a un archivo temporal.
+
+        La primera parte se lee del GET ya abierto (chunks) y las demás se piden
+        con Range en los threads auxiliares, cada una con un cupo libre del
+        planificador: sin cupos libres no se parte. Si algún rango falla, se
+        cancelan los demás y se termina de leer el GET completo.
+
+        Returns:
+            El payload, o None si la descarga debe seguir sin rangos leyendo el
+            resto de chunks en writer (no había cupos libres, o el GET trajo más
+            bytes que su Content-Length y lo recibido ya está en writer)
+
+        Raises:
+            _TransferTooSlow: Si no termina antes de deadline
+        """
+        with self.scheduler.spare_slots(urlsplit(url).netloc, self.ranged_parts - 1) as extra:
+            if not extra:
+                return None
+            ranges = self._split_ranges(size, extra + 1)
+            self._count("ranged_downloads")
+            self._count("ranged_parts", len(ranges))
+            with RangedSpoolFile(size) as target:
+                try:
+                    return self._fetch_ranges(url, chunks, ranges, target, timeouts, deadline)
+                except _BodyTooLong as e:
+                    self._ranged_fallback(url, e)
+                    self._spill_prefix(target, e, writer)
+                    return None
+
+    def _fetch_ranges(
+        self,
+        url: str,
+        chunks: Iterator[bytes],
+        ranges: List[Tuple[int, int]],
+        target: RangedSpoolFile,
+        timeouts: Tuple[float, float],
+        deadline: float,
+    ) -> SpooledPayload:
+        """Lee la primera parte de chunks y las demás con Range (ver _download_ranged)"""
+        size = target.size
+        executor = self._get_executor()
+        token = current_token()
+        futures = [executor.submit(self._fetch_range, url, start, end, target, timeouts) for start, end in ranges[1:]]
         try:
-            # Primero, una petición HEAD para obtener el tamaño sin descargar el cuerpo.
-            head_response = requests.head(url, timeout=10, allow_redirects=True)
-            head_response.raise_for_status()
-            content_length_str = head_response.headers.get("content-length")
-
-            # Si no podemos obtener el tamaño, usamos el timeout fijo por defecto.
-            final_timeout = timeout
-
-            if content_length_str and content_length_str.isdigit():
-                content_length = int(content_length_str)
-                
-                # Lógica de timeout adaptativo: 1 segundo por cada 200KB, con un mínimo de 10s y un máximo de 120s.
-                # Esto asume una velocidad de descarga mínima razonable.
-                adaptive_timeout = max(10, min(120, content_length // 200000))
-                final_timeout = adaptive_timeout
-
-                # Verificación de tamaño máximo permitido.
-                size_mb = content_length / (1024 * 1024)
-                if size_mb > settings.MAX_FILE_SIZE_MB:
-                    print(f"❌ File too large: {size_mb:.2f}MB (max: {settings.MAX_FILE_SIZE_MB}MB)")
+            received = self._copy_chunks(chunks, target, 0, ranges[0][1] + 1, deadline)
+            if token is not None:
+                # Los rangos corren en threads auxiliares: la cancelación los aborta
+                with token.on_cancel(target.abort):
+                    done, pending = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+            else:
+                done, pending = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+            self._raise_if_cancelled(None, received)
+            if pending:
+                raise _TransferTooSlow(received)
+            errors = [future.exception() for future in done if future.exception() is not None]
+            if errors:
+                self._ranged_fallback(url, errors[0])
+                target.abort()
+                received = self._copy_chunks(chunks, target, received, size, deadline)
+                if received < size:
+                    raise requests.exceptions.ChunkedEncodingError(f"Body ended at {received} of {size} bytes")
+            return target.finish()
+        finally:
+            # Ningún rango puede seguir escribiendo una vez que el archivo se cierra
+            target.abort()
+            for future in futures:
+                future.cancel()
+            wait(futures)
+
+    async def _fetch_range_async(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        start: int,
+        end: int,
+        target: RangedSpoolFile,
+        request_timeout: httpx.Timeout,
+    ) -> None:
+        """Como _fetch_range, con httpx"""
+        request = client.build_request("GET", url, headers={"Range": f"bytes={start}-{end}"}, timeout=request_timeout)
+        response = await client.send(request, stream=True)
+        try:
+            self._check_range(response.status_code, response.headers, start, end, target.size)
+            offset = start
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                if target.aborted:
+                    return
+                offset = self._write_range_chunk(target, offset, end, chunk)
+        finally:
+            await response.aclose()
+        if offset != end + 1:
+            raise _RangeNotHonored(f"Range {start}-{end} ended at {offset}")
+
+    @staticmethod
+    async def _copy_chunks_async(chunks, target: RangedSpoolFile, offset: int, end: int, deadline: float) -> int:
+        """Como _copy_chunks, para un iterador async"""
+        async for chunk in chunks:
+            DownloadService._raise_if_cancelled(None, offset)
+            if offset + len(chunk) > target.size:
+                raise _BodyTooLong(offset, chunk)
+            target.write_at(offset, chunk)
+            offset += len(chunk)
+            if time.monotonic() > deadline:
+                raise _TransferTooSlow(offset)
+            if offset >= end:
+                break
+        return offset
+
+    async def _download_ranged_async(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        chunks: AsyncIterator[bytes],
+        size: int,
+        request_timeout: httpx.Timeout,
+        deadline: float,
+        writer: SpoolWriter,
+    ) -> Optional[SpooledPayload]:
+        """Como _download_ranged, con los rangos como tareas del event loop"""
+        with self.scheduler.spare_slots(urlsplit(url).netloc, self.ranged_parts - 1) as extra:
+            if not extra:
+                return None
+            ranges = self._split_ranges(size, extra + 1)
+            self._count("ranged_downloads")
+            self._count("ranged_parts", len(ranges))
+            with RangedSpoolFile(size) as target:
+                try:
+                    return await self._fetch_ranges_async(client, url, chunks, ranges, target, request_timeout, deadline)
+                except _BodyTooLong as e:
+                    self._ranged_fallback(url, e)
+                    self._spill_prefix(target, e, writer)
                     return None
 
-            # Ahora, la petición GET para descargar el contenido con el timeout calculado.
-            response = requests.get(url, timeout=final_timeout, stream=True)
-            response.raise_for_status()
+    async def _fetch_ranges_async(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        chunks: AsyncIterator[bytes],
+        ranges: List[Tuple[int, int]],
+        target: RangedSpoolFile,
+        request_timeout: httpx.Timeout,
+        deadline: float,
+    ) -> SpooledPayload:
+        """Como _fetch_ranges, con los rangos como tareas del event loop"""
+        size = target.size
+        tasks = [
+            asyncio.ensure_future(self._fetch_range_async(client, url, start, end, target, request_timeout))
+            for start, end in ranges[1:]
+        ]
+        try:
+            received = await self._copy_chunks_async(chunks, target, 0, ranges[0][1] + 1, deadline)
+            done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+            self._raise_if_cancelled(None, received)
+            if pending:
+                raise _TransferTooSlow(received)
+            errors = [task.exception() for task in done if task.exception() is not None]
+            if errors:
+                self._ranged_fallback(url, errors[0])
+                target.abort()
+                received = await self._copy_chunks_async(chunks, target, received, size, deadline)
+                if received < size:
+                    raise httpx.RemoteProtocolError(f"Body ended at {received} of {size} bytes")
+            return target.finish()
+        finally:
+            target.abort()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-            # Descargamos el contenido en memoria.
-            content = response.content
-            print(f"✅ Downloaded {len(content) / 1024:.1f} KB from {url} (timeout: {final_timeout}s)")
-            return content
+    # ------------------------------------------------------------------
+    # Validadores y GET condicional
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _conditional_headers(validators: Optional[Validators]) -> Optional[Dict[str, str]]:
+        """Encabezados If-None-Match / If-Modified-Since para los validadores guardados"""
+        if not validators:
+            return None
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        return headers or None
+
+    @staticmethod
+    def _validators(headers) -> Optional[Validators]:
+        """ETag y Last-Modified de una respuesta (None si no trae ninguno)"""
+        validators = {"etag": headers.get("etag"), "last_modified": headers.get("last-modified")}
+        if not any(validators.values()):
+            return None
+        return validators
+
+    def _not_modified(self, host: str, ttfb: float, headers, validators: Validators) -> SpooledPayload:
+        """Payload vacío de un 304, con los validadores vigentes"""
+        self.throughput.observe(host, ttfb, 0, 0.0)
+        payload = SpooledPayload()
+        payload.not_modified = True
+        payload.validators = self._validators(headers) or validators
+        return payload
+
+    # ------------------------------------------------------------------
+    # Descarga
+    # ------------------------------------------------------------------
+
+    def _attempt(
+        self, url: str, timeout: int, budget: Optional[ByteBudget], validators: Optional[Validators] = None
+    ) -> Tuple[Optional[SpooledPayload], bool]:
+        """
+        Un intento de descarga.
 
+        Returns:
+            (payload, False) si se descargó; (None, transitorio) si falló
+        """
+        max_bytes = settings.MAX_FILE_SIZE_MB * 1024 * 1024
+        host = urlsplit(url).netloc
+        try:
+            timeouts = self.throughput.timeouts(host, self.connect_timeout, timeout)
+            response, ttfb = self._open_hedged(url, host, timeouts, self._conditional_headers(validators))
+            with response, SpoolWriter(self.memory_threshold, budget) as writer:
+                if response.status_code == 304 and validators:
+                    return self._not_modified(host, ttfb, response.headers, validators), False
+                response.raise_for_status()
+
+                if self._declared_too_large(response.headers, max_bytes):
+                    return None, False
+
+                body_started = time.monotonic()
+                deadline = self._transfer_deadline(host, response.headers, body_started)
+                size = self._ranged_size(response.headers)
+                chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+                payload = None
+                if size is not None:
+                    try:
+                        payload = self._download_ranged(url, chunks, size, timeouts, deadline, writer)
+                    except _TransferTooSlow as e:
+                        self._reject_slow(url, e.received, deadline - body_started)
+                        return None, True
+                if payload is None:
+                    # Sin rangos: el resto del cuerpo (todo, o lo que siga tras lo ya volcado en writer)
+                    for chunk in chunks:
+                        self._raise_if_cancelled(response.headers, writer.size)
+                        writer.write(chunk)
+                        if writer.size > max_bytes:
+                            self._reject_too_large(writer.size)
+                            return None, False
+                        if deadline is not None and time.monotonic() > deadline:
+                            self._reject_slow(url, writer.size, deadline - body_started)
+                            return None, True
+                    payload = writer.finish()
+
+                self.throughput.observe(host, ttfb, payload.size, time.monotonic() - body_started)
+                payload.validators = self._validators(response.headers)
+                return payload, False
+
+        except requests.exceptions.HTTPError as e:
+            print(f"❌ Error downloading {url}: {e}")
+            status_code = e.response.status_code if e.response is not None else 0
+            self.negative_cache.add(url, status_code)
+            return None, self.retry_policy.is_retryable_status(status_code)
         except requests.exceptions.Timeout:
             print(f"❌ Timeout downloading {url}")
-            return None
+            return None, True
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            print(f"❌ Connection error downloading {url}: {e}")
+            return None, True
         except requests.exceptions.RequestException as e:
             print(f"❌ Error downloading {url}: {e}")
+            return None, False
+
+    def download(
+        self,
+        url: str,
+        timeout: int = 30,
+        budget: Optional[ByteBudget] = None,
+        validators: Optional[Validators] = None,
+    ) -> Optional[SpooledPayload]:
+        """
+        Descarga un archivo por fragmentos.
+
+        El límite MAX_FILE_SIZE_MB se comprueba con el Content-Length de la propia
+        respuesta GET y, mientras llegan los datos, con los bytes recibidos: la
+        descarga se corta en cuanto se supera. Los archivos de hasta
+        DOWNLOAD_MEMORY_THRESHOLD_MB quedan en memoria; los mayores se escriben a
+        disco mientras llegan.
+
+        Los timeouts de conexión, espera y transferencia se derivan del TTFB y el
+        ancho de banda observados en el host (ver HostThroughput): una
+        transferencia que supera su plazo se corta y cuenta como fallo transitorio.
+
+        Los fallos transitorios (5xx, timeouts, conexiones reseteadas) se reintentan
+        con backoff; los 4xx fallan de inmediato. Si la URL está en la caché
+        negativa (403/404 recientes) o el circuito del host está abierto, la
+        descarga falla sin enviar la petición.
+
+        Con validators (ETag / Last-Modified de una descarga anterior) el GET es
+        condicional: si el archivo no cambió, el servidor responde 304 sin cuerpo.
+
+        Args:
+            url: URL del archivo
+            timeout: Segundos máximos de espera de datos mientras no haya estimación del host
+            budget: Presupuesto donde reservar el contenido en memoria (si se agota, va a disco)
+            validators: {"etag", "last_modified"} de la copia que tiene el llamador
+
+        Returns:
+            SpooledPayload con el contenido y sus validadores (el llamador debe
+            cerrarlo); uno vacío con not_modified=True si respondió 304; o None si falla
+        """
+        if self.cached_failure(url) is not None:
             return None
-    
-    @staticmethod
-    def get_content_type(url: str) -> Optional[str]:
+        host = urlsplit(url).netloc
+        breaker = self.circuit_breakers.get(host)
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            if not self._allow(url, breaker):
+                return None
+            try:
+                # Cada intento ocupa un cupo del planificador global; las esperas entre reintentos no
+                with self.scheduler.slot(host):
+                    payload, transient = self._attempt(url, timeout, budget, validators)
+            except BaseException:
+                breaker.abandon()
+                raise
+            delay = self._settle(url, breaker, attempt, payload, transient)
+            if delay is None:
+                return payload
+            token = current_token()
+            if token is None:
+                time.sleep(delay)
+            elif token.wait(delay):
+                raise Cancelled()
+        return None
+
+    def download_file(self, url: str, timeout: int = 30) -> Optional[bytes]:
+        """
+        Descarga un archivo completo en memoria.
+
+        Returns:
+            Contenido del archivo o None si falla
+        """
+        payload = self.download(url, timeout=timeout)
+        if payload is None:
+            return None
+        with payload:
+            return bytes(payload.buffer())
+
+    def _declared_too_large(self, headers, max_bytes: int) -> bool:
+        """Comprueba el Content-Length de la respuesta contra el límite"""
+        content_length_str = headers.get("content-length")
+        if content_length_str and content_length_str.isdigit() and int(content_length_str) > max_bytes:
+            self._reject_too_large(int(content_length_str))
+            return True
+        return False
+
+    def _transfer_deadline(self, host: str, headers, body_started: float) -> Optional[float]:
+        """Instante límite para terminar de recibir el cuerpo (None si no hay Content-Length)"""
+        content_length_str = headers.get("content-length")
+        if not content_length_str or not content_length_str.isdigit():
+            return None
+        return body_started + self.throughput.transfer_timeout(host, int(content_length_str))
+
+    def _reject_slow(self, url: str, received: int, allowed: float) -> None:
+        print(f"❌ Transfer too slow: {received / 1024:.1f} KB in {allowed:.1f}s from {url}")
+        self._count("deadline_exceeded")
+
+    def _reject_too_large(self, size: int) -> None:
+        size_mb = size / (1024 * 1024)
+        print(f"❌ File too large: {size_mb:.2f}MB+ (max: {settings.MAX_FILE_SIZE_MB}MB)")
+        self._count("too_large")
+
+    def _completed(self, url: str, payload: SpooledPayload) -> SpooledPayload:
+        if payload.not_modified:
+            self._count("not_modified")
+            print(f"✅ Not modified: {url}")
+            return payload
+        self._count("downloads")
+        self._count("bytes_downloaded", payload.size)
+        self._count("spilled", payload.spilled)
+        print(f"✅ Downloaded {payload.size / 1024:.1f} KB from {url}{' (to disk)' if payload.spilled else ''}")
+        return payload
+
+    def cached_failure(self, url: str) -> Optional[int]:
+        """
+        Código HTTP de un fallo permanente reciente de la URL (caché negativa).
+
+        Returns:
+            403/404/410 si la URL falló hace menos de NEGATIVE_CACHE_TTL_SECONDS, o None
+        """
+        status_code = self.negative_cache.get(url)
+        if status_code is not None:
+            print(f"❌ Cached {status_code} for {url}, skipping download")
+            self._count("negative_cache_hits")
+            self._count("failed")
+        return status_code
+
+    def _allow(self, url: str, breaker: CircuitBreaker) -> bool:
+        """Consulta el circuito del host antes de un intento"""
+        if breaker.allow():
+            return True
+        print(f"❌ Circuit open for {urlsplit(url).netloc}, skipping {url}")
+        self._count("circuit_rejected")
+        self._count("failed")
+        return False
+
+    def _settle(
+        self, url: str, breaker: CircuitBreaker, attempt: int, payload: Optional[SpooledPayload], transient: bool
+    ) -> Optional[float]:
+        """
+        Registra el resultado de un intento.
+
+        Returns:
+            Segundos a esperar antes de reintentar, o None si la descarga terminó
+        """
+        if transient:
+            breaker.record_failure()
+        else:
+            # El host respondió (aunque sea con un 4xx): está sano
+            breaker.record_success()
+
+        if payload is not None:
+            self._completed(url, payload)
+            return None
+        if not transient or attempt >= self.retry_policy.max_attempts:
+            self._count("failed")
+            return None
+
+        delay = self.retry_policy.backoff(attempt)
+        self._count("retries")
+        print(f"🔁 Retrying {url} in {delay:.1f}s (attempt {attempt + 1}/{self.retry_policy.max_attempts})")
+        return delay
+
+    # ------------------------------------------------------------------
+    # Motor asyncio
+    # ------------------------------------------------------------------
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """Cliente httpx con pool de conexiones para el event loop actual"""
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            client = self._async_clients.get(loop)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                    timeout=httpx.Timeout(30, connect=self.connect_timeout),
+                    follow_redirects=True,
+                )
+                self._async_clients[loop] = client
+            return client
+
+    async def _attempt_async(
+        self, url: str, timeout: int, budget: Optional[ByteBudget], validators: Optional[Validators] = None
+    ) -> Tuple[Optional[SpooledPayload], bool]:
+        """Un intento de descarga con httpx (ver _attempt)"""
+        max_bytes = settings.MAX_FILE_SIZE_MB * 1024 * 1024
+        host = urlsplit(url).netloc
+        client = self._get_async_client()
+        try:
+            connect_timeout, read_timeout = self.throughput.timeouts(host, self.connect_timeout, timeout)
+            request_timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+            response, ttfb = await self._open_hedged_async(
+                client, url, host, request_timeout, self._conditional_headers(validators)
+            )
+            try:
+                if response.status_code == 304 and validators:
+                    return self._not_modified(host, ttfb, response.headers, validators), False
+                response.raise_for_status()
+                with SpoolWriter(self.memory_threshold, budget) as writer:
+                    if self._declared_too_large(response.headers, max_bytes):
+                        return None, False
+
+                    body_started = time.monotonic()
+                    deadline = self._transfer_deadline(host, response.headers, body_started)
+                    size = self._ranged_size(response.headers)
+                    chunks = response.aiter_bytes(CHUNK_SIZE)
+                    payload = None
+                    if size is not None:
+                        try:
+                            payload = await self._download_ranged_async(
+                                client, url, chunks, size, request_timeout, deadline, writer
+                            )
+                        except _TransferTooSlow as e:
+                            self._reject_slow(url, e.received, deadline - body_started)
+                            return None, True
+                    if payload is None:
+                        async for chunk in chunks:
+                            self._raise_if_cancelled(response.headers, writer.size)
+                            writer.write(chunk)
+                            if writer.size > max_bytes:
+                                self._reject_too_large(writer.size)
+                                return None, False
+                            if deadline is not None and time.monotonic() > deadline:
+                                self._reject_slow(url, writer.size, deadline - body_started)
+                                return None, True
+                        payload = writer.finish()
+
+                    self.throughput.observe(host, ttfb, payload.size, time.monotonic() - body_started)
+                    payload.validators = self._validators(response.headers)
+                    return payload, False
+            finally:
+                await response.aclose()
+
+        except httpx.HTTPStatusError as e:
+            print(f"❌ Error downloading {url}: {e}")
+            self.negative_cache.add(url, e.response.status_code)
+            return None, self.retry_policy.is_retryable_status(e.response.status_code)
+        except httpx.TimeoutException:
+            print(f"❌ Timeout downloading {url}")
+            return None, True
+        except httpx.TransportError as e:
+            print(f"❌ Connection error downloading {url}: {e}")
+            return None, True
+        except httpx.HTTPError as e:
+            print(f"❌ Error downloading {url}: {e}")
+            return None, False
+
+    async def download_async(
+        self,
+        url: str,
+        timeout: int = 30,
+        budget: Optional[ByteBudget] = None,
+        validators: Optional[Validators] = None,
+    ) -> Optional[SpooledPayload]:
+        """
+        Igual que download(), sin bloquear el event loop.
+
+        Args:
+            url: URL del archivo
+            timeout: Segundos máximos de espera de datos mientras no haya estimación del host
+            budget: Presupuesto donde reservar el contenido en memoria (si se agota, va a disco)
+            validators: {"etag", "last_modified"} de la copia que tiene el llamador
+
+        Returns:
+            SpooledPayload con el contenido (el llamador debe cerrarlo), uno vacío
+            con not_modified=True si respondió 304, o None si falla
+        """
+        if self.cached_failure(url) is not None:
+            return None
+        host = urlsplit(url).netloc
+        breaker = self.circuit_breakers.get(host)
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            if not self._allow(url, breaker):
+                return None
+            try:
+                async with self.scheduler.slot_async(host):
+                    payload, transient = await self._attempt_async(url, timeout, budget, validators)
+            except BaseException:
+                breaker.abandon()
+                raise
+            if payload is not None and not payload.not_modified:
+                self._count("async_downloads")
+            delay = self._settle(url, breaker, attempt, payload, transient)
+            if delay is None:
+                return payload
+            await asyncio.sleep(delay)
+            if cancel_requested():
+                raise Cancelled()
+        return None
+
+    async def aclose(self) -> None:
+        """
+        Cierra el cliente async del event loop actual.
+
+        Cada pipeline async lo llama al terminar: los threads auxiliares siguen
+        vivos porque los comparten los hedges y rangos de otras descargas
+        (se detienen con shutdown() al cerrar la aplicación).
+        """
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            client = self._async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def shutdown(self) -> None:
+        """Detiene los threads auxiliares (hedges y rangos); solo al cerrar la aplicación"""
+        with self._async_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_content_type(self, url: str) -> Optional[str]:
         """
         Obtiene el Content-Type de una URL sin descargar el archivo completo
-        
+
         Args:
             url: URL del archivo
-        
+
         Returns:
             Content-Type o None
         """
         try:
-            response = requests.head(url, timeout=10)
+            response = self.session.head(url, timeout=(self.connect_timeout, 10))
             return response.headers.get('content-type')
         except:
             return None
 
+    def content_length(self, url: str, timeout: float = 5) -> Optional[int]:
+        """
+        Tamaño declarado de una URL (Content-Length de un HEAD), sin descargarla.
+
+        El HEAD solo usa un cupo libre del planificador global (spare_slots): si
+        hay descargas esperando, no se envía y el tamaño queda sin estimar.
+
+        Returns:
+            Tamaño en bytes, o None si no hay cupo libre, el servidor no lo
+            informa o la petición falla
+        """
+        if self.cached_failure(url) is not None:
+            return None
+        with self.scheduler.spare_slots(urlsplit(url).netloc, 1) as free:
+            if not free:
+                return None
+            self._count("size_probes")
+            try:
+                response = self.session.head(
+                    url, timeout=(min(self.connect_timeout, timeout), timeout), allow_redirects=True
+                )
+            except requests.RequestException:
+                return None
+        content_length_str = response.headers.get("content-length")
+        if response.ok and content_length_str and content_length_str.isdigit():
+            return int(content_length_str)
+        return None
+
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        """Uso del pool de conexiones por host"""
+        hosts = {}
+        for adapter in {id(a): a for a in self.session.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{pool.scheme}://{pool.host}:{pool.port}"
+                # num_connections son las conexiones abiertas; el resto de peticiones reutilizó una
+                hosts[host] = {
+                    "requests": pool.num_requests,
+                    "connections_opened": pool.num_connections,
+                    "connections_reused": max(0, pool.num_requests - pool.num_connections),
+                    "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn is not None),
+                    "max_size": pool.pool.maxsize,
+                }
+        return hosts
+
+    def stats(self) -> Dict[str, Any]:
+        """Métricas de descargas y del pool de conexiones"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["pool_size"] = self.pool_size
+        stats["hosts"] = self.pool_stats()
+        with self._async_lock:
+            clients = [c for c in self._async_clients.values() if not c.is_closed]
+        stats["async_clients"] = len(clients)
+        stats["retry_policy"] = self.retry_policy.stats()
+        stats["circuit_breakers"] = self.circuit_breakers.stats()
+        stats["negative_cache"] = self.negative_cache.stats()
+        stats["host_estimates"] = self.throughput.stats()
+        stats["hedging"] = self.hedging
+        stats["hedge_budget"] = self.hedge_budget.stats()
+        stats["ranged_threshold_mb"] = self.ranged_threshold // (1024 * 1024)
+        stats["ranged_parts_per_file"] = self.ranged_parts
+        stats["scheduler"] = self.scheduler.stats()
+        return stats
+
 download_service = DownloadService()
@@ -7,10 +7,38 @@ from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from typing import Optional
+from backend.core.config import settings
+from backend.utils.content_sniffer import ContentInfo, sniff_content
+
+# Límite de píxeles alineado con el de la aplicación: Pillow rechaza las bombas de descompresión
+Image.MAX_IMAGE_PIXELS = settings.MAX_IMAGE_PIXELS
 
 # Constantes para detectar extensiones de Office
 WORD_EXTENSIONS = {".doc", ".docx"}
 PASSTHROUGH_EXTENSIONS = {".xlsx", ".pptx"}
+# Extensiones de imagen que se convierten a PDF (formatos que Pillow decodifica)
+IMAGE_EXTENSIONS = {".jpg", ".png", ".webp", ".tiff"}
+
+# Dimensiones de un A4 a 300 DPI: 2480x3508 píxeles.
+A4_MAX_WIDTH = 2480
+A4_MAX_HEIGHT = 3508
+
+# Componentes de color de JPEG que se pueden incrustar tal cual en el PDF (DCTDecode)
+JPEG_PASSTHROUGH_COLORSPACES = {1: "/DeviceGray", 3: "/DeviceRGB"}
+# SOF que los lectores de PDF decodifican con DCTDecode: baseline, extendido y progresivo con Huffman.
+# Los lossless (SOF3) y los de codificación aritmética (SOF9-11) se recodifican.
+JPEG_PASSTHROUGH_SOF_MARKERS = {0xC0, 0xC1, 0xC2}
+
+# Transposición que deja derecha una imagen según su orientación EXIF (1 = ya está derecha)
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
 
 class PDFService:
     """Servicio para conversión de archivos a PDF"""
@@ -18,59 +46,36 @@ class PDFService:
     @staticmethod
     def is_pdf(content: bytes) -> bool:
         """Verifica si el contenido es un PDF"""
-        return content.startswith(b'%PDF')
+        return sniff_content(content).kind == "pdf"
     
     @staticmethod
     def is_image(content: bytes) -> bool:
-        """Verifica si el contenido es una imagen"""
-        try:
-            Image.open(io.BytesIO(content))
-            return True
-        except:
-            return False
+        """Verifica si el contenido es una imagen (por cabecera, sin decodificarla)"""
+        return sniff_content(content).is_image
     
     @staticmethod
     def get_file_extension_from_content(content: bytes) -> str:
         """Detecta la extensión del archivo por sus magic bytes para mayor fiabilidad."""
-        if content.startswith(b'%PDF'):
-            return '.pdf'
-        
-        # Formatos de Office basados en ZIP (OOXML)
-        if content.startswith(b'PK\x03\x04'):
-            # El contenido de los archivos OOXML es un ZIP. Buscamos directorios específicos.
-            if b'word/' in content[:2000]:
-                return '.docx'
-            if b'xl/' in content[:2000]:
-                return '.xlsx'
-            if b'ppt/' in content[:2000]:
-                return '.pptx'
-        
-        # Formatos de Office antiguos (OLE CF)
-        if content.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
-            # Estos son más difíciles de diferenciar, pero podemos buscar strings comunes.
-            if b'WordDocument' in content[:2000]:
-                return '.doc'
-            # Nota: .xls y .ppt antiguos son más ambiguos y los omitimos por ahora para seguridad.
-
-        # Formatos de imagen
-        try:
-            with Image.open(io.BytesIO(content)) as img:
-                if img.format and img.format.lower() in ['jpeg', 'jpg']:
-                    return '.jpg'
-                if img.format and img.format.lower() == 'png':
-                    return '.png'
-        except IOError:
-            pass # No es una imagen que PIL pueda abrir
-
-        return '' # Extensión desconocida
+        return sniff_content(content).extension
+    
+    @staticmethod
+    def _check_pixel_limit(width: int, height: int) -> None:
+        """Rechaza imágenes con más píxeles que MAX_IMAGE_PIXELS, antes de decodificarlas."""
+        if width * height > settings.MAX_IMAGE_PIXELS:
+            raise ValueError(
+                f"Image too large: {width}x{height} ({width * height} pixels, max: {settings.MAX_IMAGE_PIXELS})"
+            )
     
     @staticmethod
     def _optimize_image_for_pdf(image: Image.Image) -> Image.Image:
-        """Reduce el tamaño de la imagen si excede las dimensiones de un A4 a 300 DPI."""
-        # Dimensiones de un A4 a 300 DPI: 2480x3508 píxeles.
-        A4_MAX_WIDTH = 2480
-        A4_MAX_HEIGHT = 3508
+        """
+        Reduce el tamaño de la imagen si excede las dimensiones de un A4 a 300 DPI.
         
+        Para JPEG se usa primero el modo draft de Pillow: el decodificador reduce la
+        imagen por la mayor potencia de dos (1/2, 1/4, 1/8) que la deja aún igual o
+        mayor que el tamaño objetivo, y luego LANCZOS hace el ajuste final. Así una
+        foto de 4000x3000 nunca se decodifica completa.
+        """
         width, height = image.size
 
         if width > A4_MAX_WIDTH or height > A4_MAX_HEIGHT:
@@ -79,54 +84,176 @@ class PDFService:
             new_width = int(width * ratio)
             new_height = int(height * ratio)
             
-            print(f"🔧 Optimizing image from {width}x{height} to {new_width}x{new_height}")
+            # Reducción en la decodificación (solo JPEG; debe hacerse antes de cargar la imagen).
+            if image.format == "JPEG":
+                image.draft(None, (new_width, new_height))
+            
+            print(f"🔧 Optimizing image from {width}x{height} (decoded at {image.size[0]}x{image.size[1]}) to {new_width}x{new_height}")
             # Usamos LANCZOS que es el filtro de redimensionado de más alta calidad.
             return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
         
         return image # No necesita optimización.
     
     @staticmethod
-    def image_to_pdf(image_bytes: bytes) -> Optional[bytes]:
-        """Convierte una imagen a PDF, optimizándola primero si es necesario."""
+    def _a4_placement(img_width: int, img_height: int) -> tuple:
+        """Calcula (x, y, ancho, alto) para centrar la imagen escalada en un A4"""
+        a4_width, a4_height = A4
+        scale = min(a4_width / img_width, a4_height / img_height)
+        new_width = img_width * scale
+        new_height = img_height * scale
+        x = (a4_width - new_width) / 2
+        y = (a4_height - new_height) / 2
+        return x, y, new_width, new_height
+    
+    @staticmethod
+    def can_embed_jpeg(info: ContentInfo) -> bool:
+        """
+        True si el JPEG puede incrustarse sin recodificar: no requiere resize, su color es
+        compatible, es un JPEG Huffman de 8 bits (SOF0/1/2) y no tiene orientación EXIF que aplicar.
+        """
+        return (
+            info.kind == "jpeg"
+            and info.sof_marker in JPEG_PASSTHROUGH_SOF_MARKERS
+            and info.precision == 8
+            and info.orientation in (None, 1)
+            and info.components in JPEG_PASSTHROUGH_COLORSPACES
+            and info.width is not None
+            and 0 < info.width <= A4_MAX_WIDTH
+            and 0 < info.height <= A4_MAX_HEIGHT
+        )
+    
+    @staticmethod
+    def _jpeg_to_pdf(jpeg_bytes: bytes, width: int, height: int, components: int) -> bytes:
+        """
+        Genera un PDF A4 que incrusta el stream JPEG original (DCTDecode), sin decodificarlo.
+        
+        El resultado visual es el mismo que el de la ruta con reportlab: la imagen
+        escalada para caber en la página y centrada.
+        """
+        x, y, draw_width, draw_height = PDFService._a4_placement(width, height)
+        a4_width, a4_height = A4
+        content_stream = f"q\n{draw_width:.4f} 0 0 {draw_height:.4f} {x:.4f} {y:.4f} cm\n/Im0 Do\nQ\n".encode("ascii")
+        
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+            (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {a4_width:.4f} {a4_height:.4f}] "
+                f"/Resources << /XObject << /Im0 4 0 R >> /ProcSet [/PDF /ImageB /ImageC] >> "
+                f"/Contents 5 0 R >>"
+            ).encode("ascii"),
+            [
+                (
+                    f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                    f"/ColorSpace {JPEG_PASSTHROUGH_COLORSPACES[components]} /BitsPerComponent 8 "
+                    f"/Filter /DCTDecode /Length {len(jpeg_bytes)} >>\nstream\n"
+                ).encode("ascii"),
+                jpeg_bytes,
+                b"\nendstream",
+            ],
+            [f"<< /Length {len(content_stream)} >>\nstream\n".encode("ascii"), content_stream, b"endstream"],
+        ]
+        
+        parts = [b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"]
+        position = len(parts[0])
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(position)
+            chunks = [f"{number} 0 obj\n".encode("ascii")]
+            chunks.extend(body if isinstance(body, list) else [body])
+            chunks.append(b"\nendobj\n")
+            parts.extend(chunks)
+            position += sum(len(c) for c in chunks)
+        
+        xref = [f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")]
+        xref.extend(f"{offset:010d} 00000 n \n".encode("ascii") for offset in offsets)
+        xref.append(
+            f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{position}\n%%EOF\n".encode("ascii")
+        )
+        parts.extend(xref)
+        return b"".join(parts)
+    
+    @staticmethod
+    def _render_image_to_pdf(image: Image.Image) -> bytes:
+        """Ruta general: optimiza, endereza según EXIF, recodifica como PNG y dibuja con reportlab."""
+        # La orientación se lee antes de redimensionar: la imagen resultante ya no trae EXIF.
+        transpose = EXIF_ORIENTATION_TRANSPOSE.get(image.getexif().get(0x0112))
+
+        # --- INICIO DE LA OPTIMIZACIÓN ---
+        # 1. Optimizar la imagen antes de hacer cualquier otra cosa.
+        image = PDFService._optimize_image_for_pdf(image)
+        # --- FIN DE LA OPTIMIZACIÓN ---
+
+        if transpose is not None:
+            image = image.transpose(transpose)
+
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        pdf_buffer = io.BytesIO()
+        x, y, new_width, new_height = PDFService._a4_placement(*image.size)
+
+        c = canvas.Canvas(pdf_buffer, pagesize=A4)
+
+        # Usamos un buffer en memoria para pasar la imagen a reportlab.
+        with io.BytesIO() as temp_img_buffer:
+            image.save(temp_img_buffer, format="PNG")
+            temp_img_buffer.seek(0)
+            # Usar ImageReader para que reportlab acepte BytesIO
+            img_reader = ImageReader(temp_img_buffer)
+            c.drawImage(img_reader, x, y, width=new_width, height=new_height)
+        
+        c.save()
+        pdf_buffer.seek(0)
+        return pdf_buffer.read()
+    
+    @staticmethod
+    def image_to_pdf(image_bytes: bytes, info: Optional[ContentInfo] = None) -> Optional[bytes]:
+        """
+        Convierte una imagen a PDF, optimizándola primero si es necesario.
+        
+        Los JPEG que no requieren resize se incrustan tal cual (DCTDecode), sin
+        decodificar ni recodificar: es mucho más rápido y el PDF pesa casi lo mismo
+        que la foto original.
+        
+        Args:
+            image_bytes: Contenido de la imagen
+            info: Resultado de sniff_content si ya se calculó
+        """
         try:
-            image = Image.open(io.BytesIO(image_bytes))
+            info = info or sniff_content(image_bytes)
+            if info.pixels is not None:
+                PDFService._check_pixel_limit(info.width, info.height)
 
-            # --- INICIO DE LA OPTIMIZACIÓN ---
-            # 1. Optimizar la imagen antes de hacer cualquier otra cosa.
-            image = PDFService._optimize_image_for_pdf(image)
-            # --- FIN DE LA OPTIMIZACIÓN ---
-
-            if image.mode != "RGB":
-                image = image.convert("RGB")
-
-            pdf_buffer = io.BytesIO()
-            img_width, img_height = image.size
-            a4_width, a4_height = A4
-
-            scale = min(a4_width / img_width, a4_height / img_height)
-            new_width = img_width * scale
-            new_height = img_height * scale
-
-            c = canvas.Canvas(pdf_buffer, pagesize=A4)
-            x = (a4_width - new_width) / 2
-            y = (a4_height - new_height) / 2
-
-            # Usamos un buffer en memoria para pasar la imagen a reportlab.
-            with io.BytesIO() as temp_img_buffer:
-                image.save(temp_img_buffer, format="PNG")
-                temp_img_buffer.seek(0)
-                # Usar ImageReader para que reportlab acepte BytesIO
-                img_reader = ImageReader(temp_img_buffer)
-                c.drawImage(img_reader, x, y, width=new_width, height=new_height)
-            
-            c.save()
-            pdf_buffer.seek(0)
-            return pdf_buffer.read()
+            if PDFService.can_embed_jpeg(info):
+                return PDFService._jpeg_to_pdf(bytes(image_bytes), info.width, info.height, info.components)
+
+            image = Image.open(io.BytesIO(image_bytes))
+            PDFService._check_pixel_limit(*image.size)
+            return PDFService._render_image_to_pdf(image)
 
         except Exception as e:
             print(f"❌ Error converting image to PDF: {e}")
             return None
     
+    @staticmethod
+    def resolve_extension(content: bytes, original_filename: str = None, info: Optional[ContentInfo] = None) -> str:
+        """
+        Determina la extensión efectiva del archivo.
+
+        Primero por el contenido (magic bytes) y, si no se detecta, por el nombre original.
+        """
+        # Primero, intentamos detectar la extensión por el contenido (magic bytes).
+        ext = (info or sniff_content(content)).extension
+
+        # Si no se detecta, usamos el nombre del archivo como segunda opción.
+        if not ext and original_filename:
+            file_parts = original_filename.lower().split(".")
+            if len(file_parts) > 1:
+                ext = f".{file_parts[-1]}"
+
+        return ext
+    
     @staticmethod
     def convert_to_pdf(content: bytes, original_filename: str = None) -> Optional[dict]:
         """
@@ -139,14 +266,9 @@ class PDFService:
         Returns:
             Un diccionario con {"mode", "content", "extension"} o None si falla.
         """
-        # Primero, intentamos detectar la extensión por el contenido (magic bytes).
-        ext = PDFService.get_file_extension_from_content(content)
-
-        # Si no se detecta, usamos el nombre del archivo como segunda opción.
-        if not ext and original_filename:
-            file_parts = original_filename.lower().split(".")
-            if len(file_parts) > 1:
-                ext = f".{file_parts[-1]}"
+        # Una sola lectura de cabeceras alcanza para todas las decisiones.
+        info = sniff_content(content)
+        ext = PDFService.resolve_extension(content, original_filename, info)
 
         # --- Lógica de decisión ---
 
@@ -163,8 +285,8 @@ class PDFService:
             return {"mode": "passthrough", "content": content, "extension": ext}
 
         # 4. Si es una imagen, la convertimos a PDF.
-        if ext in [".jpg", ".png"]:
-            pdf_content = PDFService.image_to_pdf(content)
+        if ext in IMAGE_EXTENSIONS:
+            pdf_content = PDFService.image_to_pdf(content, info)
             if pdf_content:
                 return {"mode": "pdf", "content": pdf_content, "extension": ".pdf"}
 
@@ -5,6 +5,7 @@ import psycopg2
 from psycopg2 import pool
 from typing import List, Dict, Any, Optional
 from backend.core.config import settings
+from backend.core.singleflight import SingleFlight
 
 class RedshiftService:
     """Servicio para consultas read-only a Redshift"""
@@ -12,6 +13,8 @@ class RedshiftService:
     def __init__(self):
         """Inicializa el connection pool"""
         self.connection_pool = None
+        # Consultas idénticas concurrentes (mismo SQL y parámetros) se ejecutan una vez
+        self.query_flight = SingleFlight("redshift")
         self._initialize_pool()
     
     def _initialize_pool(self):
@@ -41,7 +44,20 @@ class RedshiftService:
             self.connection_pool = None
     
     def execute_query(self, query: str, params: Optional[tuple] = None) -> List[Dict[str, Any]]:
-        """Ejecuta una query SELECT y retorna resultados como lista de diccionarios"""
+        """
+        Ejecuta una query SELECT y retorna resultados como lista de diccionarios.
+
+        Si la misma query con los mismos parámetros ya está en curso, espera su
+        resultado en lugar de ejecutarla otra vez (cada llamador recibe su copia).
+        """
+        return self.query_flight.do(
+            (query, repr(params)),
+            lambda: self._execute_query(query, params),
+            share=lambda rows: [dict(row) for row in rows],
+        )
+
+    def _execute_query(self, query: str, params: Optional[tuple] = None) -> List[Dict[str, Any]]:
+        """Ejecuta la query en una conexión del pool"""
         if not self.connection_pool:
             raise RuntimeError("Redshift connection not available. Please configure REDSHIFT_* environment variables.")
         
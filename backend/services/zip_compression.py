@@ -0,0 +1,144 @@
+"""
+Política de compresión por entrada del ZIP
+
+Casi todas las entradas son PDFs (muchos con imágenes JPEG) ya comprimidos:
+deflate gastaba CPU en cada una para reducir alrededor de un 1%. La política
+decide método y nivel por entrada:
+
+- Formatos ya comprimidos (JPEG, PNG, WEBP, HEIC, ZIP/OOXML): STORED sin medir.
+- El resto: se comprime una muestra de ZIP_COMPRESSION_SAMPLE_KB (inicio, medio
+  y final de la entrada) con el nivel más rápido. Si ahorra menos de
+  ZIP_COMPRESSION_MIN_SAVINGS, STORED. Si ahorra al menos HIGH_SAVINGS (texto,
+  PDFs con streams sin comprimir), ZIP_COMPRESSION_LEVEL. En medio, FAST_LEVEL:
+  casi el mismo ahorro por una fracción de la CPU.
+
+ZIP_COMPRESSION elige el modo: auto (la política), deflate (todo con
+ZIP_COMPRESSION_LEVEL, como antes) o store (nada comprimido).
+
+Cada ZIP lleva su CompressionReport (ver zip_stream) con los bytes ahorrados y
+la CPU gastada en muestrear y comprimir; compression_policy acumula el total
+para /api/metrics. choose() es thread-safe: los workers de conversión deciden y
+comprimen cada documento en paralelo.
+"""
+import logging
+import threading
+import time
+import zlib
+from typing import Optional, Dict, Any, Tuple
+
+from backend.core.config import settings
+from backend.utils.content_sniffer import sniff_content
+from backend.utils.zip_stream import BytesLike, CompressionReport, ZIP_DEFLATED, ZIP_STORED
+
+logger = logging.getLogger(__name__)
+
+MODES = ("auto", "deflate", "store")
+
+# Tipos que ya vienen comprimidos: deflate no los reduce
+COMPRESSED_KINDS = {"jpeg", "png", "webp", "heic", "zip", "docx", "xlsx", "pptx"}
+
+# Ahorro de la muestra a partir del cual compensa el nivel configurado
+HIGH_SAVINGS = 0.2
+
+# Nivel para entradas que ahorran poco
+FAST_LEVEL = 1
+
+
+class CompressionPolicy:
+    """
+    Elige STORED o DEFLATED (y el nivel) para cada entrada.
+
+    Args:
+        mode: "auto", "deflate" o "store"
+        level: Nivel de deflate para las entradas muy comprimibles (y en modo deflate)
+        sample_bytes: Bytes de la muestra que se comprime para medir
+        min_savings: Fracción mínima que debe ahorrar la muestra para comprimir
+    """
+
+    def __init__(self, mode: str, level: int, sample_bytes: int, min_savings: float):
+        if mode not in MODES:
+            logger.warning(f"[ZIP] Unknown ZIP_COMPRESSION '{mode}', using 'auto'")
+            mode = "auto"
+        self.mode = mode
+        self.level = min(9, max(1, level))
+        self.sample_bytes = max(1024, sample_bytes)
+        self.min_savings = min_savings
+        self._lock = threading.Lock()
+        self._totals = CompressionReport()
+        self._jobs = 0
+
+    def _sample_savings(self, view: memoryview) -> float:
+        """Fracción que ahorra deflate (nivel rápido) sobre una muestra de la entrada"""
+        size = len(view)
+        if size <= self.sample_bytes:
+            parts = [view]
+        else:
+            part = self.sample_bytes // 3
+            middle = (size - part) // 2
+            parts = [view[:part], view[middle:middle + part], view[size - part:]]
+        compressor = zlib.compressobj(FAST_LEVEL, zlib.DEFLATED, -15)
+        sampled = compressed = 0
+        for part in parts:
+            sampled += len(part)
+            compressed += len(compressor.compress(part))
+        compressed += len(compressor.flush())
+        return 1 - compressed / sampled
+
+    def choose(self, data: BytesLike, report: Optional[CompressionReport] = None) -> Tuple[int, int]:
+        """
+        Método y nivel para una entrada.
+
+        Args:
+            data: Contenido de la entrada
+            report: Reporte del ZIP donde sumar la CPU gastada en la muestra
+
+        Returns:
+            (ZIP_STORED o ZIP_DEFLATED, nivel de deflate)
+        """
+        if self.mode == "store":
+            return ZIP_STORED, 0
+        if self.mode == "deflate":
+            return ZIP_DEFLATED, self.level
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast("B")
+        if not len(view):
+            return ZIP_STORED, 0
+
+        started = time.thread_time()
+        try:
+            if sniff_content(view).kind in COMPRESSED_KINDS:
+                return ZIP_STORED, 0
+            savings = self._sample_savings(view)
+        finally:
+            if report is not None:
+                report.add_sample_time(time.thread_time() - started)
+        if savings < self.min_savings:
+            return ZIP_STORED, 0
+        return ZIP_DEFLATED, self.level if savings >= HIGH_SAVINGS else FAST_LEVEL
+
+    def record(self, report: CompressionReport) -> None:
+        """Suma el reporte de un ZIP terminado a los totales"""
+        with self._lock:
+            self._totals.merge(report)
+            self._jobs += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = self._totals.as_dict()
+            stats["zips"] = self._jobs
+        stats.update({
+            "mode": self.mode,
+            "level": self.level,
+            "sample_bytes": self.sample_bytes,
+            "min_savings": self.min_savings,
+        })
+        return stats
+
+
+compression_policy = CompressionPolicy(
+    mode=settings.ZIP_COMPRESSION,
+    level=settings.ZIP_COMPRESSION_LEVEL,
+    sample_bytes=settings.ZIP_COMPRESSION_SAMPLE_KB * 1024,
+    min_savings=settings.ZIP_COMPRESSION_MIN_SAVINGS,
+)
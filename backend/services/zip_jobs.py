@@ -0,0 +1,457 @@
+"""
+Trabajos de ZIP en segundo plano con estado persistente
+
+Un ZIP de proyecto grande tarda minutos en generarse; dentro de la petición HTTP,
+un timeout del proxy o un refresh del navegador descartaban todo el trabajo. Un
+trabajo se crea con POST, se genera en un thread del servidor (ZipService) y
+queda como archivo en disco; el cliente consulta el avance y descarga el
+resultado cuando está listo.
+
+El estado vive en SQLite (ZIP_JOBS_DIR/jobs.sqlite3) y sobrevive a reinicios:
+los ZIPs terminados siguen disponibles y los trabajos interrumpidos vuelven a la
+cola al arrancar. Los trabajos terminados se eliminan (estado y archivo) tras
+ZIP_JOB_RETENTION_HOURS.
+
+Un trabajo de proyecto (por filtros, sin códigos de proforma) usa la caché de
+ZIPs como /download/zip/project: si el ZIP ya está guardado o se está generando
+para otra petición con los mismos filtros y documentos, se copia de ahí en vez
+de reconstruirlo, y el que genera el trabajo queda guardado para los siguientes.
+
+Cada trabajo en curso tiene su CancelToken: detener el servidor o cancelar el
+trabajo corta también la descarga o conversión en curso (ver ZipPipeline),
+sin esperar a que se escriba la próxima entrada.
+"""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List
+
+from backend.core.cancellation import CancelToken, Cancelled
+from backend.core.config import settings
+from backend.services.archive_cache import archive_cache
+from backend.services.redshift_service import redshift_service
+from backend.services.zip_service import zip_service
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Error de un trabajo cancelado con cancel()
+CANCELLED_ERROR = "Cancelled"
+
+# Intervalo mínimo entre escrituras del avance en SQLite
+PROGRESS_FLUSH_SECONDS = 1.0
+
+# Límite de documentos de /download/zip (interactiva)
+DOCUMENTS_LIMIT = 1000
+
+# Límite de documentos de un ZIP de proyecto (el mismo de /download/zip/project)
+PROJECT_DOCUMENTS_LIMIT = 100000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS zip_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    request TEXT NOT NULL,
+    project_code TEXT,
+    total INTEGER NOT NULL DEFAULT 0,
+    processed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    compression TEXT
+)
+"""
+
+# Columnas agregadas después de la primera versión de la tabla
+_ADDED_COLUMNS = {"compression": "TEXT"}
+
+
+def default_jobs_dir() -> str:
+    return settings.ZIP_JOBS_DIR or os.path.join(tempfile.gettempdir(), "tale_zip_jobs")
+
+
+def _document_types(filters: Dict[str, Any]) -> Optional[List[str]]:
+    """document_type (uno) y document_types (varios, como en /download/zip/project)"""
+    types = list(filters.get("document_types") or [])
+    if filters.get("document_type") and filters["document_type"] not in types:
+        types.append(filters["document_type"])
+    return types or None
+
+
+def _check_filters(filters: Dict[str, Any]) -> None:
+    if not filters.get("document_ids") and not (
+        _document_types(filters) or any(filters.get(name) for name in ("project_code", "start_date", "end_date"))
+    ):
+        raise ValueError("At least one filter is required")
+
+
+def load_documents(filters: Dict[str, Any], limit: int = DOCUMENTS_LIMIT, strict: bool = False) -> List[Dict[str, Any]]:
+    """
+    Documentos de un DownloadZipRequest: por códigos de proforma o por filtros.
+
+    Args:
+        filters: Campos del DownloadZipRequest
+        limit: Máximo de documentos por filtros
+        strict: Si es True, superar limit es un error en vez de recortar el resultado
+
+    Raises:
+        ValueError: Si no se indica ningún código ni filtro, o (strict) si hay más de limit documentos
+    """
+    _check_filters(filters)
+    if filters.get("document_ids"):
+        documents = [redshift_service.get_document_by_codigo(doc_id) for doc_id in filters["document_ids"]]
+        return [doc for doc in documents if doc is not None]
+    documents = redshift_service.get_documents(
+        project_code=filters.get("project_code"),
+        document_types=_document_types(filters),
+        start_date=filters.get("start_date"),
+        end_date=filters.get("end_date"),
+        limit=limit + 1 if strict else limit,
+    )
+    if strict and len(documents) > limit:
+        raise ValueError(f"More than {limit} documents match the filters; narrow them (document types or dates)")
+    return documents
+
+
+class JobStore:
+    """
+    Estado de los trabajos en SQLite (una conexión compartida, con lock).
+
+    Args:
+        path: Archivo de la base de datos
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(zip_jobs)")}
+        for name, definition in _ADDED_COLUMNS.items():
+            if name not in existing:
+                self._conn.execute(f"ALTER TABLE zip_jobs ADD COLUMN {name} {definition}")
+
+    def create(self, job_id: str, filters: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO zip_jobs (id, status, request, project_code, created) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(filters), filters.get("project_code"), time.time()),
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM zip_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE zip_jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def transition(self, job_id: str, current: str, **fields: Any) -> bool:
+        """Actualiza el trabajo solo si su estado es current; False si no lo era"""
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE zip_jobs SET {columns} WHERE id = ? AND status = ?", (*fields.values(), job_id, current)
+            )
+        return cursor.rowcount == 1
+
+    def requeue_interrupted(self) -> List[str]:
+        """Vuelve a la cola los trabajos que quedaron a medias (p. ej. por un reinicio)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM zip_jobs WHERE status IN (?, ?) ORDER BY created", (QUEUED, RUNNING)
+            ).fetchall()
+            self._conn.execute(
+                "UPDATE zip_jobs SET status = ?, processed = 0, failed = 0, bytes = 0, started = NULL WHERE status = ?",
+                (QUEUED, RUNNING),
+            )
+        return [row["id"] for row in rows]
+
+    def finished_before(self, timestamp: float) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM zip_jobs WHERE status IN (?, ?) AND finished < ?", (COMPLETED, FAILED, timestamp)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def delete(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM zip_jobs WHERE id = ?", (job_id,))
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM zip_jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class _Stopped(Exception):
+    """El servidor se detiene: el trabajo vuelve a la cola en el próximo arranque"""
+
+
+class ZipJobManager:
+    """
+    Cola de trabajos de ZIP ejecutados por un pool de threads.
+
+    Args:
+        directory: Directorio con la base de datos y los ZIPs generados
+        workers: Trabajos que se generan a la vez
+        retention_seconds: Tiempo que se conserva un trabajo terminado
+    """
+
+    def __init__(self, directory: str, workers: int, retention_seconds: float):
+        self.directory = directory
+        self.workers = max(1, workers)
+        self.retention_seconds = retention_seconds
+        self._store: Optional[JobStore] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        # id -> avance del trabajo en curso (se escribe en SQLite cada PROGRESS_FLUSH_SECONDS)
+        self._live: Dict[str, Dict[str, Any]] = {}
+        # id -> token de cancelación del trabajo en curso
+        self._tokens: Dict[str, CancelToken] = {}
+        self._tokens_lock = threading.Lock()
+
+    def _artifact_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.zip")
+
+    def _ensure_started(self) -> JobStore:
+        """Abre la base de datos y el pool en el primer uso; reanuda lo interrumpido"""
+        with self._lock:
+            if self._store is not None:
+                return self._store
+            os.makedirs(self.directory, exist_ok=True)
+            for name in os.listdir(self.directory):
+                if name.endswith(".part"):
+                    os.unlink(os.path.join(self.directory, name))
+            self._store = JobStore(os.path.join(self.directory, "jobs.sqlite3"))
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="zip-job")
+            interrupted = self._store.requeue_interrupted()
+        for job_id in interrupted:
+            self._executor.submit(self._run, job_id)
+        if interrupted:
+            logger.info(f"[JOBS] Resumed {len(interrupted)} interrupted ZIP jobs")
+        self._purge_expired()
+        return self._store
+
+    def start(self) -> None:
+        """Reanuda los trabajos interrumpidos (al arrancar el servidor)"""
+        self._ensure_started()
+
+    def submit(self, filters: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Crea un trabajo con los filtros de un DownloadZipRequest.
+
+        Raises:
+            ValueError: Si no se indica ningún código ni filtro
+        """
+        _check_filters(filters)
+        store = self._ensure_started()
+        job_id = uuid.uuid4().hex
+        store.create(job_id, filters)
+        self._executor.submit(self._run, job_id)
+        logger.info(f"[JOBS] Queued ZIP job {job_id} ({filters.get('project_code') or 'documents'})")
+        return self.status(job_id)
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Estado del trabajo con su avance y el tiempo estimado restante, o None"""
+        job = self._ensure_started().get(job_id)
+        if job is None:
+            return None
+        job.update(self._live.get(job_id, {}))
+        eta = None
+        if job["status"] == RUNNING and job["started"] and job["processed"]:
+            elapsed = time.time() - job["started"]
+            eta = elapsed / job["processed"] * max(0, job["total"] - job["processed"])
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "project_code": job["project_code"],
+            "total_documents": job["total"],
+            "processed_documents": job["processed"],
+            "failed_documents": job["failed"],
+            "bytes_written": job["bytes"],
+            "eta_seconds": eta,
+            "error": job["error"],
+            "created_at": job["created"],
+            "started_at": job["started"],
+            "finished_at": job["finished"],
+            "compression": json.loads(job["compression"]) if job["compression"] else None,
+        }
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cancela un trabajo en cola o en curso (termina como failed con CANCELLED_ERROR).
+
+        Returns:
+            Estado del trabajo (uno en curso puede seguir como running hasta que
+            el pipeline se detiene), o None si no existe
+        """
+        store = self._ensure_started()
+        if store.transition(job_id, QUEUED, status=FAILED, error=CANCELLED_ERROR, finished=time.time()):
+            logger.info(f"[JOBS] ZIP job {job_id} cancelled before starting")
+        else:
+            with self._tokens_lock:
+                token = self._tokens.get(job_id)
+            if token is not None:
+                token.cancel()
+        return self.status(job_id)
+
+    def artifact(self, job_id: str) -> Optional[str]:
+        """Ruta del ZIP de un trabajo terminado, o None"""
+        job = self._ensure_started().get(job_id)
+        if job is None or job["status"] != COMPLETED:
+            return None
+        path = self._artifact_path(job_id)
+        return path if os.path.exists(path) else None
+
+    def _run(self, job_id: str) -> None:
+        store = self._store
+        job = store.get(job_id)
+        if job is None or self._stopping.is_set():
+            return
+        filters = json.loads(job["request"])
+        project_code = filters.get("project_code")
+        started = time.time()
+        # Un cancel() pudo ganarle al worker
+        if not store.transition(job_id, QUEUED, status=RUNNING, started=started):
+            return
+        token = CancelToken()
+        with self._tokens_lock:
+            self._tokens[job_id] = token
+        if self._stopping.is_set():
+            token.cancel()
+        live = {"processed": 0, "failed": 0, "total": 0, "bytes": 0}
+        self._live[job_id] = live
+        last_flush = 0.0
+        part_path = self._artifact_path(job_id) + ".part"
+        chunks = None
+        summary: Dict[str, Any] = {}
+
+        def progress(processed: int, failed: int, total: int) -> None:
+            live.update(processed=processed, failed=failed, total=total)
+
+        try:
+            # Sin recortes silenciosos: un ZIP incompleto falla con el motivo
+            documents = load_documents(filters, limit=PROJECT_DOCUMENTS_LIMIT, strict=True)
+            if not documents:
+                raise ValueError("No documents found matching filters")
+            live["total"] = len(documents)
+            store.update(job_id, total=len(documents))
+            chunks = zip_service.stream_zip(
+                documents, project_code=project_code, summary=summary, progress=progress,
+                cancel_token=token, weight=settings.ZIP_JOB_WEIGHT,
+            )
+            if project_code and not filters.get("document_ids"):
+                # La misma clave que /download/zip/project: ZIP guardado, construcción compartida o uno nuevo
+                archive_key = archive_cache.archive_key(
+                    project_code, _document_types(filters), filters.get("start_date"), filters.get("end_date"), documents
+                )
+                chunks = archive_cache.store(
+                    archive_key, chunks, cacheable=lambda: summary.get("failed") == 0, project_code=project_code,
+                )
+            with open(part_path, "wb") as f:
+                for chunk in chunks:
+                    if self._stopping.is_set():
+                        raise _Stopped()
+                    f.write(chunk)
+                    live["bytes"] += len(chunk)
+                    now = time.monotonic()
+                    if now - last_flush >= PROGRESS_FLUSH_SECONDS:
+                        last_flush = now
+                        store.update(job_id, **live)
+            if "failed" not in summary:
+                # Copiado de la caché o de otra construcción: solo se guardan ZIPs sin faltantes
+                live.update(processed=live["total"], failed=0)
+            os.replace(part_path, self._artifact_path(job_id))
+            store.update(
+                job_id, status=COMPLETED, finished=time.time(),
+                compression=json.dumps(summary.get("compression")), **live,
+            )
+            logger.info(
+                f"[JOBS] ZIP job {job_id} completed: {live['processed'] - live['failed']}/{live['total']} documents, "
+                f"{live['bytes'] / (1024 * 1024):.1f} MB in {time.time() - started:.1f}s"
+            )
+        except (_Stopped, Cancelled):
+            if self._stopping.is_set():
+                store.update(job_id, status=QUEUED, started=None, processed=0, failed=0, bytes=0)
+            else:
+                logger.info(f"[JOBS] ZIP job {job_id} cancelled")
+                store.update(job_id, status=FAILED, error=CANCELLED_ERROR, finished=time.time(), **live)
+        except Exception as e:
+            logger.error(f"[JOBS] ZIP job {job_id} failed: {e}")
+            store.update(job_id, status=FAILED, error=str(e), finished=time.time(), **live)
+        finally:
+            if chunks is not None:
+                # Detiene el pipeline si el trabajo se interrumpió a mitad
+                chunks.close()
+            self._live.pop(job_id, None)
+            with self._tokens_lock:
+                self._tokens.pop(job_id, None)
+            if os.path.exists(part_path):
+                os.unlink(part_path)
+        self._purge_expired()
+
+    def _purge_expired(self) -> None:
+        """Elimina los trabajos terminados hace más de retention_seconds"""
+        store = self._store
+        for job_id in store.finished_before(time.time() - self.retention_seconds):
+            try:
+                os.unlink(self._artifact_path(job_id))
+            except FileNotFoundError:
+                pass
+            store.delete(job_id)
+
+    def shutdown(self) -> None:
+        """Detiene los trabajos en curso; vuelven a la cola en el próximo arranque"""
+        self._stopping.set()
+        with self._tokens_lock:
+            tokens = list(self._tokens.values())
+        # Corta las descargas y conversiones en curso, no solo entre fragmentos
+        for token in tokens:
+            token.cancel()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+            if self._store is not None:
+                self._store.close()
+            self._executor = self._store = None
+        self._stopping.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            store = self._store
+        return {
+            "directory": self.directory,
+            "workers": self.workers,
+            "running": len(self._live),
+            "jobs": store.counts() if store is not None else {},
+        }
+
+
+zip_jobs = ZipJobManager(
+    directory=default_jobs_dir(),
+    workers=settings.ZIP_JOB_WORKERS,
+    retention_seconds=settings.ZIP_JOB_RETENTION_HOURS * 3600,
+)
@@ -0,0 +1,544 @@
+"""
+Pipeline por etapas para la construcción de ZIPs
+
+    [descarga (I/O)] --cola acotada--> [conversión (CPU)] --cola acotada--> [escritura ordenada]
+
+Cada etapa tiene su propio pool de workers y su propia cola de entrada, de modo
+que la etapa cuello de botella se puede escalar sola. Las colas acotadas dan
+backpressure: si el cliente consume lento, la escritura se frena, se llenan las
+colas y las descargas se detienen en lugar de acumular memoria.
+
+La etapa de descarga puede ser asyncio (fetch_async): un solo thread con un
+event loop ejecuta hasta download_workers descargas concurrentes.
+
+Cancelar cancel_token (p. ej. el cliente se desconectó) detiene el pipeline:
+results() lanza Cancelled, los items sin empezar no se descargan y las
+descargas y conversiones en curso ven el token (cancel_scope) y se cortan. Lo
+mismo ocurre si el consumidor cierra results() antes de terminar.
+
+Los workers del pipeline solo piden trabajo: cada descarga y cada conversión
+espera un cupo de los planificadores globales (backend.core.scheduler) como
+parte del flujo de este pipeline, así que la concurrencia real está acotada
+para todo el proceso y los cupos se reparten con colas justas entre ZIPs.
+
+Los threads de los workers son de cada pipeline (a lo sumo uno por item) y no
+de un pool compartido a propósito: el cupo se pide dentro de fetch/convert
+(download_service lo suelta entre reintentos), así que un worker espera su
+turno bloqueado en el planificador. En un pool compartido y acotado, los
+workers de un ZIP grande esperando cupo ocuparían sus threads y los de un ZIP
+chico quedarían en la cola FIFO del pool, fuera del reparto justo. Lo que se
+comparte y se acota para todo el proceso son los cupos, no los threads.
+
+Con plan, los items empiezan a descargarse en el orden que indique (p. ej. el
+más grande primero, ver ZipPlanner), pero se siguen entregando en el orden de
+la lista; uno que termina antes que los anteriores espera en un buffer de
+reordenamiento. Ese buffer está acotado: con reorder_window items empezados y
+sin entregar, solo se admite el siguiente a entregar, así que un item lento
+frena las descargas nuevas en vez de acumular resultados en memoria.
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from backend.core.cancellation import CancelToken, Cancelled, cancel_scope, cancellation_metrics
+from backend.core.scheduler import Flow, flow_scope
+
+logger = logging.getLogger(__name__)
+
+# Intervalo con el que los workers bloqueados revisan si el pipeline se detuvo
+_POLL_SECONDS = 0.2
+# Intervalo con el que la etapa asyncio reintenta encolar en una cola llena
+_ASYNC_POLL_SECONDS = 0.02
+
+# _try_admit: la ventana de items en curso está llena
+_WINDOW_FULL = object()
+
+
+class _PlannedInput:
+    """
+    Items por empezar, en el orden del plan.
+
+    take_next() sigue el plan; take(index) adelanta un item puntual (el
+    siguiente a entregar cuando la ventana está llena). No es thread-safe: el
+    pipeline lo usa con su lock de ventana.
+    """
+
+    # Sin límite de capacidad (para StageMetrics)
+    maxsize = 0
+
+    def __init__(self, order: List[int]):
+        self._order = deque(order)
+        self._taken = set()
+        self._remaining = len(order)
+
+    def qsize(self) -> int:
+        return self._remaining
+
+    def taken(self, index: int) -> bool:
+        return index in self._taken
+
+    def take(self, index: int) -> None:
+        self._taken.add(index)
+        self._remaining -= 1
+
+    def take_next(self) -> Optional[int]:
+        while self._order:
+            index = self._order.popleft()
+            if index not in self._taken:
+                self.take(index)
+                return index
+        return None
+
+
+@dataclass
+class PipelineResult:
+    """Resultado final de un item (éxito con value, o error)"""
+    index: int
+    item: Any
+    value: Any = None
+    error: Optional[str] = None
+
+
+class StageMetrics:
+    """Métricas de una etapa: tamaño, profundidad de cola y tiempo ocupado"""
+
+    def __init__(self, name: str, workers: int, input_queue: Optional[queue.Queue]):
+        self.name = name
+        self.workers = workers
+        self.input_queue = input_queue
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed: float, failed: bool = False) -> None:
+        with self._lock:
+            self.processed += 1
+            self.failed += int(failed)
+            self.busy_seconds += elapsed
+
+    def observe_queue(self) -> None:
+        if self.input_queue is not None:
+            depth = self.input_queue.qsize()
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self.input_queue.qsize() if self.input_queue is not None else 0,
+                "queue_capacity": self.input_queue.maxsize if self.input_queue is not None else 0,
+                "max_queue_depth": self.max_queue_depth,
+                "processed": self.processed,
+                "failed": self.failed,
+                "busy_seconds": round(self.busy_seconds, 3),
+            }
+
+
+class ZipPipeline:
+    """
+    Ejecuta fetch → convert para cada item y entrega los resultados en orden.
+
+    Args:
+        items: Items a procesar (el orden de la lista es el orden de salida)
+        fetch: Función de la etapa de descarga: item -> contenido
+        convert: Función de la etapa de conversión: (item, contenido) -> value
+        describe_error: Formatea el mensaje de error de un item
+        release: Libera un value que no llegó a entregarse (si el pipeline se corta)
+        release_fetched: Libera un contenido descargado que no llegó a convertirse
+        fetch_async: Alternativa asyncio a fetch (corrutina item -> contenido)
+        async_cleanup: Corrutina que se ejecuta al cerrar el event loop de descargas
+        download_workers: Threads de la etapa de descarga
+        convert_workers: Threads de la etapa de conversión
+        queue_depth: Capacidad de cada cola entre etapas
+        reorder_window: Items empezados y aún no entregados a partir de los
+            cuales solo se admite el siguiente a entregar (acota el buffer de
+            reordenamiento); sin indicar, lo que cabe en los workers y las colas
+        name: Nombre del pipeline para métricas
+        cancel_token: Si se cancela, el pipeline se detiene (ver módulo); sin
+            indicar, se usa uno propio
+        weight: Peso del pipeline en el reparto de cupos de los planificadores
+        plan: Función items -> índices en el orden en que procesarlos; se
+            ejecuta al iniciar results() (sin indicar, el orden de la lista)
+    """
+
+    _active: "weakref.WeakSet[ZipPipeline]" = weakref.WeakSet()
+
+    def __init__(
+        self,
+        items: List[Any],
+        fetch: Callable[[Any], Any],
+        convert: Callable[[Any, Any], Any],
+        describe_error: Callable[[Any, Exception], str] = lambda item, e: str(e),
+        release: Optional[Callable[[Any], None]] = None,
+        release_fetched: Optional[Callable[[Any], None]] = None,
+        fetch_async: Optional[Callable[[Any], Awaitable[Any]]] = None,
+        async_cleanup: Optional[Callable[[], Awaitable[None]]] = None,
+        download_workers: int = 4,
+        convert_workers: int = 2,
+        queue_depth: int = 16,
+        reorder_window: Optional[int] = None,
+        name: str = "zip",
+        cancel_token: Optional[CancelToken] = None,
+        weight: float = 1.0,
+        plan: Optional[Callable[[List[Any]], List[int]]] = None,
+    ):
+        self.items = list(items)
+        self.fetch = fetch
+        self.convert = convert
+        self.describe_error = describe_error
+        self.release = release
+        self.release_fetched = release_fetched
+        self.fetch_async = fetch_async
+        self.async_cleanup = async_cleanup
+        self.name = name
+        self.cancel_token = cancel_token or CancelToken()
+        self.flow = Flow(name, weight)
+        self.plan = plan
+        self._delivered = 0
+        self._stopped = False
+        total = len(self.items)
+        self.download_workers = max(1, min(download_workers, total or 1))
+        self.convert_workers = max(1, min(convert_workers, total or 1))
+        if reorder_window is None:
+            reorder_window = self.download_workers + self.convert_workers + 2 * max(1, queue_depth)
+        self.reorder_window = max(1, reorder_window)
+
+        self._input = _PlannedInput([])
+        self._convert_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_depth))
+        self._write_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_depth))
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        # Threads de descarga: uno por worker, o uno solo con el event loop
+        self._download_threads = 1 if fetch_async is not None else self.download_workers
+        self._downloads_pending = self._download_threads
+        self._downloads_lock = threading.Lock()
+        self._reorder: Dict[int, PipelineResult] = {}
+        # Items tomados por las descargas; con _delivered definen la ventana
+        self._admitted = 0
+        self._window = threading.Condition()
+        self.started_at: Optional[float] = None
+
+        self.metrics = {
+            "download": StageMetrics("download", self.download_workers, self._input),
+            "convert": StageMetrics("convert", self.convert_workers, self._convert_queue),
+            "write": StageMetrics("write", 1, self._write_queue),
+        }
+
+    # ------------------------------------------------------------------
+    # Workers
+    # ------------------------------------------------------------------
+
+    def _put(self, q: queue.Queue, entry: Any) -> bool:
+        """Encola respetando la capacidad; abandona si el pipeline se detuvo"""
+        while not self._stop.is_set():
+            try:
+                q.put(entry, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def _put_async(self, q: queue.Queue, entry: Any) -> bool:
+        """Como _put, sin bloquear el event loop"""
+        while not self._stop.is_set():
+            try:
+                q.put_nowait(entry)
+                return True
+            except queue.Full:
+                await asyncio.sleep(_ASYNC_POLL_SECONDS)
+        return False
+
+    def _try_admit(self) -> Any:
+        """
+        Siguiente (index, item) a empezar; _WINDOW_FULL, o None si no quedan.
+
+        Con la ventana llena solo se admite el siguiente a entregar (si no
+        empezó): así la entrega siempre avanza y el buffer no pasa de la ventana.
+        """
+        with self._window:
+            if self._admitted - self._delivered >= self.reorder_window:
+                index = self._delivered
+                if index >= len(self.items) or self._input.taken(index):
+                    return _WINDOW_FULL
+                self._input.take(index)
+            else:
+                index = self._input.take_next()
+                if index is None:
+                    return None
+            self._admitted += 1
+            return index, self.items[index]
+
+    def _admit(self) -> Any:
+        """Como _try_admit, esperando a que se entregue un resultado si la ventana está llena"""
+        while not self._stop.is_set():
+            with self._window:
+                entry = self._try_admit()
+                if entry is not _WINDOW_FULL:
+                    return entry
+                self._window.wait(_POLL_SECONDS)
+        return None
+
+    def _finish_download_thread(self) -> None:
+        """El último thread de descarga avisa a la etapa de conversión"""
+        with self._downloads_lock:
+            self._downloads_pending -= 1
+            last = self._downloads_pending == 0
+        if last:
+            for _ in range(self.convert_workers):
+                self._put(self._convert_queue, None)
+
+    def _download_worker(self) -> None:
+        metrics = self.metrics["download"]
+        try:
+            while not self._stop.is_set():
+                entry = self._admit()
+                if entry is None:
+                    break
+                index, item = entry
+                start = time.monotonic()
+                try:
+                    entry = (index, item, self.fetch(item), None)
+                except Cancelled:
+                    break
+                except Exception as e:
+                    entry = (index, item, None, self.describe_error(item, e))
+                metrics.record(time.monotonic() - start, failed=entry[3] is not None)
+                if not self._put(self._convert_queue, entry):
+                    self._discard_fetched(entry)
+                    break
+                self.metrics["convert"].observe_queue()
+        finally:
+            self._finish_download_thread()
+
+    async def _async_download_task(self) -> None:
+        metrics = self.metrics["download"]
+        while not self._stop.is_set():
+            entry = self._try_admit()
+            if entry is _WINDOW_FULL:
+                await asyncio.sleep(_ASYNC_POLL_SECONDS)
+                continue
+            if entry is None:
+                return
+            index, item = entry
+            start = time.monotonic()
+            try:
+                entry = (index, item, await self.fetch_async(item), None)
+            except Cancelled:
+                return
+            except Exception as e:
+                entry = (index, item, None, self.describe_error(item, e))
+            metrics.record(time.monotonic() - start, failed=entry[3] is not None)
+            if not await self._put_async(self._convert_queue, entry):
+                self._discard_fetched(entry)
+                return
+            self.metrics["convert"].observe_queue()
+
+    async def _async_download_stage(self) -> None:
+        try:
+            outcomes = await asyncio.gather(
+                *(self._async_download_task() for _ in range(self.download_workers)), return_exceptions=True
+            )
+            for outcome in outcomes:
+                if isinstance(outcome, Exception):
+                    logger.error(f"[PIPELINE] Async download task failed: {outcome}")
+        finally:
+            if self.async_cleanup is not None:
+                await self.async_cleanup()
+
+    def _async_download_worker(self) -> None:
+        try:
+            asyncio.run(self._async_download_stage())
+        except Exception as e:
+            logger.error(f"[PIPELINE] Async download stage failed: {e}")
+        finally:
+            self._finish_download_thread()
+
+    def _convert_worker(self) -> None:
+        metrics = self.metrics["convert"]
+        while not self._stop.is_set():
+            try:
+                entry = self._convert_queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if entry is None:
+                break
+            index, item, content, error = entry
+            start = time.monotonic()
+            result = PipelineResult(index=index, item=item, error=error)
+            if error is None:
+                try:
+                    result.value = self.convert(item, content)
+                except Cancelled:
+                    break
+                except Exception as e:
+                    result.error = self.describe_error(item, e)
+            del content
+            metrics.record(time.monotonic() - start, failed=result.error is not None)
+            if not self._put(self._write_queue, result):
+                self._discard(result)
+                break
+            self.metrics["write"].observe_queue()
+
+    def _run_worker(self, target: Callable[[], None]) -> None:
+        """Ejecuta un worker con el token de cancelación y el flujo activos en su thread"""
+        with cancel_scope(self.cancel_token), flow_scope(self.flow):
+            target()
+
+    def _discard_fetched(self, entry) -> None:
+        if entry is None:
+            return
+        index, _, content, _ = entry
+        if self.release_fetched is not None and content is not None:
+            try:
+                self.release_fetched(content)
+            except Exception as e:
+                logger.warning(f"[PIPELINE] Error releasing download {index}: {e}")
+
+    def _discard(self, result: PipelineResult) -> None:
+        if self.release is not None and result.value is not None:
+            try:
+                self.release(result.value)
+            except Exception as e:
+                logger.warning(f"[PIPELINE] Error releasing result {result.index}: {e}")
+
+    # ------------------------------------------------------------------
+    # Ejecución
+    # ------------------------------------------------------------------
+
+    def _processing_order(self) -> List[int]:
+        """Orden de procesamiento según plan (el de la lista si no hay o falla)"""
+        natural = list(range(len(self.items)))
+        if self.plan is None:
+            return natural
+        try:
+            with cancel_scope(self.cancel_token), flow_scope(self.flow):
+                order = list(self.plan(self.items))
+        except Exception as e:
+            logger.warning(f"[PIPELINE] {self.name} planning failed, keeping list order: {e}")
+            return natural
+        if sorted(order) != natural:
+            logger.warning(f"[PIPELINE] {self.name} plan is not a permutation of the items, keeping list order")
+            return natural
+        return order
+
+    def _start(self) -> None:
+        self.started_at = time.monotonic()
+        self._input = self.metrics["download"].input_queue = _PlannedInput(self._processing_order())
+        self.metrics["download"].observe_queue()
+
+        download_target = self._async_download_worker if self.fetch_async is not None else self._download_worker
+        for i in range(self._download_threads):
+            self._threads.append(threading.Thread(
+                target=self._run_worker, args=(download_target,), name=f"{self.name}-download-{i}", daemon=True
+            ))
+        for i in range(self.convert_workers):
+            self._threads.append(threading.Thread(
+                target=self._run_worker, args=(self._convert_worker,), name=f"{self.name}-convert-{i}", daemon=True
+            ))
+        for thread in self._threads:
+            thread.start()
+        ZipPipeline._active.add(self)
+
+    def results(self) -> Iterator[PipelineResult]:
+        """
+        Inicia el pipeline y entrega los resultados en el orden de la lista.
+
+        La etapa de escritura es el consumidor de este iterador. Si se cierra
+        antes de terminar, el pipeline se detiene y los resultados pendientes
+        se liberan.
+
+        Raises:
+            Cancelled: Si se cancela cancel_token antes de terminar
+        """
+        self._start()
+        try:
+            for index in range(len(self.items)):
+                while index not in self._reorder:
+                    self.cancel_token.raise_if_cancelled()
+                    try:
+                        result = self._write_queue.get(timeout=_POLL_SECONDS)
+                    except queue.Empty:
+                        continue
+                    self._reorder[result.index] = result
+
+                result = self._reorder.pop(index)
+                with self._window:
+                    self._delivered = index + 1
+                    self._window.notify_all()
+                start = time.monotonic()
+                yield result
+                self.metrics["write"].record(time.monotonic() - start, failed=result.error is not None)
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        """Detiene los workers y libera los resultados que no se entregaron"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._stop.set()
+        unfinished = self._delivered < len(self.items)
+        if unfinished:
+            # Que las descargas y conversiones en curso se corten ya
+            self.cancel_token.cancel()
+        for thread in self._threads:
+            thread.join()
+        discarded = len(self._reorder)
+        for result in self._reorder.values():
+            self._discard(result)
+        self._reorder.clear()
+        while True:
+            try:
+                entry = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+            discarded += 1
+            self._discard(entry)
+        while True:
+            try:
+                entry = self._convert_queue.get_nowait()
+            except queue.Empty:
+                break
+            discarded += entry is not None
+            self._discard_fetched(entry)
+        if unfinished and self.started_at is not None:
+            skipped = self._input.qsize()
+            cancellation_metrics.count("builds_cancelled")
+            cancellation_metrics.count("documents_skipped", skipped)
+            cancellation_metrics.count("documents_discarded", discarded)
+            logger.info(
+                f"[PIPELINE] {self.name} cancelled: {skipped} documents never downloaded, "
+                f"{discarded} finished documents discarded"
+            )
+        ZipPipeline._active.discard(self)
+
+    @property
+    def reorder_depth(self) -> int:
+        """Resultados listos que esperan a uno anterior para escribirse"""
+        return len(self._reorder)
+
+    def stats(self) -> Dict[str, Any]:
+        """Métricas por etapa de este pipeline"""
+        return {
+            "name": self.name,
+            "items": len(self.items),
+            "weight": self.flow.weight,
+            "elapsed_seconds": round(time.monotonic() - self.started_at, 1) if self.started_at else 0.0,
+            "reorder_depth": self.reorder_depth,
+            "reorder_window": self.reorder_window,
+            "stages": {name: m.stats() for name, m in self.metrics.items()},
+        }
+
+    @classmethod
+    def active_stats(cls) -> List[Dict[str, Any]]:
+        """Métricas de todos los pipelines en curso"""
+        return [p.stats() for p in list(cls._active)]
@@ -0,0 +1,169 @@
+"""
+Planificación del orden de trabajo de un ZIP (el más largo primero)
+
+El pipeline procesaba los documentos en el orden del ZIP (TALE: por tipo y
+fecha de carga): un archivo de 50 MB que quedaba al final empezaba a
+descargarse cuando los demás ya habían terminado y alargaba todo el ZIP. Con
+estimaciones de tamaño, el trabajo se ordena de mayor a menor (LPT, longest
+processing time first), lo que acerca el tiempo total al mínimo posible con
+los workers disponibles.
+
+Estimación de cada documento:
+- Caché de documentos: tamaño de la entrada guardada de la URL, sin red.
+- Si no está, un HEAD (Content-Length) con hasta ZIP_SIZE_HINT_WORKERS en
+  paralelo y un plazo total de ZIP_SIZE_HINT_TIMEOUT_SECONDS. Cada HEAD usa un
+  cupo libre del planificador de descargas (no espera ni adelanta a las
+  descargas en cola) y su timeout es lo que queda del plazo: lo que no
+  responde a tiempo queda sin estimar y no sigue ocupando el cupo.
+- Sin estimación se usa la mediana de las conocidas (1 si no hay ninguna).
+- Las imágenes que no vienen de la caché pesan IMAGE_CONVERSION_FACTOR veces
+  más: además de la transferencia pasan por el pool de conversión (las de la
+  caché ya vienen convertidas).
+
+Solo cambia el orden en que se procesan los documentos: el ZIP se sigue
+escribiendo en el orden TALE (_group_documents_by_folder / _get_doc_sort_key).
+"""
+import contextvars
+import logging
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional, Dict, Any, List, Set, Tuple
+
+from backend.core.config import settings
+from backend.services.document_cache import document_cache
+from backend.services.download_service import download_service
+from backend.services.pdf_service import IMAGE_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+# Costo relativo de una imagen que además de descargarse hay que convertir
+IMAGE_CONVERSION_FACTOR = 2.0
+
+
+class ZipPlanner:
+    """
+    Ordena los documentos de un ZIP de mayor a menor costo estimado.
+
+    Args:
+        enabled: Si es False, plan() conserva el orden del ZIP
+        workers: HEADs simultáneos para estimar tamaños (entre todos los ZIPs)
+        timeout: Segundos máximos para reunir las estimaciones por HEAD
+    """
+
+    def __init__(self, enabled: bool, workers: int, timeout: float):
+        self.enabled = enabled
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="zip-plan")
+        self._lock = threading.Lock()
+        self._stats = {
+            "plans": 0,
+            "documents": 0,
+            "cache_hints": 0,
+            "head_hints": 0,
+            "unknown": 0,
+            "planning_seconds": 0.0,
+        }
+
+    def _count(self, key: str, delta: float = 1) -> None:
+        with self._lock:
+            self._stats[key] += delta
+
+    @staticmethod
+    def _probe(url: str, deadline: float) -> Optional[int]:
+        """HEAD con el tiempo que queda hasta deadline (None si ya no queda)"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return download_service.content_length(url, remaining)
+
+    def size_hints(self, urls: List[str]) -> Tuple[Dict[str, Optional[int]], Set[str]]:
+        """
+        Tamaño estimado de cada URL.
+
+        Returns:
+            ({url: bytes o None si no se pudo estimar a tiempo}, URLs estimadas desde la caché)
+        """
+        hints: Dict[str, Optional[int]] = {}
+        cached: Set[str] = set()
+        missing = []
+        for url in dict.fromkeys(urls):
+            hints[url] = document_cache.size_hint(url) if url else None
+            if hints[url] is not None:
+                cached.add(url)
+            elif url:
+                missing.append(url)
+        self._count("cache_hints", len(cached))
+        if not missing:
+            return hints, cached
+
+        # Los HEAD heredan el flujo y el token de cancelación del llamador
+        deadline = time.monotonic() + self.timeout
+        futures = {
+            self._executor.submit(contextvars.copy_context().run, self._probe, url, deadline): url
+            for url in missing
+        }
+        done, pending = wait(futures, timeout=self.timeout)
+        for future in pending:
+            future.cancel()
+        for future in done:
+            if future.exception() is None and future.result() is not None:
+                hints[futures[future]] = future.result()
+                self._count("head_hints")
+        return hints, cached
+
+    @staticmethod
+    def _is_image(url: str) -> bool:
+        return os.path.splitext(url.split("?")[0])[1].lower() in IMAGE_EXTENSIONS
+
+    def plan(self, documents: List[Dict[str, Any]]) -> List[int]:
+        """
+        Orden de procesamiento: índices de documents de mayor a menor costo.
+
+        A igual costo se respeta el orden original: sin estimaciones solo pasan
+        adelante las imágenes, y con la planificación desactivada no cambia.
+        Solo define el orden de proceso; las entradas se escriben en orden TALE.
+        """
+        if not self.enabled or len(documents) < 2:
+            return list(range(len(documents)))
+        start = time.monotonic()
+        urls = [doc.get("url") or "" for doc in documents]
+        hints, cached = self.size_hints(urls)
+        known = [hints[url] for url in urls if hints[url] is not None]
+        fallback = statistics.median(known) if known else 1
+        unknown = len(urls) - len(known)
+        costs = []
+        for url in urls:
+            size = hints[url] if hints[url] is not None else fallback
+            if url not in cached and self._is_image(url):
+                size *= IMAGE_CONVERSION_FACTOR
+            costs.append(size)
+
+        order = sorted(range(len(documents)), key=lambda i: -costs[i])
+        elapsed = time.monotonic() - start
+        self._count("plans")
+        self._count("documents", len(documents))
+        self._count("unknown", unknown)
+        self._count("planning_seconds", elapsed)
+        logger.info(
+            f"[PLAN] {len(documents)} documents ordered largest first in {elapsed:.2f}s "
+            f"({len(known)} sized, {unknown} unknown)"
+        )
+        return order
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["planning_seconds"] = round(stats["planning_seconds"], 3)
+        stats["enabled"] = self.enabled
+        return stats
+
+
+zip_planner = ZipPlanner(
+    enabled=settings.ZIP_SIZE_HINTS,
+    workers=settings.ZIP_SIZE_HINT_WORKERS,
+    timeout=settings.ZIP_SIZE_HINT_TIMEOUT_SECONDS,
+)
@@ -3,15 +3,22 @@ Servicio de generación de ZIPs en streaming con estructura TALE
 IMPLEMENTACIÓN CONGELADA - NO MODIFICAR SIN APROBACIÓN
 """
 import io
-import zipfile
 import logging
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Tuple, Optional, Iterator, Callable
 from collections import defaultdict
 from datetime import datetime
-import concurrent.futures
+from http import HTTPStatus
+from backend.core.cancellation import CancelToken, Cancelled, cancel_requested
+from backend.core.config import settings
+from backend.core.memory_budget import zip_memory_budget
+from backend.core.spool import SpooledPayload, SpoolWriter
 from backend.services.download_service import download_service
-from backend.services.pdf_service import pdf_service
+from backend.services.document_cache import document_cache
+from backend.services.zip_compression import compression_policy
+from backend.services.zip_pipeline import ZipPipeline
+from backend.services.zip_planner import zip_planner
 from backend.utils.file_naming import generate_filename, generate_folder_path, TIPO_UNIDAD_CODES
+from backend.utils.zip_stream import BytesLike, CompressionReport, PreparedEntry, ZipStreamWriter, ZIP_STORED, prepare_entry
 
 logger = logging.getLogger(__name__)
 
@@ -93,12 +100,15 @@ class ZipService:
         return dict(grouped)
     
     @staticmethod
-    def _add_info_folder(zip_file: zipfile.ZipFile) -> None:
+    def _add_info_folder(zip_writer: ZipStreamWriter) -> Iterator[bytes]:
         """
         Agrega carpeta _00_INFO_TALE con archivos informativos
         
         Args:
-            zip_file: ZipFile donde agregar
+            zip_writer: ZipStreamWriter donde agregar
+        
+        Yields:
+            Fragmentos del ZIP correspondientes a la carpeta
         """
         # README.txt con información del ZIP
         fecha_generacion = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -140,128 +150,328 @@ Para más información: www.taleinmobiliaria.com
 Soporte: soporte@taleinmobiliaria.com
 """.encode('utf-8')
         
-        zip_file.writestr("_00_INFO_TALE/README.txt", readme_content)
+        yield from ZipService._add_entry(zip_writer, "_00_INFO_TALE/README.txt", readme_content)
         
         logger.info("[ZIP] Added _00_INFO_TALE folder")
     
     @staticmethod
-    def _download_and_process_file(doc: Dict[str, Any], project_code: str) -> Tuple[Optional[str], Optional[bytes], Optional[str]]:
-        """
-        Función de trabajo para un solo archivo: descarga, procesa y retorna el resultado.
-        Diseñada para ser ejecutada en un thread pool.
-        Retorna (zip_path, content, error_message).
-        """
+    def _add_entry(zip_writer: ZipStreamWriter, name: str, data: BytesLike) -> Iterator[bytes]:
+        """Agrega una entrada con el método y nivel que elija la política de compresión"""
+        compress_type, level = compression_policy.choose(data, zip_writer.report)
+        yield from zip_writer.add(name, data, compress_type=compress_type, compresslevel=level)
+    
+    @staticmethod
+    def _describe_error(doc: Dict[str, Any], error: Exception) -> str:
+        """Formatea una línea de FAILED_FILES.txt: PROFORMA | TIPO | ERROR"""
         codigo_proforma = doc.get("codigo_proforma", "UNKNOWN")
         tipo_doc = doc.get("tipo_documento", "Otro")
+        return f"{codigo_proforma} | {tipo_doc} | {str(error)}"
+    
+    @staticmethod
+    def _document_url(doc: Dict[str, Any]) -> str:
+        url = doc.get("url", "")
+        if not url:
+            raise ValueError("Missing document URL")
+        return url
+    
+    @staticmethod
+    def _check_download(payload: Optional[SpooledPayload]) -> SpooledPayload:
+        if payload is not None and payload.size == 0:
+            payload.close()
+            payload = None
+        if payload is None:
+            raise ValueError("Download failed or file is empty")
+        return payload
+    
+    @staticmethod
+    def _fetch_document(doc: Dict[str, Any]) -> SpooledPayload:
+        """
+        Etapa de descarga (I/O): obtiene el contenido original del documento.
+        
+        El contenido se descarga por fragmentos y se reserva contra el presupuesto
+        global de memoria; los archivos grandes (o sin presupuesto) quedan en disco.
+        Si document_cache tiene una copia de la URL, el GET es condicional y un 304
+        devuelve directamente la copia ya convertida.
+        
+        Raises:
+            ValueError: Si falta la URL o la descarga falla
+        """
+        url = ZipService._document_url(doc)
+        return ZipService._check_download(document_cache.fetch(url, budget=zip_memory_budget))
+    
+    @staticmethod
+    async def _fetch_document_async(doc: Dict[str, Any]) -> SpooledPayload:
+        """Igual que _fetch_document, con el motor asyncio de download_service (ZIP_ASYNC_DOWNLOADS)"""
+        url = ZipService._document_url(doc)
+        return ZipService._check_download(await document_cache.fetch_async(url, budget=zip_memory_budget))
+    
+    @staticmethod
+    def _process_document(doc: Dict[str, Any], download: SpooledPayload, project_code: str) -> Tuple[str, SpooledPayload]:
+        """
+        Etapa de conversión (CPU): convierte a PDF y genera la ruta TALE dentro del ZIP.
+        Las imágenes se convierten en el pool de procesos de conversion_executor, o
+        se toman ya convertidas de document_cache.
         
+        Si el archivo no requiere conversión (PDF o passthrough), la descarga misma
+        pasa a ser el contenido de la entrada, sin copiarla. Si no, la descarga se
+        libera y el resultado se retiene contra el presupuesto global de memoria:
+        si está agotado, el worker espera hasta ZIP_BUDGET_WAIT_SECONDS y luego lo
+        deriva a disco. Una conversión tomada de la caché se escribe desde su archivo.
+        
+        Returns:
+            (zip_path, payload)
+        """
         try:
             url = doc.get("url", "")
-            if not url:
-                raise ValueError("Missing document URL")
-
-            content = download_service.download_file(url)
-            if not content:
-                raise ValueError("Download failed or file is empty")
-
             original_filename = url.split("/")[-1].split("?")[0]
-            result = pdf_service.convert_to_pdf(content, original_filename)
+            content = download.buffer()
+            result = document_cache.convert_to_pdf(content, original_filename, url=url, validators=download.validators)
             if not result:
                 raise ValueError(f"Unsupported file type for {original_filename}")
+        except Exception:
+            download.close()
+            raise
 
-            file_content = result["content"]
-            file_extension = result["extension"]
-            folder_path = generate_folder_path(doc, project_code or "PROJECT")
+        file_content = result["content"]
+        file_extension = result["extension"]
+        folder_path = generate_folder_path(doc, project_code or "PROJECT")
 
-            if result["mode"] == "pdf":
-                filename = generate_filename(doc)
-            else: # passthrough
-                filename_base = generate_filename(doc).rsplit(".", 1)[0]
-                filename = f"{filename_base}{file_extension}"
-            
-            zip_path = f"{folder_path}/{filename}"
-            return (zip_path, file_content, None)
+        if result["mode"] == "pdf":
+            filename = generate_filename(doc)
+        else: # passthrough
+            filename_base = generate_filename(doc).rsplit(".", 1)[0]
+            filename = f"{filename_base}{file_extension}"
+        
+        zip_path = f"{folder_path}/{filename}"
+        if file_content is content:
+            return (zip_path, download)
 
-        except Exception as e:
-            error_msg = f"{codigo_proforma} | {tipo_doc} | {str(e)}"
-            return (None, None, error_msg)
+        download.close()
+        if "payload" in result:
+            return (zip_path, result["payload"])
+        payload = SpooledPayload.hold(file_content, zip_memory_budget, settings.ZIP_BUDGET_WAIT_SECONDS)
+        return (zip_path, payload)
     
     @staticmethod
-    def create_zip(documents: List[Dict[str, Any]], project_code: str = None) -> io.BytesIO:
-        """Crea un ZIP en streaming con descarga y procesamiento paralelo."""
-        zip_buffer = io.BytesIO()
+    def _prepare_entry(
+        zip_path: str, payload: SpooledPayload, report: CompressionReport
+    ) -> Tuple[str, SpooledPayload, PreparedEntry]:
+        """
+        Etapa de conversión (CPU): elige el método de la entrada y la comprime.
+        
+        Se ejecuta en los workers de conversión, en paralelo entre documentos; el
+        writer solo copia el resultado al ZIP (add_prepared). La salida
+        comprimida se retiene contra el presupuesto de memoria y, si no cabe o
+        supera DOWNLOAD_MEMORY_THRESHOLD_MB, va a disco. Una entrada STORED
+        conserva el payload original con su CRC ya calculado.
+        
+        Returns:
+            (zip_path, payload a escribir, metadata de la entrada)
+        """
+        try:
+            content = payload.buffer()
+            compress_type, level = compression_policy.choose(content, report)
+            if compress_type == ZIP_STORED:
+                return (zip_path, payload, prepare_entry(content, ZIP_STORED))
+            with SpoolWriter(settings.DOWNLOAD_MEMORY_THRESHOLD_MB * 1024 * 1024, zip_memory_budget) as output:
+                def write(chunk: BytesLike) -> None:
+                    # Una entrada grande no termina de comprimirse si el ZIP se canceló
+                    if cancel_requested():
+                        raise Cancelled()
+                    output.write(chunk)
+                
+                entry = prepare_entry(content, compress_type, level, write)
+                compressed = output.finish()
+        except BaseException:
+            payload.close()
+            raise
+        # Comprimida la entrada, el contenido original ya no hace falta
+        payload.close()
+        return (zip_path, compressed, entry)
+    
+    @staticmethod
+    def _build_failed_files_content(failed_files: List[str]) -> bytes:
+        """Genera el contenido de FAILED_FILES.txt"""
+        failed_content = "╔════════════════════════════════════════════════════════════════╗\n"
+        failed_content += "║                    ARCHIVOS NO PROCESADOS                      ║\n"
+        failed_content += "╚════════════════════════════════════════════════════════════════╝\n\n"
+        failed_content += f"Total de errores: {len(failed_files)}\n"
+        failed_content += f"Generado: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+        failed_content += "PROFORMA | TIPO | ERROR\n"
+        failed_content += "-" * 80 + "\n"
+        for fail in failed_files:
+            failed_content += f"{fail}\n"
+        return failed_content.encode('utf-8')
+    
+    @staticmethod
+    def stream_zip(
+        documents: List[Dict[str, Any]],
+        project_code: str = None,
+        summary: Optional[Dict[str, int]] = None,
+        progress: Optional[Callable[[int, int, int], None]] = None,
+        cancel_token: Optional[CancelToken] = None,
+        weight: float = 1.0,
+    ) -> Iterator[bytes]:
+        """
+        Genera el ZIP en streaming con descarga y procesamiento paralelo.
+        
+        Los documentos pasan por un pipeline descarga → conversión → escritura
+        (ver ZipPipeline) y se escriben en el orden TALE apenas están listos, de modo
+        que el cliente recibe los primeros bytes de inmediato y la memoria no crece
+        con el tamaño del proyecto.
+        
+        Los documentos se procesan del más grande al más chico (ver ZipPlanner)
+        para acortar el tiempo total, pero se escriben en el orden TALE.
+        
+        La compresión de cada entrada (ver CompressionPolicy) ocurre en los
+        workers de conversión, en paralelo; el writer solo concatena las
+        entradas ya comprimidas.
+        
+        Args:
+            documents: Lista de documentos con metadata
+            project_code: Código del proyecto
+            summary: Si se indica, al terminar recibe "failed" (documentos en
+                FAILED_FILES.txt), "processing_failed" (los que fallaron en esta
+                generación, sin contar los omitidos por la caché negativa) y
+                "compression" (bytes ahorrados y CPU gastada, ver CompressionReport)
+            progress: Si se indica, se llama con (procesados, fallidos, total)
+                cada vez que un documento termina (bien o con error)
+            cancel_token: Cancelarlo (p. ej. al desconectarse el cliente) detiene
+                descargas y conversiones; el generador termina con Cancelled
+            weight: Peso de este ZIP en el reparto de descargas y conversiones
+                entre los ZIPs en curso (ver backend.core.scheduler)
+        
+        Yields:
+            Fragmentos del archivo ZIP
+        """
+        compression = CompressionReport()
+        zip_writer = ZipStreamWriter(report=compression)
         failed_files = []
         total_docs = len(documents)
+        project_code_or_default = project_code or 'PROJECT'
+        
+        # Agrupar documentos por carpeta: define el orden de escritura en el ZIP
+        grouped_docs = ZipService._group_documents_by_folder(documents, project_code_or_default)
+        ordered_docs = [doc for folder_docs in grouped_docs.values() for doc in folder_docs]
         
-        # Usar máximo 10 workers para no saturar el sistema (rango seguro)
-        MAX_WORKERS = min(10, total_docs) if total_docs > 0 else 1
+        # URLs con un 403/404 reciente (caché negativa): fallan de inmediato, sin descargarse
+        pending_docs = []
+        for doc in ordered_docs:
+            status_code = download_service.cached_failure(doc.get("url", ""))
+            if status_code is None:
+                pending_docs.append(doc)
+            else:
+                reason = f"cached {status_code} {HTTPStatus(status_code).phrase}"
+                failed_files.append(ZipService._describe_error(doc, ValueError(reason)))
+        skipped_count = len(failed_files)
+        if failed_files:
+            logger.warning(f"[ZIP] {skipped_count} documents skipped by the negative cache")
+        
+        pipeline = ZipPipeline(
+            pending_docs,
+            fetch=ZipService._fetch_document,
+            convert=lambda doc, content: ZipService._prepare_entry(
+                *ZipService._process_document(doc, content, project_code_or_default), compression
+            ),
+            describe_error=ZipService._describe_error,
+            release=lambda value: value[1].close(),
+            release_fetched=lambda download: download.close(),
+            fetch_async=ZipService._fetch_document_async if settings.ZIP_ASYNC_DOWNLOADS else None,
+            async_cleanup=download_service.aclose,
+            download_workers=settings.ZIP_DOWNLOAD_WORKERS,
+            convert_workers=settings.ZIP_CONVERT_WORKERS,
+            queue_depth=settings.ZIP_QUEUE_DEPTH,
+            name=f"zip-{project_code_or_default}",
+            cancel_token=cancel_token,
+            weight=weight,
+            plan=zip_planner.plan,
+        )
 
-        logger.info(f"[ZIP] Starting parallel ZIP generation: Project={project_code or 'UNKNOWN'}, Total Docs={total_docs}, Workers={MAX_WORKERS}")
-        
-        # Agrupar documentos por carpeta
-        grouped_docs = ZipService._group_documents_by_folder(documents, project_code or 'PROJECT')
-        logger.info(f"[ZIP] Grouped into {len(grouped_docs)} folders")
-        
-        # Procesar todos los documentos en paralelo
-        processed_results = []
-        processed_count = 0
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Crear lista de futures
-            futures = {
-                executor.submit(ZipService._download_and_process_file, doc, project_code or 'PROJECT'): doc
-                for doc in documents
-            }
-            
-            # Procesar resultados conforme van terminando
-            for future in concurrent.futures.as_completed(futures):
+        logger.info(
+            f"[ZIP] Starting streaming ZIP generation: Project={project_code or 'UNKNOWN'}, Total Docs={total_docs}, "
+            f"Folders={len(grouped_docs)}, Download workers={pipeline.download_workers}, "
+            f"Convert workers={pipeline.convert_workers}, Queue depth={settings.ZIP_QUEUE_DEPTH}, "
+            f"Async downloads={pipeline.fetch_async is not None}"
+        )
+        
+        # 1. Agregar carpeta de información (primeros bytes hacia el cliente)
+        yield from ZipService._add_info_folder(zip_writer)
+        
+        # 2. Etapa de escritura: recibe los documentos en orden TALE y los escribe
+        processed_count = len(failed_files)
+        spilled_count = 0
+        if progress is not None:
+            progress(processed_count, len(failed_files), total_docs)
+        
+        try:
+            for result in pipeline.results():
                 processed_count += 1
-                doc = futures[future]
-                tipo_doc = doc.get("tipo_documento", "Otro")
-                
-                try:
-                    zip_path, content, error_msg = future.result()
-                    
-                    if error_msg:
-                        failed_files.append(error_msg)
-                        logger.warning(f"[ZIP] ✗ {processed_count}/{total_docs} | FAILED: {error_msg}")
-                    else:
-                        processed_results.append((zip_path, content))
-                        logger.info(f"[ZIP] ✓ {processed_count}/{total_docs} | {tipo_doc} | {zip_path}")
+                tipo_doc = result.item.get("tipo_documento", "Otro")
                 
-                except Exception as e:
-                    error_msg = f"{doc.get('codigo_proforma', 'UNKNOWN')} | {tipo_doc} | {str(e)}"
-                    failed_files.append(error_msg)
-                    logger.warning(f"[ZIP] ✗ {processed_count}/{total_docs} | FAILED: {error_msg}")
-        
-        # Ahora agregar todos los resultados al ZIP (ya procesados)
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # 1. Agregar carpeta de información
-            ZipService._add_info_folder(zip_file)
-            
-            # 2. Agregar archivos procesados
-            for zip_path, content in processed_results:
-                zip_file.writestr(zip_path, content)
-            
-            # 3. Agregar FAILED_FILES.txt si hubo errores
-            if failed_files:
-                failed_content = "╔════════════════════════════════════════════════════════════════╗\n"
-                failed_content += "║                    ARCHIVOS NO PROCESADOS                      ║\n"
-                failed_content += "╚════════════════════════════════════════════════════════════════╝\n\n"
-                failed_content += f"Total de errores: {len(failed_files)}\n"
-                failed_content += f"Generado: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                failed_content += "PROFORMA | TIPO | ERROR\n"
-                failed_content += "-" * 80 + "\n"
-                for fail in failed_files:
-                    failed_content += f"{fail}\n"
-                
-                zip_file.writestr("FAILED_FILES.txt", failed_content.encode('utf-8'))
-                logger.warning(f"[ZIP] Added FAILED_FILES.txt ({len(failed_files)} errors)")
+                if result.error:
+                    failed_files.append(result.error)
+                    logger.warning(f"[ZIP] ✗ {processed_count}/{total_docs} | FAILED: {result.error}")
+                else:
+                    # Al escribir la entrada se libera su reserva del presupuesto
+                    zip_path, payload, entry = result.value
+                    with payload:
+                        spilled_count += payload.spilled
+                        yield from zip_writer.add_prepared(zip_path, payload.buffer(), entry)
+                    logger.info(f"[ZIP] ✓ {processed_count}/{total_docs} | {tipo_doc} | {zip_path}")
+                if progress is not None:
+                    progress(processed_count, len(failed_files), total_docs)
+        finally:
+            # Si el cliente corta la descarga, detener el pipeline y liberar lo retenido
+            pipeline.stop()
         
-        zip_buffer.seek(0)
+        stage_stats = pipeline.stats()["stages"]
+        logger.info(
+            "[ZIP] Stage busy time: " + ", ".join(
+                f"{name}={stats['busy_seconds']:.1f}s (max queue {stats['max_queue_depth']})"
+                for name, stats in stage_stats.items()
+            )
+        )
+        
+        # 3. Agregar FAILED_FILES.txt si hubo errores
+        if failed_files:
+            yield from ZipService._add_entry(zip_writer, "FAILED_FILES.txt", ZipService._build_failed_files_content(failed_files))
+            logger.warning(f"[ZIP] Added FAILED_FILES.txt ({len(failed_files)} errors)")
+        
+        # 4. Central directory
+        yield from zip_writer.close()
+        
+        compression_policy.record(compression)
+        if summary is not None:
+            summary["failed"] = len(failed_files)
+            summary["processing_failed"] = len(failed_files) - skipped_count
+            summary["compression"] = compression.as_dict()
         
         success_count = total_docs - len(failed_files)
-        logger.info(f"[ZIP] Completed: {success_count}/{total_docs} successful, {len(failed_files)} failed")
+        logger.info(f"[ZIP] Completed: {success_count}/{total_docs} successful, {len(failed_files)} failed, {zip_writer.bytes_written / (1024 * 1024):.1f} MB")
+        logger.info(
+            f"[ZIP] Compression ({compression_policy.mode}): {compression.bytes_saved / (1024 * 1024):.2f} MB saved "
+            f"for {compression.cpu_seconds:.2f}s CPU ({compression.deflated_entries} deflated, "
+            f"{compression.stored_entries} stored)"
+        )
+        budget_stats = zip_memory_budget.stats()
+        logger.info(
+            f"[ZIP] Memory budget: {budget_stats['in_use_bytes'] / (1024 * 1024):.1f}/"
+            f"{budget_stats['limit_bytes'] / (1024 * 1024):.0f} MB in use, "
+            f"peak {budget_stats['peak_bytes'] / (1024 * 1024):.1f} MB, {spilled_count} entries spilled to disk"
+        )
+    
+    @staticmethod
+    def create_zip(documents: List[Dict[str, Any]], project_code: str = None) -> io.BytesIO:
+        """
+        Crea el ZIP completo en memoria.
         
+        Se mantiene por compatibilidad; los endpoints usan stream_zip() para no
+        retener el archivo completo en RAM.
+        """
+        zip_buffer = io.BytesIO()
+        for chunk in ZipService.stream_zip(documents, project_code=project_code):
+            zip_buffer.write(chunk)
+        zip_buffer.seek(0)
         return zip_buffer
 
 zip_service = ZipService()
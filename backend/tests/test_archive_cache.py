@@ -0,0 +1,190 @@
+"""
+Tests de la caché de ZIPs de proyecto terminados
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.api.routes import _PinnedFileResponse
+from backend.core.negative_cache import NegativeCache
+from backend.core.spool import SpooledPayload
+from backend.services import zip_service as zip_service_module
+from backend.services.archive_cache import ArchiveCache, TMP_PREFIX
+from backend.services.zip_service import ZipService
+
+DOCS = [
+    {"codigo_proforma": "P-1", "fecha_carga": "2026-01-10 09:00:00"},
+    {"codigo_proforma": "P-2", "fecha_carga": "2026-03-02 12:30:00"},
+]
+
+
+def _chunks():
+    yield b"PK"
+    yield b"contenido"
+
+
+class TestArchiveKey:
+    """Normalización de la clave"""
+
+    def test_orden_de_tipos_no_cambia_la_clave(self):
+        a = ArchiveCache.archive_key("PROY", ["Minuta", "Voucher"], None, "", DOCS)
+        b = ArchiveCache.archive_key(" PROY ", ["Voucher", "Minuta", "Voucher"], "", None, DOCS)
+        assert a == b
+
+    def test_documento_nuevo_cambia_la_clave(self):
+        before = ArchiveCache.archive_key("PROY", None, None, None, DOCS)
+        after = ArchiveCache.archive_key("PROY", None, None, None, DOCS + [{"fecha_carga": "2026-04-01 08:00:00"}])
+        assert before != after
+        assert before != ArchiveCache.archive_key("PROY", ["Minuta"], None, None, DOCS)
+
+
+class TestArchiveCache:
+    """Tests de ArchiveCache"""
+
+    def test_stream_completo_queda_guardado(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        assert cache.get("k") is None
+        assert b"".join(cache.store("k", _chunks(), cacheable=lambda: True, project_code="PROY")) == b"PKcontenido"
+
+        path = cache.get("k")
+        with open(path, "rb") as f:
+            assert f.read() == b"PKcontenido"
+        assert not [n for n in os.listdir(tmp_path) if n.startswith(TMP_PREFIX)]
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["stores"]) == (1, 1, 1)
+
+    def test_stream_cortado_o_con_fallos_no_se_guarda(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        list(cache.store("fallos", _chunks(), cacheable=lambda: False))
+        stream = cache.store("cortado", _chunks(), cacheable=lambda: True)
+        next(stream)
+        stream.close()  # el cliente cortó la descarga
+
+        assert cache.get("fallos") is None and cache.get("cortado") is None
+        assert os.listdir(tmp_path) == []
+        assert cache.stats()["discarded"] == 2
+
+    def test_desalojo_lru_y_limite(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=25)
+        list(cache.store("a", _chunks(), cacheable=lambda: True))
+        list(cache.store("b", _chunks(), cacheable=lambda: True))
+        cache.get("a")
+        list(cache.store("c", _chunks(), cacheable=lambda: True))
+        assert cache.get("b") is None
+        assert cache.get("a") and cache.get("c")
+
+        # Un ZIP mayor que la caché se envía completo pero no se guarda
+        big = [b"x" * 20, b"y" * 20]
+        assert b"".join(cache.store("grande", iter(big), cacheable=lambda: True)) == b"".join(big)
+        assert cache.get("grande") is None
+
+    def test_purga_por_proyecto_y_recarga(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        list(cache.store("a", _chunks(), cacheable=lambda: True, project_code="UNO"))
+        list(cache.store("b", _chunks(), cacheable=lambda: True, project_code="DOS"))
+
+        reloaded = ArchiveCache(str(tmp_path), max_bytes=1024)
+        assert reloaded.purge("UNO") == 1
+        assert reloaded.get("a") is None and reloaded.get("b") is not None
+        assert reloaded.purge() == 1
+        assert os.listdir(tmp_path) == []
+
+
+    def test_entrada_fijada_no_se_borra_mientras_se_envia(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        list(cache.store("a", _chunks(), cacheable=lambda: True, project_code="UNO"))
+        path = cache.pin("a")
+        assert cache.stats()["pinned"] == 1
+
+        # Purgada durante el envío: sale del índice, pero el archivo sigue legible
+        assert cache.purge("UNO") == 1
+        assert cache.get("a") is None
+        with open(path, "rb") as f:
+            assert f.read() == b"PKcontenido"
+        cache.unpin("a")
+        assert not os.path.exists(path) and cache.stats()["pinned"] == 0
+
+    def test_entrada_fijada_y_guardada_otra_vez(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        list(cache.store("a", _chunks(), cacheable=lambda: True))
+        cache.pin("a")
+        cache.purge()
+        list(cache.store("a", _chunks(), cacheable=lambda: True))
+        cache.unpin("a")
+        # El archivo nuevo no se borra al terminar el envío del anterior
+        assert cache.get("a") is not None
+
+
+class TestPinnedFileResponse:
+    """El ZIP guardado se libera al terminar el envío, también si falla"""
+
+    def test_unpin_aunque_el_envio_falle(self, tmp_path):
+        path = tmp_path / "a.zip"
+        path.write_bytes(b"PK")
+        released = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            raise OSError("cliente desconectado")
+
+        response = _PinnedFileResponse(lambda: released.append(True), str(path), filename="a.zip")
+        scope = {"type": "http", "method": "GET", "headers": []}
+        with pytest.raises(OSError):
+            asyncio.run(response(scope, receive, send))
+        assert released == [True]
+
+
+class TestStreamZipSummary:
+    """stream_zip informa los fallos para decidir si el ZIP se guarda"""
+
+    def test_resumen_de_fallos(self, monkeypatch):
+        docs = [
+            {"codigo_proforma": "P-1", "tipo_documento": "Voucher", "url": "https://s3/x/a.pdf",
+             "codigo_unidad": "101", "tipo_unidad": "DPTO", "nombre_cliente": "ANA", "documento_cliente": "1"},
+            {"codigo_proforma": "P-2", "tipo_documento": "Minuta", "url": "https://s3/x/b.pdf",
+             "codigo_unidad": "102", "tipo_unidad": "DPTO", "nombre_cliente": "LUIS", "documento_cliente": "2"},
+        ]
+        monkeypatch.setattr(
+            zip_service_module.download_service, "download",
+            lambda url, *a, **k: None if url.endswith("b.pdf") else SpooledPayload(data=b"%PDF-1.4", size=8),
+        )
+        monkeypatch.setattr(zip_service_module.download_service, "content_length", lambda url, timeout=5: None)
+        summary = {}
+        list(ZipService.stream_zip(docs, project_code="PROY", summary=summary))
+        compression = summary.pop("compression")
+        assert summary == {"failed": 1, "processing_failed": 1}
+        assert compression["stored_entries"] + compression["deflated_entries"] == 3
+
+    def test_omitido_por_la_cache_negativa_cuenta_como_faltante(self, monkeypatch, tmp_path):
+        """Un ZIP al que le falta un documento de la caché negativa no se guarda"""
+        docs = [
+            {"codigo_proforma": "P-1", "tipo_documento": "Voucher", "url": "https://s3/x/a.pdf",
+             "codigo_unidad": "101", "tipo_unidad": "DPTO", "nombre_cliente": "ANA", "documento_cliente": "1"},
+            {"codigo_proforma": "P-2", "tipo_documento": "Minuta", "url": "https://s3/x/b.pdf",
+             "codigo_unidad": "102", "tipo_unidad": "DPTO", "nombre_cliente": "LUIS", "documento_cliente": "2"},
+        ]
+        negative = NegativeCache(ttl_seconds=60, max_entries=10)
+        negative.add("https://s3/x/b.pdf", 404)
+        monkeypatch.setattr(zip_service_module.download_service, "negative_cache", negative)
+        monkeypatch.setattr(
+            zip_service_module.download_service, "download",
+            lambda url, *a, **k: SpooledPayload(data=b"%PDF-1.4", size=8),
+        )
+        monkeypatch.setattr(zip_service_module.download_service, "content_length", lambda url, timeout=5: None)
+        cache = ArchiveCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+        summary = {}
+        # La misma condición que usa /download/zip/project
+        list(cache.store(
+            "k", ZipService.stream_zip(docs, project_code="PROY", summary=summary),
+            cacheable=lambda: summary.get("failed") == 0,
+        ))
+        assert (summary["failed"], summary["processing_failed"]) == (1, 0)
+        assert cache.get("k") is None
+
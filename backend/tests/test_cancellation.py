@@ -0,0 +1,182 @@
+"""
+Tests de la cancelación de ZIPs cuando el cliente se desconecta
+"""
+import os
+import sys
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.api.routes import _stream_until_disconnect
+from backend.core.cancellation import CancelToken, Cancelled, cancel_scope, cancellation_metrics, current_token
+from backend.services.archive_cache import ArchiveCache
+from backend.services.conversion_executor import ConversionExecutor
+from backend.services.zip_pipeline import ZipPipeline
+
+
+class TestCancelToken:
+    """Tests de CancelToken"""
+
+    def test_callbacks_y_scope(self):
+        token = CancelToken()
+        calls = []
+        with token.on_cancel(lambda: calls.append("bloque")):
+            pass
+        with token.on_cancel(lambda: calls.append("activo")):
+            token.cancel()
+            token.cancel()
+        # Registrado ya cancelado: se ejecuta de inmediato
+        with token.on_cancel(lambda: calls.append("tarde")):
+            pass
+        assert calls == ["activo", "tarde"]
+
+        assert current_token() is None
+        with cancel_scope(token):
+            assert current_token() is token
+            with pytest.raises(Cancelled):
+                token.raise_if_cancelled()
+        assert current_token() is None
+
+
+class TestPipelineCancellation:
+    """El pipeline se detiene al cancelarse y no descarga lo pendiente"""
+
+    def test_cancelar_detiene_descargas(self):
+        fetched = []
+        token = CancelToken()
+
+        def fetch(item):
+            fetched.append(item)
+            # Cada descarga ve el token del pipeline en su thread
+            assert current_token() is token
+            time.sleep(0.02)
+            return item
+
+        pipeline = ZipPipeline(
+            list(range(200)), fetch, lambda item, content: content,
+            download_workers=2, convert_workers=1, queue_depth=2,
+            cancel_token=token,
+        )
+        before = cancellation_metrics.stats()
+        results = pipeline.results()
+        assert next(results).index == 0
+        token.cancel()
+        with pytest.raises(Cancelled):
+            list(results)
+
+        after = cancellation_metrics.stats()
+        assert len(fetched) < 50
+        assert after["builds_cancelled"] == before["builds_cancelled"] + 1
+        skipped = after["documents_skipped"] - before["documents_skipped"]
+        assert skipped == 200 - len(fetched)
+        assert ZipPipeline.active_stats() == []
+
+    def test_detener_antes_de_terminar_corta_lo_en_curso(self):
+        seen = []
+
+        def fetch(item):
+            # Una descarga lenta que solo termina antes si se cancela
+            seen.append(current_token().wait(5))
+            return item
+
+        pipeline = ZipPipeline([1, 2], fetch, lambda item, content: content, download_workers=2)
+        outcome = []
+
+        def consume():
+            try:
+                list(pipeline.results())
+            except Cancelled:
+                outcome.append("cancelled")
+
+        consumer = threading.Thread(target=consume)
+        start = time.monotonic()
+        consumer.start()
+        time.sleep(0.1)
+        pipeline.stop()
+        consumer.join(timeout=5)
+        assert time.monotonic() - start < 2
+        assert seen == [True, True]
+        assert outcome == ["cancelled"]
+
+
+class TestConversionCancellation:
+    """Las conversiones en cola se retiran al cancelar"""
+
+    def test_conversion_en_cola_se_cancela(self):
+        executor = ConversionExecutor(processes=1, max_tasks_per_child=1, memory_limit_mb=0, timeout=10)
+        token = CancelToken()
+        queued = Future()
+        threading.Timer(0.05, token.cancel).start()
+        with cancel_scope(token), pytest.raises(Cancelled):
+            executor._wait(queued)
+        assert queued.cancelled()
+        assert executor.stats()["cancelled"] == 1
+
+
+class TestArchiveAbandon:
+    """El ZIP solo se cancela si nadie más lo está leyendo"""
+
+    def test_abandono_con_y_sin_seguidores(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        release = threading.Event()
+
+        def chunks():
+            yield b"PK"
+            release.wait(timeout=5)
+            yield b"resto"
+
+        leader = cache.store("k", chunks(), cacheable=lambda: True)
+        next(leader)
+        follower = cache.store("k", iter(()), cacheable=lambda: True)
+        next(follower)
+        cancelled = []
+        assert cache.abandon("k", lambda: cancelled.append("k")) is False
+
+        follower.close()
+        assert cache.abandon("k", lambda: cancelled.append("k")) is True
+        assert cancelled == ["k"]
+        # Una petición nueva ya no se suma a la construcción abandonada
+        fresh = cache.store("k", iter([b"nuevo"]), cacheable=lambda: True)
+        assert b"".join(fresh) == b"nuevo"
+        release.set()
+        leader.close()
+
+
+class TestStreamThreads:
+    """El ZIP en streaming no ocupa el executor por defecto del event loop"""
+
+    def test_next_en_threads_propios(self):
+        threads = []
+        closed = threading.Event()
+
+        def chunks():
+            try:
+                for chunk in (b"PK", b"resto", b"fin"):
+                    threads.append(threading.current_thread().name)
+                    yield chunk
+            finally:
+                closed.set()
+
+        disconnected = []
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            default = loop.run_in_executor(None, threading.current_thread)
+            stream = _stream_until_disconnect(chunks(), lambda: disconnected.append(True))
+            received = [await stream.__anext__(), await stream.__anext__()]
+            # El cliente corta: el generador se cierra y se avisa la desconexión
+            await stream.aclose()
+            return received, (await default).name
+
+        received, default_thread = asyncio.run(main())
+        assert received == [b"PK", b"resto"]
+        assert all(name.startswith("zip-stream") for name in threads)
+        assert not default_thread.startswith("zip-stream")
+        assert closed.wait(timeout=5) and disconnected == [True]
+
@@ -0,0 +1,110 @@
+"""
+Tests de la detección de tipo de archivo por cabecera
+"""
+import os
+import struct
+import sys
+import zipfile
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.utils.content_sniffer import sniff_content
+
+
+def _image_bytes(size, fmt, mode="RGB"):
+    buffer = BytesIO()
+    Image.new(mode, size, color="white" if mode == "L" else "blue").save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def _ooxml(folder):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("[Content_Types].xml", "<Types/>")
+        zf.writestr(f"{folder}/document.xml", "<x/>")
+    return buffer.getvalue()
+
+
+def _ole(stream_name):
+    """Cabecera OLE mínima con una entrada de directorio en el sector 0"""
+    header = bytearray(512)
+    header[:8] = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+    struct.pack_into("<H", header, 30, 9)  # sectores de 512 bytes
+    struct.pack_into("<I", header, 48, 0)  # directorio en el sector 0
+    entry = bytearray(128)
+    name = stream_name.encode("utf-16-le") + b"\x00\x00"
+    entry[:len(name)] = name
+    struct.pack_into("<H", entry, 64, len(name))
+    return bytes(header) + bytes(entry) + bytes(384)
+
+
+class TestSniffContent:
+    """Tests de sniff_content"""
+
+    @pytest.mark.parametrize("fmt,kind,extension", [
+        ("JPEG", "jpeg", ".jpg"),
+        ("PNG", "png", ".png"),
+        ("WEBP", "webp", ".webp"),
+        ("TIFF", "tiff", ".tiff"),
+    ])
+    def test_imagenes_con_dimensiones(self, fmt, kind, extension):
+        info = sniff_content(_image_bytes((321, 123), fmt))
+        assert (info.kind, info.width, info.height) == (kind, 321, 123)
+        assert info.extension == extension and info.is_image
+
+    def test_componentes_jpeg(self):
+        assert sniff_content(_image_bytes((10, 10), "JPEG", mode="L")).components == 1
+        assert sniff_content(_image_bytes((10, 10), "JPEG")).components == 3
+        assert sniff_content(_image_bytes((10, 10), "JPEG", mode="CMYK")).components == 4
+
+    def test_sof_y_precision_jpeg(self):
+        info = sniff_content(_image_bytes((10, 10), "JPEG"))
+        assert (info.sof_marker, info.precision, info.orientation) == (0xC0, 8, None)
+        buffer = BytesIO()
+        Image.new("RGB", (10, 10)).save(buffer, format="JPEG", progressive=True)
+        assert sniff_content(buffer.getvalue()).sof_marker == 0xC2
+
+    def test_orientacion_exif_jpeg(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        buffer = BytesIO()
+        Image.new("RGB", (10, 10)).save(buffer, format="JPEG", exif=exif.tobytes())
+        info = sniff_content(buffer.getvalue())
+        assert (info.orientation, info.width, info.height) == (6, 10, 10)
+
+    def test_webp_sin_perdida(self):
+        buffer = BytesIO()
+        Image.new("RGB", (70, 30)).save(buffer, format="WEBP", lossless=True)
+        info = sniff_content(buffer.getvalue())
+        assert (info.kind, info.width, info.height) == ("webp", 70, 30)
+
+    @pytest.mark.parametrize("folder,extension", [("word", ".docx"), ("xl", ".xlsx"), ("ppt", ".pptx")])
+    def test_ooxml(self, folder, extension):
+        assert sniff_content(_ooxml(folder)).extension == extension
+
+    def test_zip_generico(self):
+        info = sniff_content(_ooxml("otros"))
+        assert info.kind == "zip" and info.extension == ""
+
+    def test_ole(self):
+        assert sniff_content(_ole("WordDocument")).extension == ".doc"
+        assert sniff_content(_ole("Workbook")).kind == "xls"
+
+    def test_pdf_y_desconocido(self):
+        assert sniff_content(b"%PDF-1.7\n...").extension == ".pdf"
+        assert sniff_content(b"texto plano").kind == ""
+        assert sniff_content(b"").extension == ""
+
+    def test_cabecera_truncada(self):
+        """Una cabecera cortada conserva el tipo aunque no haya dimensiones"""
+        info = sniff_content(_image_bytes((50, 50), "PNG")[:20])
+        assert info.kind == "png" and info.pixels is None
+
+    def test_acepta_memoryview(self):
+        data = _image_bytes((40, 20), "PNG")
+        assert sniff_content(memoryview(data)).pixels == 800
@@ -0,0 +1,103 @@
+"""
+Tests del ejecutor de conversiones en pool de procesos
+"""
+import os
+import struct
+import sys
+import zlib
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.services.conversion_executor import ConversionExecutor
+
+
+def _png(width, height, color="red"):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), color=color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _png_bomb(width=60000, height=60000):
+    """PNG mínimo que declara dimensiones gigantes (bomba de descompresión)"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(b"")) + chunk(b"IEND", b"")
+
+
+@pytest.fixture(scope="module")
+def executor():
+    executor = ConversionExecutor(processes=2, max_tasks_per_child=2, memory_limit_mb=1024, timeout=60)
+    yield executor
+    executor.shutdown()
+
+
+class TestConversionExecutor:
+    """Tests de ConversionExecutor"""
+
+    def test_imagen_se_convierte_en_el_pool(self, executor):
+        result = executor.convert_to_pdf(_png(300, 200), "foto.png")
+        assert result["mode"] == "pdf"
+        assert result["content"].startswith(b"%PDF")
+        assert executor.stats()["completed"] >= 1
+
+    def test_pdf_se_resuelve_sin_pool(self, executor):
+        before = executor.stats()["inline"]
+        result = executor.convert_to_pdf(b"%PDF-1.4 contenido", "doc.pdf")
+        assert result == {"mode": "pdf", "content": b"%PDF-1.4 contenido", "extension": ".pdf"}
+        assert executor.stats()["inline"] == before + 1
+
+    def test_bomba_falla_solo_su_documento(self, executor):
+        """Una imagen desmesurada falla sin romper el pool"""
+        assert executor.convert_to_pdf(_png_bomb(), "bomba.png") is None
+        result = executor.convert_to_pdf(_png(50, 50), "ok.png")
+        assert result and result["mode"] == "pdf"
+        assert executor.stats()["worker_crashes"] == 0
+
+    def test_reciclaje_de_workers(self, executor):
+        """Varias conversiones seguidas funcionan aunque los workers se reciclen"""
+        for i in range(6):
+            assert executor.convert_to_pdf(_png(20 + i, 20), f"img{i}.png")["mode"] == "pdf"
+
+    def test_modo_sin_procesos(self):
+        inline = ConversionExecutor(processes=0, max_tasks_per_child=1, memory_limit_mb=0, timeout=10)
+        result = inline.convert_to_pdf(_png(10, 10), "x.png")
+        assert result["mode"] == "pdf"
+        assert inline.stats()["pool_running"] is False
+
+    def test_bomba_se_rechaza_antes_del_pool(self, executor):
+        """Las dimensiones de la cabecera bastan para rechazar sin enviar al pool"""
+        before = executor.stats()["submitted"]
+        assert executor.convert_to_pdf(_png_bomb(), "bomba.png") is None
+        assert executor.stats()["submitted"] == before
+
+    def test_timeout_termina_el_worker_colgado(self):
+        slow = ConversionExecutor(processes=1, max_tasks_per_child=10, memory_limit_mb=1024, timeout=60)
+        try:
+            assert slow.convert_to_pdf(_png(10, 10), "calentar.png")["mode"] == "pdf"
+            workers = list(slow._pool._processes.values())
+            slow.timeout = 0.001
+            assert slow.convert_to_pdf(_png(3000, 3000), "lenta.png") is None
+            stats = slow.stats()
+            assert stats["timeouts"] >= 1 and stats["pool_restarts"] >= 1
+            # El worker de la conversión vencida no sigue ocupando un proceso
+            for worker in workers:
+                worker.join(timeout=5)
+                assert not worker.is_alive()
+            slow.timeout = 60
+            assert slow.convert_to_pdf(_png(20, 20), "ok.png")["mode"] == "pdf"
+        finally:
+            slow.shutdown()
+
+    def test_jpeg_incrustable_no_pasa_por_el_pool(self, executor):
+        buffer = BytesIO()
+        Image.new("RGB", (200, 100)).save(buffer, format="JPEG")
+        before = executor.stats()["inline"]
+        result = executor.convert_to_pdf(buffer.getvalue(), "foto.jpg")
+        assert b"/DCTDecode" in result["content"]
+        assert executor.stats()["inline"] == before + 1
@@ -0,0 +1,213 @@
+"""
+Tests de la caché en disco de documentos convertidos
+"""
+import io
+import os
+import sys
+import zipfile
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.core.spool import SpooledPayload
+from backend.services import document_cache as document_cache_module
+from backend.services import zip_service as zip_service_module
+from backend.services.document_cache import DocumentCache, TMP_PREFIX
+from backend.services.pdf_service import PDFService
+from backend.services.zip_service import ZipService
+
+
+def _png(color="red"):
+    buffer = BytesIO()
+    Image.new("RGB", (40, 30), color=color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def conversions(monkeypatch):
+    """Convierte en el mismo proceso y cuenta las conversiones que producen contenido nuevo"""
+    calls = []
+
+    class _Executor:
+        @staticmethod
+        def convert_to_pdf(content, original_filename=None):
+            result = PDFService.convert_to_pdf(content, original_filename)
+            if result and result["content"] is not content:
+                calls.append(original_filename)
+            return result
+
+    monkeypatch.setattr(document_cache_module, "conversion_executor", _Executor)
+    return calls
+
+
+class TestDocumentCache:
+    """Tests de DocumentCache"""
+
+    def test_guardar_y_leer(self, tmp_path):
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        key = cache.content_key(b"original")
+        assert cache.get(key) is None
+        assert cache.put(key, b"%PDF-1.4 convertido", ".pdf")
+
+        payload, extension = cache.get(key)
+        with payload:
+            assert extension == ".pdf"
+            assert payload.buffer()[:] == b"%PDF-1.4 convertido"
+        # Cerrar el payload no elimina la entrada
+        assert os.path.exists(tmp_path / f"{key}.pdf")
+        assert not [name for name in os.listdir(tmp_path) if name.startswith(TMP_PREFIX)]
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["stores"], stats["entries"]) == (1, 1, 1, 1)
+
+    def test_desalojo_lru(self, tmp_path):
+        cache = DocumentCache(str(tmp_path), max_bytes=250)
+        keys = [cache.content_key(bytes([i])) for i in range(3)]
+        cache.put(keys[0], b"a" * 100, ".pdf")
+        cache.put(keys[1], b"b" * 100, ".pdf")
+        cache.get(keys[0])[0].close()  # keys[0] pasa a ser la más reciente
+        cache.put(keys[2], b"c" * 100, ".pdf")
+
+        assert cache.get(keys[1]) is None
+        assert not os.path.exists(tmp_path / f"{keys[1]}.pdf")
+        for key in (keys[0], keys[2]):
+            cache.get(key)[0].close()
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["bytes"] == 200
+
+    def test_entrada_abierta_sobrevive_al_desalojo(self, tmp_path):
+        cache = DocumentCache(str(tmp_path), max_bytes=150)
+        first, second = cache.content_key(b"1"), cache.content_key(b"2")
+        cache.put(first, b"x" * 100, ".pdf")
+        payload, _ = cache.get(first)
+        cache.put(second, b"y" * 100, ".pdf")
+        with payload:
+            assert payload.buffer()[:] == b"x" * 100
+
+    def test_recarga_desde_disco(self, tmp_path):
+        cache = DocumentCache(str(tmp_path), max_bytes=1024)
+        key = cache.content_key(b"persistente")
+        cache.put(key, b"%PDF-1.4", ".pdf")
+        (tmp_path / f"{TMP_PREFIX}interrumpida").write_bytes(b"basura")
+
+        reloaded = DocumentCache(str(tmp_path), max_bytes=1024)
+        payload, _ = reloaded.get(key)
+        with payload:
+            assert payload.buffer()[:] == b"%PDF-1.4"
+        assert not (tmp_path / f"{TMP_PREFIX}interrumpida").exists()
+
+    def test_imagen_se_convierte_una_sola_vez(self, tmp_path, conversions):
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        image = _png()
+        first = cache.convert_to_pdf(image, "foto.png")
+        second = cache.convert_to_pdf(image, "otra.png")
+
+        assert conversions == ["foto.png"]
+        assert "payload" not in first
+        with second["payload"]:
+            assert second["mode"] == "pdf" and second["extension"] == ".pdf"
+            assert second["content"][:] == first["content"]
+
+    def test_pdf_no_pasa_por_la_cache(self, tmp_path, conversions):
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        content = b"%PDF-1.4 original"
+        assert cache.convert_to_pdf(content, "a.pdf")["content"] is content
+        assert cache.stats()["stores"] == 0 and cache.stats()["misses"] == 0
+
+    def test_zip_usa_la_cache(self, tmp_path, conversions, monkeypatch):
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        monkeypatch.setattr(zip_service_module, "document_cache", cache)
+        image = _png("blue")
+        monkeypatch.setattr(
+            zip_service_module.download_service, "download",
+            lambda url, *a, **k: SpooledPayload(data=image, size=len(image)),
+        )
+        docs = [{"codigo_proforma": "P-1", "tipo_documento": "Voucher", "url": "https://s3/x/foto.png",
+                 "codigo_unidad": "101", "tipo_unidad": "DPTO", "nombre_cliente": "ANA", "documento_cliente": "1"}]
+
+        archives = [b"".join(ZipService.stream_zip(docs, project_code="PROY")) for _ in range(2)]
+        assert conversions == ["foto.png"]
+        contents = []
+        for data in archives:
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                pdfs = [name for name in zf.namelist() if name.endswith(".pdf")]
+                contents.append(zf.read(pdfs[0]))
+        assert contents[0] == contents[1] and contents[0].startswith(b"%PDF")
+        assert cache.stats()["hits"] == 1
+
+
+class TestRevalidation:
+    """Revalidación de documentos guardados con GET condicional"""
+
+    class _Downloads:
+        """download_service simulado: 304 si los validadores coinciden con el ETag actual"""
+
+        def __init__(self, body, etag='"v1"'):
+            self.body = body
+            self.etag = etag
+            self.requests = []
+
+        def download(self, url, budget=None, validators=None):
+            self.requests.append(validators)
+            if validators and validators.get("etag") == self.etag:
+                payload = SpooledPayload()
+                payload.not_modified = True
+                return payload
+            payload = SpooledPayload(data=self.body, size=len(self.body))
+            payload.validators = {"etag": self.etag, "last_modified": None}
+            return payload
+
+    def _export(self, cache, url):
+        """Lo que hace cada exportación: fetch + conversión"""
+        download = cache.fetch(url)
+        result = cache.convert_to_pdf(download.buffer(), url.rsplit("/", 1)[-1], url=url, validators=download.validators)
+        content = bytes(result["content"])
+        download.close()
+        if "payload" in result:
+            result["payload"].close()
+        return content
+
+    def test_304_reutiliza_la_conversion(self, tmp_path, conversions, monkeypatch):
+        downloads = self._Downloads(_png("green"))
+        monkeypatch.setattr(document_cache_module, "download_service", downloads)
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        url = "https://s3/x/foto.png"
+
+        first = self._export(cache, url)
+        second = self._export(cache, url)
+        assert first == second and first.startswith(b"%PDF")
+        assert downloads.requests == [None, {"etag": '"v1"', "last_modified": None}]
+        assert conversions == ["foto.png"]
+        assert cache.stats()["not_modified_hits"] == 1
+
+    def test_pdf_con_etag_se_guarda_y_revalida(self, tmp_path, conversions, monkeypatch):
+        downloads = self._Downloads(b"%PDF-1.4 contrato")
+        monkeypatch.setattr(document_cache_module, "download_service", downloads)
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        url = "https://s3/x/contrato.pdf"
+
+        assert self._export(cache, url) == b"%PDF-1.4 contrato"
+        assert self._export(cache, url) == b"%PDF-1.4 contrato"
+        assert cache.stats()["not_modified_hits"] == 1
+
+        # El documento cambió: el 200 trae el contenido y los validadores nuevos
+        downloads.body, downloads.etag = b"%PDF-1.4 contrato v2", '"v2"'
+        assert self._export(cache, url) == b"%PDF-1.4 contrato v2"
+        assert cache.validators_for(url)["etag"] == '"v2"'
+        assert cache.size_hint(url) == len(b"%PDF-1.4 contrato v2")
+        assert cache.size_hint("https://s3/x/otro.pdf") is None
+
+    def test_entrada_desalojada_descarga_de_nuevo(self, tmp_path, conversions, monkeypatch):
+        downloads = self._Downloads(b"%PDF-1.4 acta")
+        monkeypatch.setattr(document_cache_module, "download_service", downloads)
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        url = "https://s3/x/acta.pdf"
+        self._export(cache, url)
+        cache.clear()
+
+        assert cache.validators_for(url) is None
+        assert self._export(cache, url) == b"%PDF-1.4 acta"
+        assert downloads.requests == [None, None]
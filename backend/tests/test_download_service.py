@@ -0,0 +1,715 @@
+"""
+Tests del servicio de descargas contra un servidor HTTP local
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.services import download_service as download_service_module
+from backend.core.cancellation import CancelToken, Cancelled, cancel_scope, cancellation_metrics
+from backend.core.circuit_breaker import CircuitBreaker, HostCircuitBreakers, CLOSED, OPEN
+from backend.core.hedging import HedgeBudget
+from backend.core.host_throughput import HostThroughput
+from backend.core.negative_cache import NegativeCache
+from backend.core.retry import RetryPolicy
+from backend.core.scheduler import FairScheduler
+from backend.core.spool import SpoolWriter
+from backend.services.download_service import CHUNK_SIZE, DownloadService
+
+FILES = {
+    "/small.pdf": b"%PDF-1.4 " + b"x" * 1000,
+    "/big.bin": b"\0" * (3 * 1024 * 1024),
+}
+
+# Se envían con Transfer-Encoding: chunked (sin Content-Length)
+CHUNKED_FILES = {
+    "/chunked-big.bin": b"\1" * (3 * 1024 * 1024),
+    "/chunked-medium.pdf": b"%PDF-1.4 " + b"m" * (1536 * 1024),
+}
+
+
+# Anuncian Accept-Ranges; /ranged/ responde los Range con 206 y /norange/ los ignora (200 completo)
+RANGED_BODY = bytes(range(256)) * (10 * 1024 + 3)
+
+ETAG = '"v1"'
+
+
+def _service(retries=3, failure_threshold=5, reset_timeout=30, throughput=None, **kwargs):
+    """DownloadService con reintentos sin espera y estado propio del test"""
+    return DownloadService(
+        retry_policy=RetryPolicy(max_attempts=retries, base_delay=0, max_delay=0),
+        circuit_breakers=HostCircuitBreakers(failure_threshold, reset_timeout),
+        negative_cache=NegativeCache(ttl_seconds=60, max_entries=100),
+        throughput=throughput or HostThroughput(alpha=0.2, safety_factor=4, min_timeout=5, max_timeout=120),
+        **kwargs,
+    )
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_GET(self):
+        self.server.methods.append("GET")
+        if self.path.startswith("/status/"):
+            # /status/<código>[/<fallos antes de responder 200>]
+            parts = self.path.split("/")
+            failures = int(parts[3]) if len(parts) > 3 else 10 ** 6
+            self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+            code = int(parts[2]) if self.server.hits[self.path] <= failures else 200
+            body = b"%PDF-1.4 ok" if code == 200 else b""
+            self.send_response(code)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith("/stall/"):
+            # La primera petición a la ruta tarda 1 s en responder; las siguientes, nada
+            self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+            if self.server.hits[self.path] == 1:
+                time.sleep(1)
+            body = b"%PDF-1.4 stall"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        if self.path == "/slow.bin":
+            # Content-Length de 512 KB enviado en 8 partes con pausas
+            self.send_response(200)
+            self.send_header("Content-Length", str(512 * 1024))
+            self.end_headers()
+            try:
+                for _ in range(8):
+                    self.wfile.write(b"s" * (64 * 1024))
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        if self.path.startswith("/etag/"):
+            # ETag fijo: 304 si el cliente ya tiene esa versión
+            self.server.statuses.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == ETAG:
+                self.send_response(304)
+                self.send_header("ETag", ETAG)
+                self.end_headers()
+                return
+            body = FILES["/small.pdf"]
+            self.send_response(200)
+            self.send_header("ETag", ETAG)
+            self.send_header("Last-Modified", "Tue, 06 Oct 2026 10:00:00 GMT")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith(("/ranged/", "/norange/")):
+            self._send_ranged(honor_range=self.path.startswith("/ranged/"))
+            return
+        if self.path in CHUNKED_FILES:
+            self._send_chunked(CHUNKED_FILES[self.path])
+            return
+        body = FILES.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_ranged(self, honor_range):
+        requested = self.headers.get("Range")
+        self.server.ranges.append(requested)
+        body, status, content_range = RANGED_BODY, 200, None
+        if requested and honor_range:
+            start, end = (int(v) for v in requested[len("bytes="):].split("-"))
+            body, status = RANGED_BODY[start:end + 1], 206
+            content_range = f"bytes {start}-{end}/{len(RANGED_BODY)}"
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_chunked(self, body):
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for start in range(0, len(body), 256 * 1024):
+                part = body[start:start + 256 * 1024]
+                self.wfile.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_HEAD(self):
+        self.server.methods.append("HEAD")
+        body = FILES.get(self.path)
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Length", str(len(body)) if body is not None else "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.methods = []
+    httpd.hits = {}
+    httpd.ranges = []
+    httpd.statuses = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+class TestDownloadService:
+    """Tests de DownloadService"""
+
+    def test_reutiliza_conexiones_sin_head(self, server):
+        httpd, base = server
+        service = _service(pool_size=4)
+        for _ in range(5):
+            assert service.download_file(f"{base}/small.pdf") == FILES["/small.pdf"]
+
+        assert httpd.methods == ["GET"] * 5
+        host = service.stats()["hosts"][base]
+        assert host["requests"] == 5
+        assert host["connections_opened"] == 1
+        assert host["connections_reused"] == 4
+        assert host["idle_connections"] == 1
+        assert service.stats()["downloads"] == 5
+
+    def test_limite_de_tamano_por_content_length(self, server, monkeypatch):
+        _, base = server
+        monkeypatch.setattr(download_service_module.settings, "MAX_FILE_SIZE_MB", 2)
+        service = _service(pool_size=2)
+        assert service.download_file(f"{base}/big.bin") is None
+        assert service.stats()["too_large"] == 1
+
+    def test_error_http(self, server):
+        _, base = server
+        service = _service(pool_size=2)
+        assert service.download_file(f"{base}/missing.pdf") is None
+        assert service.stats()["failed"] == 1
+
+    def test_limite_de_tamano_sin_content_length(self, server, monkeypatch):
+        """Sin Content-Length la descarga se corta apenas se supera el límite"""
+        _, base = server
+        monkeypatch.setattr(download_service_module.settings, "MAX_FILE_SIZE_MB", 2)
+        service = _service(pool_size=2)
+        assert service.download(f"{base}/chunked-big.bin") is None
+        assert service.stats()["too_large"] == 1
+
+    def test_archivo_grande_se_descarga_a_disco(self, server):
+        _, base = server
+        service = _service(pool_size=2, memory_threshold_mb=1)
+        payload = service.download(f"{base}/chunked-medium.pdf")
+        with payload:
+            assert payload.spilled
+            assert payload.buffer()[:] == CHUNKED_FILES["/chunked-medium.pdf"]
+        assert service.stats()["spilled"] == 1
+
+    def test_archivo_pequeno_queda_en_memoria(self, server):
+        _, base = server
+        service = _service(pool_size=2)
+        with service.download(f"{base}/small.pdf") as payload:
+            assert not payload.spilled
+            assert payload.buffer() == FILES["/small.pdf"]
+
+    def test_content_length_con_head(self, server):
+        httpd, base = server
+        service = _service(scheduler=FairScheduler("test", 4))
+        assert service.content_length(f"{base}/small.pdf") == len(FILES["/small.pdf"])
+        assert service.content_length(f"{base}/no-existe.pdf") is None
+        assert httpd.methods == ["HEAD", "HEAD"]
+        assert service.stats()["size_probes"] == 2
+        assert service.scheduler.stats()["in_use"] == 0
+
+    def test_content_length_sin_cupo_libre_no_envia_head(self, server):
+        httpd, base = server
+        service = _service(scheduler=FairScheduler("test", 1))
+        with service.scheduler.slot():
+            assert service.content_length(f"{base}/small.pdf") is None
+        assert httpd.methods == []
+        assert service.stats()["size_probes"] == 0
+
+
+class TestDownloadServiceAsync:
+    """Tests del motor asyncio"""
+
+    def test_descargas_concurrentes_reutilizan_el_cliente(self, server):
+        httpd, base = server
+        service = _service(pool_size=4)
+
+        async def run():
+            payloads = await asyncio.gather(*(service.download_async(f"{base}/small.pdf") for _ in range(6)))
+            clients = service.stats()["async_clients"]
+            await service.aclose()
+            return payloads, clients
+
+        payloads, clients = asyncio.run(run())
+        assert [p.buffer() for p in payloads] == [FILES["/small.pdf"]] * 6
+        assert clients == 1
+        assert httpd.methods == ["GET"] * 6
+        assert service.stats()["async_downloads"] == 6
+
+    def test_aclose_no_detiene_los_threads_compartidos(self, server):
+        _, base = server
+        service = _service(pool_size=2)
+        executor = service._get_executor()
+        # Un hedge o rango de otra descarga en curso mientras un pipeline async termina
+        pending = executor.submit(time.sleep, 0.2)
+
+        async def run():
+            await service.download_async(f"{base}/small.pdf")
+            await service.aclose()
+
+        asyncio.run(run())
+        assert pending.result(timeout=5) is None
+        assert service._get_executor() is executor
+        with service.download(f"{base}/small.pdf") as payload:
+            assert payload.buffer() == FILES["/small.pdf"]
+
+        service.shutdown()
+        assert executor._shutdown
+
+    def test_limite_y_errores(self, server, monkeypatch):
+        _, base = server
+        monkeypatch.setattr(download_service_module.settings, "MAX_FILE_SIZE_MB", 2)
+        service = _service(pool_size=2)
+
+        async def run():
+            results = [
+                await service.download_async(f"{base}/big.bin"),
+                await service.download_async(f"{base}/chunked-big.bin"),
+                await service.download_async(f"{base}/missing.pdf"),
+            ]
+            await service.aclose()
+            return results
+
+        assert asyncio.run(run()) == [None, None, None]
+        assert service.stats()["too_large"] == 2
+        assert service.stats()["failed"] == 3
+
+    def test_archivo_grande_a_disco(self, server):
+        _, base = server
+        service = _service(pool_size=2, memory_threshold_mb=1)
+
+        async def run():
+            payload = await service.download_async(f"{base}/chunked-medium.pdf")
+            await service.aclose()
+            return payload
+
+        with asyncio.run(run()) as payload:
+            assert payload.spilled
+            assert payload.buffer()[:] == CHUNKED_FILES["/chunked-medium.pdf"]
+
+
+class TestRetriesAndCircuitBreaker:
+    """Reintentos con backoff y circuit breaker por host"""
+
+    def test_5xx_transitorio_se_reintenta(self, server):
+        httpd, base = server
+        service = _service(retries=3)
+        assert service.download_file(f"{base}/status/503/2") == b"%PDF-1.4 ok"
+        assert httpd.hits["/status/503/2"] == 3
+        assert service.stats()["retries"] == 2
+
+    def test_403_y_404_fallan_sin_reintentar(self, server):
+        httpd, base = server
+        service = _service(retries=3)
+        assert service.download_file(f"{base}/status/403") is None
+        assert service.download_file(f"{base}/status/404") is None
+        assert httpd.hits == {"/status/403": 1, "/status/404": 1}
+        assert service.stats()["retries"] == 0
+
+    def test_async_reintenta_igual(self, server):
+        httpd, base = server
+        service = _service(retries=2)
+
+        async def run():
+            payload = await service.download_async(f"{base}/status/502/1")
+            await service.aclose()
+            return payload
+
+        with asyncio.run(run()) as payload:
+            assert payload.buffer() == b"%PDF-1.4 ok"
+        assert httpd.hits["/status/502/1"] == 2
+
+    def test_circuito_abierto_corta_peticiones(self, server):
+        httpd, base = server
+        service = _service(retries=1, failure_threshold=3)
+        for _ in range(3):
+            assert service.download_file(f"{base}/status/500") is None
+        assert service.download_file(f"{base}/small.pdf") is None
+        assert httpd.methods.count("GET") == 3
+        breaker = service.stats()["circuit_breakers"][base.replace("http://", "")]
+        assert breaker["state"] == OPEN and breaker["rejected_total"] == 1
+        assert service.stats()["circuit_rejected"] == 1
+
+
+class TestCircuitBreaker:
+    """Tests de CircuitBreaker"""
+
+    def test_half_open_deja_pasar_una_prueba(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr("backend.core.circuit_breaker.time.monotonic", lambda: now[0])
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+        assert not breaker.allow()
+
+        now[0] += 10
+        assert breaker.allow()
+        assert not breaker.allow()  # solo una prueba a la vez
+        breaker.record_failure()
+        assert breaker.state == OPEN and not breaker.allow()
+
+        now[0] += 10
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CLOSED and breaker.allow()
+
+    def test_backoff_con_jitter_acotado(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=3)
+        for attempt, ceiling in [(1, 0.5), (2, 1.0), (3, 2.0), (4, 3.0), (5, 3.0)]:
+            assert all(0 <= policy.backoff(attempt) <= ceiling for _ in range(50))
+        assert RetryPolicy.is_retryable_status(503) and RetryPolicy.is_retryable_status(429)
+        assert not RetryPolicy.is_retryable_status(403) and not RetryPolicy.is_retryable_status(404)
+
+
+class TestNegativeCache:
+    """Caché negativa de URLs con fallos permanentes"""
+
+    def test_403_no_vuelve_a_tocar_la_red(self, server):
+        httpd, base = server
+        service = _service()
+        url = f"{base}/status/403"
+        assert service.download_file(url) is None
+        assert service.download_file(url) is None
+
+        async def run():
+            return await service.download_async(url)
+
+        assert asyncio.run(run()) is None
+        assert httpd.hits["/status/403"] == 1
+        assert service.cached_failure(url) == 403
+        assert service.stats()["negative_cache_hits"] == 3
+
+    def test_fallos_transitorios_no_se_recuerdan(self, server):
+        httpd, base = server
+        service = _service(retries=1)
+        url = f"{base}/status/503"
+        service.download_file(url)
+        service.download_file(url)
+        assert httpd.hits["/status/503"] == 2
+        assert service.negative_cache.stats()["entries"] == 0
+
+    def test_expiracion_y_limite(self, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr("backend.core.negative_cache.time.monotonic", lambda: now[0])
+        cache = NegativeCache(ttl_seconds=10, max_entries=2)
+        cache.add("a", 403)
+        cache.add("b", 404)
+        cache.add("c", 410)
+        assert cache.get("a") is None  # descartada por el límite
+        assert cache.get("b") == 404
+        now[0] = 11
+        assert cache.get("c") is None
+        assert NegativeCache(ttl_seconds=0, max_entries=2).get("x") is None
+
+
+class TestAdaptiveTimeouts:
+    """Timeouts derivados del TTFB y ancho de banda observados por host"""
+
+    def test_estimaciones_y_timeouts_derivados(self):
+        throughput = HostThroughput(alpha=0.5, safety_factor=3, min_timeout=1, max_timeout=60)
+        assert throughput.timeouts("s3", 10, 30) == (10, 30)
+        assert throughput.transfer_timeout("s3", 2_000_000) == 10  # regla fija sin estimación
+
+        throughput.observe("s3", ttfb=0.5, nbytes=1_000_000, transfer_seconds=1.0)
+        throughput.observe("s3", ttfb=1.5, nbytes=3_000_000, transfer_seconds=1.0)
+        estimate = throughput.stats()["s3"]
+        assert estimate["ttfb_seconds"] == 1.0
+        assert estimate["bytes_per_second"] == 2_000_000
+        assert throughput.timeouts("s3", 10, 30) == (3.0, 3.0)
+        # 3 x (1 s de TTFB + 4 MB a 2 MB/s)
+        assert throughput.transfer_timeout("s3", 4_000_000) == 9.0
+        assert throughput.transfer_timeout("s3", 10 ** 10) == 60
+
+    def test_archivos_pequenos_no_estiman_ancho_de_banda(self):
+        throughput = HostThroughput(alpha=0.5, safety_factor=3, min_timeout=1, max_timeout=60)
+        throughput.observe("s3", ttfb=0.2, nbytes=1000, transfer_seconds=0.001)
+        assert throughput.stats()["s3"]["bytes_per_second"] is None
+
+    def test_descarga_registra_estimacion(self, server):
+        _, base = server
+        service = _service()
+        service.download_file(f"{base}/big.bin")
+        estimate = service.stats()["host_estimates"][base.replace("http://", "")]
+        assert estimate["samples"] == 1 and estimate["bytes_per_second"] > 0
+
+    def test_transferencia_lenta_se_corta_con_enlace_sano(self, server):
+        _, base = server
+        host = base.replace("http://", "")
+        throughput = HostThroughput(alpha=1, safety_factor=2, min_timeout=0.1, max_timeout=1)
+        throughput.observe(host, ttfb=0.01, nbytes=1024 * 1024, transfer_seconds=0.01)
+        service = _service(retries=1, throughput=throughput)
+
+        started = time.monotonic()
+        assert service.download_file(f"{base}/slow.bin") is None
+        assert time.monotonic() - started < 0.7
+        assert service.stats()["deadline_exceeded"] == 1
+
+        async def run():
+            payload = await service.download_async(f"{base}/slow.bin")
+            await service.aclose()
+            return payload
+
+        assert asyncio.run(run()) is None
+        assert service.stats()["deadline_exceeded"] == 2
+
+
+class TestHedging:
+    """Hedged requests: segundo GET cuando el primero supera el p95 de TTFB"""
+
+    @staticmethod
+    def _hedging_service(base, ratio=1.0):
+        throughput = HostThroughput(alpha=0.2, safety_factor=4, min_timeout=5, max_timeout=120)
+        for _ in range(20):
+            throughput.observe(base.replace("http://", ""), ttfb=0.01, nbytes=100, transfer_seconds=0.01)
+        return _service(throughput=throughput, hedging=True, hedge_budget=HedgeBudget(ratio=ratio, max_in_flight=2))
+
+    def test_hedge_gana_al_get_estancado(self, server):
+        httpd, base = server
+        service = self._hedging_service(base)
+        started = time.monotonic()
+        assert service.download_file(f"{base}/stall/sync") == b"%PDF-1.4 stall"
+        assert time.monotonic() - started < 0.8
+        assert httpd.hits["/stall/sync"] == 2
+        stats = service.stats()
+        assert stats["hedges"] == 1 and stats["hedges_won"] == 1
+        assert stats["hedge_budget"]["issued_total"] == 1
+
+    def test_hedge_async(self, server):
+        httpd, base = server
+        service = self._hedging_service(base)
+
+        async def run():
+            started = time.monotonic()
+            payload = await service.download_async(f"{base}/stall/async")
+            elapsed = time.monotonic() - started
+            await service.aclose()
+            return payload, elapsed
+
+        payload, elapsed = asyncio.run(run())
+        with payload:
+            assert payload.buffer() == b"%PDF-1.4 stall"
+        assert elapsed < 0.8
+        assert service.stats()["hedges_won"] == 1
+
+    def test_sin_presupuesto_no_hay_hedge(self, server):
+        httpd, base = server
+        service = self._hedging_service(base, ratio=0)
+        assert service.download_file(f"{base}/stall/budget") == b"%PDF-1.4 stall"
+        assert httpd.hits["/stall/budget"] == 1
+        assert service.stats()["hedges"] == 0
+        assert service.stats()["hedge_budget"]["rejected_total"] == 1
+
+    def test_presupuesto_de_tokens(self):
+        budget = HedgeBudget(ratio=0.5, max_in_flight=1)
+        budget.record_request()
+        assert not budget.try_acquire()
+        budget.record_request()
+        assert budget.try_acquire()
+        budget.record_request()
+        budget.record_request()
+        assert not budget.try_acquire()  # ya hay un hedge en curso
+        budget.release()
+        assert budget.try_acquire()
+
+
+class TestRangedDownloads:
+    """Descarga por rangos en paralelo de archivos grandes"""
+
+    def test_rangos_en_paralelo(self, server):
+        httpd, base = server
+        service = _service(ranged_threshold_mb=1, ranged_parts=4)
+        with service.download(f"{base}/ranged/sync.bin") as payload:
+            assert payload.spilled
+            assert payload.buffer()[:] == RANGED_BODY
+        # El GET original aporta la primera parte; las otras 3 se piden con Range
+        assert httpd.ranges[0] is None
+        assert sorted(r for r in httpd.ranges if r) == sorted(
+            f"bytes={start}-{end}" for start, end in service._split_ranges(len(RANGED_BODY), 4)[1:]
+        )
+        stats = service.stats()
+        assert stats["ranged_downloads"] == 1 and stats["ranged_parts"] == 4
+        assert stats["ranged_fallbacks"] == 0
+
+    def test_rangos_async(self, server):
+        httpd, base = server
+        service = _service(ranged_threshold_mb=1, ranged_parts=3)
+
+        async def run():
+            payload = await service.download_async(f"{base}/ranged/async.bin")
+            await service.aclose()
+            return payload
+
+        with asyncio.run(run()) as payload:
+            assert payload.buffer()[:] == RANGED_BODY
+        assert len([r for r in httpd.ranges if r]) == 2
+        assert service.stats()["ranged_downloads"] == 1
+
+    def test_servidor_que_ignora_range_usa_el_get_completo(self, server):
+        _, base = server
+        service = _service(ranged_threshold_mb=1, ranged_parts=4)
+        with service.download(f"{base}/norange/sync.bin") as payload:
+            assert payload.buffer()[:] == RANGED_BODY
+        stats = service.stats()
+        assert stats["ranged_fallbacks"] == 1 and stats["downloads"] == 1
+
+        async def run():
+            payload = await service.download_async(f"{base}/norange/async.bin")
+            await service.aclose()
+            return payload
+
+        with asyncio.run(run()) as payload:
+            assert payload.buffer()[:] == RANGED_BODY
+        assert service.stats()["ranged_fallbacks"] == 2
+
+    def test_partes_limitadas_por_los_cupos_libres(self, server):
+        httpd, base = server
+        # Con 2 cupos por host, el GET original ocupa uno y queda uno para un rango
+        service = _service(ranged_threshold_mb=1, ranged_parts=4, scheduler=FairScheduler("test", 8, max_per_host=2))
+        assert service.download_file(f"{base}/ranged/two.bin") == RANGED_BODY
+        assert len([r for r in httpd.ranges if r]) == 1
+        assert service.stats()["ranged_parts"] == 2
+        assert service.scheduler.stats()["in_use"] == 0
+
+    def test_sin_cupos_libres_descarga_sin_rangos(self, server):
+        httpd, base = server
+        service = _service(ranged_threshold_mb=1, ranged_parts=4, scheduler=FairScheduler("test", 8, max_per_host=1))
+        assert service.download_file(f"{base}/ranged/one.bin") == RANGED_BODY
+        assert httpd.ranges == [None]
+        assert service.stats()["ranged_downloads"] == 0
+
+    def test_cuerpo_mas_largo_que_content_length_sigue_sin_rangos(self, server):
+        _, base = server
+        service = _service(ranged_parts=2, scheduler=FairScheduler("test", 8))
+        body = RANGED_BODY + b"extra"
+        chunks = iter([body[:CHUNK_SIZE], body[CHUNK_SIZE:-1], body[-1:]])
+        with SpoolWriter(0) as writer:
+            payload = service._download_ranged(
+                f"{base}/ranged/long.bin", chunks, len(RANGED_BODY), (5, 5), time.monotonic() + 30, writer
+            )
+            assert payload is None
+            # Lo recibido pasó a writer y el resto del cuerpo sigue en chunks
+            for chunk in chunks:
+                writer.write(chunk)
+            with writer.finish() as payload:
+                assert payload.buffer()[:] == body
+        assert service.stats()["ranged_fallbacks"] == 1
+
+    def test_bajo_el_umbral_no_usa_rangos(self, server):
+        httpd, base = server
+        service = _service(ranged_threshold_mb=0)
+        assert service.download_file(f"{base}/ranged/off.bin") == RANGED_BODY
+        assert httpd.ranges == [None]
+        assert service.stats()["ranged_downloads"] == 0
+
+
+class TestConditionalGet:
+    """GET condicional con los validadores de una descarga anterior"""
+
+    def test_304_con_etag(self, server):
+        httpd, base = server
+        service = _service()
+        with service.download(f"{base}/etag/a.pdf") as first:
+            assert first.buffer() == FILES["/small.pdf"]
+            assert first.validators == {"etag": ETAG, "last_modified": "Tue, 06 Oct 2026 10:00:00 GMT"}
+
+        second = service.download(f"{base}/etag/a.pdf", validators=first.validators)
+        assert second.not_modified and second.size == 0
+        assert second.validators["etag"] == ETAG
+        assert httpd.statuses == [None, ETAG]
+
+        stale = service.download(f"{base}/etag/a.pdf", validators={"etag": '"v0"', "last_modified": None})
+        with stale:
+            assert not stale.not_modified and stale.buffer() == FILES["/small.pdf"]
+        stats = service.stats()
+        assert stats["not_modified"] == 1 and stats["downloads"] == 2
+
+    def test_304_async(self, server):
+        _, base = server
+        service = _service()
+
+        async def run():
+            payload = await service.download_async(f"{base}/etag/b.pdf", validators={"etag": ETAG})
+            await service.aclose()
+            return payload
+
+        assert asyncio.run(run()).not_modified
+        stats = service.stats()
+        assert stats["not_modified"] == 1 and stats["async_downloads"] == 0
+
+
+class TestCancellation:
+    """Una descarga se corta al cancelarse el token activo"""
+
+    def test_descarga_cancelada_se_corta(self, server):
+        _, base = server
+        service = _service(pool_size=2)
+        token = CancelToken()
+        before = cancellation_metrics.stats()
+        threading.Timer(0.15, token.cancel).start()
+        start = time.monotonic()
+        with cancel_scope(token), pytest.raises(Cancelled):
+            service.download(f"{base}/slow.bin")
+        assert time.monotonic() - start < 0.6
+        after = cancellation_metrics.stats()
+        assert after["downloads_aborted"] == before["downloads_aborted"] + 1
+        assert after["download_bytes_avoided"] > before["download_bytes_avoided"]
+        # No cuenta como fallo del host
+        assert service.stats()["failed"] == 0
+
+    def test_async_cancelada_se_corta(self, server):
+        _, base = server
+        service = _service(pool_size=2)
+        token = CancelToken()
+
+        async def run():
+            asyncio.get_running_loop().call_later(0.15, token.cancel)
+            try:
+                with pytest.raises(Cancelled):
+                    await service.download_async(f"{base}/slow.bin")
+            finally:
+                await service.aclose()
+
+        with cancel_scope(token):
+            asyncio.run(run())
@@ -0,0 +1,124 @@
+"""
+Tests del presupuesto de memoria compartido y del spill a disco
+"""
+import os
+import sys
+import threading
+import time
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.core.memory_budget import ByteBudget
+from backend.core.spool import SpooledPayload, SpoolWriter
+
+
+class TestByteBudget:
+    """Tests de ByteBudget"""
+
+    def test_reserva_y_libera(self):
+        budget = ByteBudget(100)
+        assert budget.acquire(60, timeout=0)
+        assert budget.in_use == 60
+        assert not budget.acquire(50, timeout=0)
+        budget.release(60)
+        assert budget.acquire(50, timeout=0)
+        stats = budget.stats()
+        assert stats["in_use_bytes"] == 50
+        assert stats["peak_bytes"] == 60
+        assert stats["rejected_total"] == 1
+
+    def test_bloque_mayor_al_limite_se_rechaza(self):
+        """Un bloque que nunca cabría no bloquea al worker"""
+        budget = ByteBudget(10)
+        start = time.monotonic()
+        assert not budget.acquire(11, timeout=5)
+        assert time.monotonic() - start < 1
+
+    def test_espera_hasta_que_se_libere(self):
+        """Un worker bloqueado continúa cuando otro libera bytes"""
+        budget = ByteBudget(100)
+        budget.acquire(100)
+        result = {}
+
+        def worker():
+            result["ok"] = budget.acquire(40, timeout=5)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.1)
+        assert budget.stats()["waiting_workers"] == 1
+        budget.release(100)
+        thread.join(2)
+        assert result["ok"]
+        assert budget.in_use == 40
+
+
+class TestSpooledPayload:
+    """Tests de SpooledPayload"""
+
+    def test_en_memoria_libera_presupuesto(self):
+        budget = ByteBudget(1024)
+        payload = SpooledPayload.hold(b"x" * 100, budget, timeout=0)
+        assert not payload.spilled
+        assert budget.in_use == 100
+        assert bytes(payload.buffer()) == b"x" * 100
+        payload.close()
+        assert budget.in_use == 0
+
+    def test_spill_a_disco_sin_presupuesto(self):
+        budget = ByteBudget(10)
+        data = os.urandom(4096)
+        payload = SpooledPayload.hold(data, budget, timeout=0)
+        assert payload.spilled
+        assert budget.in_use == 0
+        path = payload._path
+        assert os.path.exists(path)
+        assert payload.buffer()[:] == data
+        payload.close()
+        assert not os.path.exists(path)
+
+
+class TestSpoolWriter:
+    """Tests de SpoolWriter"""
+
+    def test_pequeno_queda_en_memoria_con_reserva_exacta(self):
+        budget = ByteBudget(10 * 1024 * 1024)
+        with SpoolWriter(memory_limit=1024 * 1024, budget=budget) as writer:
+            for _ in range(4):
+                writer.write(b"a" * 1000)
+            payload = writer.finish()
+        assert not payload.spilled
+        assert budget.in_use == 4000
+        assert payload.buffer() == b"a" * 4000
+        payload.close()
+        assert budget.in_use == 0
+
+    def test_supera_umbral_y_continua_en_disco(self):
+        budget = ByteBudget(10 * 1024 * 1024)
+        with SpoolWriter(memory_limit=1500, budget=budget) as writer:
+            writer.write(b"a" * 1000)
+            writer.write(b"b" * 1000)
+            assert writer.spilled
+            assert budget.in_use == 0
+            writer.write(b"c" * 10)
+            payload = writer.finish()
+        with payload:
+            assert payload.spilled
+            assert bytes(payload.buffer()) == b"a" * 1000 + b"b" * 1000 + b"c" * 10
+
+    def test_sin_presupuesto_va_a_disco(self):
+        budget = ByteBudget(100)
+        writer = SpoolWriter(memory_limit=1024 * 1024, budget=budget)
+        writer.write(b"x" * 50)
+        assert writer.spilled
+        with writer.finish() as payload:
+            assert payload.size == 50
+
+    def test_descartar_elimina_el_archivo(self):
+        writer = SpoolWriter(memory_limit=0)
+        writer.write(b"x" * 10)
+        path = writer._path
+        assert os.path.exists(path)
+        writer.discard()
+        assert not os.path.exists(path)
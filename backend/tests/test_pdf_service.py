@@ -0,0 +1,121 @@
+"""
+Tests de la conversión de imágenes a PDF
+"""
+import os
+import re
+import sys
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.services.pdf_service import PDFService
+from backend.utils.content_sniffer import ContentInfo
+
+
+def _image_bytes(size, mode="RGB", fmt="JPEG"):
+    buffer = BytesIO()
+    Image.new(mode, size, color="white" if mode == "L" else "blue").save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def _assert_xref_valida(pdf: bytes):
+    """Cada entrada del xref apunta al inicio de su objeto"""
+    startxref = int(re.search(rb"startxref\n(\d+)", pdf).group(1))
+    assert pdf[startxref:].startswith(b"xref")
+    offsets = re.findall(rb"(\d{10}) 00000 n ", pdf[startxref:])
+    for number, offset in enumerate(offsets, start=1):
+        assert pdf[int(offset):].startswith(f"{number} 0 obj".encode())
+
+
+class TestJpegPassthrough:
+    """El JPEG original se incrusta sin recodificar cuando no requiere resize"""
+
+    def test_jpeg_rgb_se_incrusta_tal_cual(self):
+        jpeg = _image_bytes((800, 600))
+        pdf = PDFService.image_to_pdf(jpeg)
+        assert pdf.startswith(b"%PDF-1.4")
+        assert b"/Filter /DCTDecode" in pdf
+        assert b"/ColorSpace /DeviceRGB" in pdf
+        assert jpeg in pdf
+        _assert_xref_valida(pdf)
+
+    def test_jpeg_escala_de_grises(self):
+        jpeg = _image_bytes((300, 400), mode="L")
+        pdf = PDFService.image_to_pdf(jpeg)
+        assert b"/ColorSpace /DeviceGray" in pdf
+        assert jpeg in pdf
+
+    def test_jpeg_grande_usa_ruta_general(self):
+        """Un JPEG mayor que A4 a 300 DPI se redimensiona y no se incrusta"""
+        jpeg = _image_bytes((2600, 1000))
+        pdf = PDFService.image_to_pdf(jpeg)
+        assert pdf.startswith(b"%PDF")
+        assert jpeg not in pdf
+
+    def test_jpeg_progresivo_se_incrusta(self):
+        buffer = BytesIO()
+        Image.new("RGB", (200, 100), color="blue").save(buffer, format="JPEG", progressive=True)
+        jpeg = buffer.getvalue()
+        assert jpeg in PDFService.image_to_pdf(jpeg)
+
+    def test_jpeg_rotado_por_exif_se_recodifica_derecho(self, monkeypatch):
+        """Con orientación 6 se aplica la rotación: la página muestra la foto en vertical"""
+        placement = PDFService._a4_placement
+        sizes = []
+        monkeypatch.setattr(PDFService, "_a4_placement", staticmethod(lambda w, h: sizes.append((w, h)) or placement(w, h)))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        buffer = BytesIO()
+        Image.new("RGB", (400, 200), color="blue").save(buffer, format="JPEG", exif=exif.tobytes())
+        jpeg = buffer.getvalue()
+        pdf = PDFService.image_to_pdf(jpeg)
+        assert jpeg not in pdf and b"DCTDecode" not in pdf
+        assert sizes == [(200, 400)]
+
+    @pytest.mark.parametrize("marker, precision", [(0xC3, 8), (0xC9, 8), (0xCA, 8), (0xC1, 12)])
+    def test_jpeg_no_huffman_8_bits_no_se_incrusta(self, marker, precision):
+        """Lossless, aritméticos o de 12 bits no se describen bien con DCTDecode de 8 bits"""
+        info = ContentInfo("jpeg", 800, 600, 3, marker, precision)
+        assert not PDFService.can_embed_jpeg(info)
+        assert PDFService.can_embed_jpeg(ContentInfo("jpeg", 800, 600, 3, 0xC2, 8, 1))
+
+    def test_png_usa_ruta_general(self):
+        png = _image_bytes((100, 100), fmt="PNG")
+        pdf = PDFService.image_to_pdf(png)
+        assert pdf.startswith(b"%PDF")
+        assert b"DCTDecode" not in pdf
+
+    def test_ubicacion_igual_a_ruta_general(self):
+        """La imagen queda centrada y escalada igual que con reportlab"""
+        x, y, width, height = PDFService._a4_placement(800, 600)
+        pdf = PDFService.image_to_pdf(_image_bytes((800, 600)))
+        assert f"{width:.4f} 0 0 {height:.4f} {x:.4f} {y:.4f} cm".encode() in pdf
+
+
+class TestDraftDownscale:
+    """Reducción en la decodificación para fotos grandes"""
+
+    def test_jpeg_grande_se_decodifica_reducido(self):
+        """5000x4000 se decodifica a 1/2 (2500x2000) y luego se ajusta al A4"""
+        image = Image.open(BytesIO(_image_bytes((5000, 4000))))
+        optimized = PDFService._optimize_image_for_pdf(image)
+        assert image.size == (2500, 2000)
+        assert optimized.size == (2480, 1984)
+
+    def test_escala_no_baja_del_objetivo(self):
+        """La reducción elige la potencia de dos que deja la imagen >= objetivo"""
+        image = Image.open(BytesIO(_image_bytes((4960, 3000))))
+        optimized = PDFService._optimize_image_for_pdf(image)
+        assert image.size[0] >= optimized.size[0] and image.size[1] >= optimized.size[1]
+        assert optimized.size == (2480, 1500)
+
+    def test_limite_de_pixeles(self, monkeypatch):
+        """Imágenes por encima de MAX_IMAGE_PIXELS se rechazan sin decodificarse"""
+        from backend.services import pdf_service as pdf_service_module
+        monkeypatch.setattr(pdf_service_module.settings, "MAX_IMAGE_PIXELS", 100 * 100)
+        assert PDFService.image_to_pdf(_image_bytes((101, 100))) is None
+        assert PDFService.image_to_pdf(_image_bytes((100, 100))) is not None
@@ -0,0 +1,257 @@
+"""
+Tests del planificador global con colas justas ponderadas
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.core.cancellation import CancelToken, Cancelled, cancel_scope
+from backend.core.scheduler import FairScheduler, Flow, flow_scope
+from backend.services.zip_pipeline import ZipPipeline
+
+
+def _run_flow(scheduler, flow, count, order, hold=0.01, host=None):
+    """Lanza count threads del flujo que toman un cupo y anotan el orden de concesión"""
+
+    def task():
+        with flow_scope(flow), scheduler.slot(host):
+            order.append(flow.name)
+            time.sleep(hold)
+
+    threads = [threading.Thread(target=task) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _wait_queued(scheduler, waiting):
+    deadline = time.monotonic() + 5
+    while scheduler.stats()["waiting"] < waiting:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+class TestFairScheduler:
+    """Tests de FairScheduler"""
+
+    def test_limite_global_y_por_host(self):
+        scheduler = FairScheduler("test", max_concurrency=4, max_per_host=2)
+        lock = threading.Lock()
+        active = {"total": 0, "a": 0, "max_total": 0, "max_a": 0}
+
+        def task(host):
+            with scheduler.slot(host):
+                with lock:
+                    active["total"] += 1
+                    active[host] = active.get(host, 0) + 1
+                    active["max_total"] = max(active["max_total"], active["total"])
+                    active["max_a"] = max(active["max_a"], active["a"])
+                time.sleep(0.02)
+                with lock:
+                    active["total"] -= 1
+                    active[host] -= 1
+
+        threads = [threading.Thread(target=task, args=(host,)) for host in ["a"] * 8 + ["b", "c", "d"] * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert active["max_total"] == 4
+        assert active["max_a"] == 2
+        stats = scheduler.stats()
+        assert stats["grants"] == 17 and stats["in_use"] == 0 and stats["per_host"] == {}
+
+    def test_trabajo_pequeno_no_espera_al_grande(self):
+        scheduler = FairScheduler("test", max_concurrency=1)
+        order = []
+        blocker = threading.Event()
+
+        def hold():
+            # Ocupa el único cupo hasta que ambos flujos estén encolados
+            with scheduler.slot():
+                blocker.wait(timeout=5)
+
+        first = threading.Thread(target=hold)
+        first.start()
+        while scheduler.stats()["in_use"] == 0:
+            time.sleep(0.005)
+        big, small = Flow("big"), Flow("small")
+        threads = _run_flow(scheduler, big, 20, order)
+        _wait_queued(scheduler, 20)
+        threads += _run_flow(scheduler, small, 3, order)
+        _wait_queued(scheduler, 23)
+        blocker.set()
+        for thread in [first] + threads:
+            thread.join()
+
+        # Los cupos se alternan: el flujo pequeño termina en las primeras concesiones
+        last_small = max(i for i, name in enumerate(order) if name == "small")
+        assert last_small < 8
+        assert order.count("big") == 20
+
+    def test_peso_reparte_los_cupos(self):
+        scheduler = FairScheduler("test", max_concurrency=1)
+        order = []
+        blocker = threading.Event()
+
+        def hold():
+            with scheduler.slot():
+                blocker.wait(timeout=5)
+
+        first = threading.Thread(target=hold)
+        first.start()
+        while scheduler.stats()["in_use"] == 0:
+            time.sleep(0.005)
+        heavy, light = Flow("heavy", weight=2.0), Flow("light", weight=1.0)
+        threads = _run_flow(scheduler, heavy, 12, order, hold=0)
+        threads += _run_flow(scheduler, light, 12, order, hold=0)
+        _wait_queued(scheduler, 24)
+        blocker.set()
+        for thread in [first] + threads:
+            thread.join()
+
+        # Con el doble de peso, heavy recibe unos dos tercios de los primeros cupos
+        assert 7 <= order[:12].count("heavy") <= 9
+
+    def test_cancelar_mientras_espera(self):
+        scheduler = FairScheduler("test", max_concurrency=1)
+        token = CancelToken()
+        outcome = []
+
+        def waiter():
+            with cancel_scope(token):
+                try:
+                    with scheduler.slot():
+                        outcome.append("granted")
+                except Cancelled:
+                    outcome.append("cancelled")
+
+        with scheduler.slot():
+            thread = threading.Thread(target=waiter)
+            thread.start()
+            _wait_queued(scheduler, 1)
+            token.cancel()
+            thread.join(timeout=5)
+            assert outcome == ["cancelled"]
+        stats = scheduler.stats()
+        assert stats["withdrawn"] == 1 and stats["waiting"] == 0 and stats["in_use"] == 0
+
+    def test_cupos_libres_sin_esperar(self):
+        scheduler = FairScheduler("test", max_concurrency=3, max_per_host=2)
+        with scheduler.slot("a"):
+            with scheduler.spare_slots("a", 4) as extra:
+                # El host "a" solo tenía un cupo más
+                assert extra == 1
+                assert scheduler.stats()["in_use"] == 2
+            with scheduler.spare_slots("b", 4) as extra:
+                assert extra == 2
+        assert scheduler.stats()["in_use"] == 0
+
+    def test_cupos_libres_no_adelantan_a_la_cola(self):
+        scheduler = FairScheduler("test", max_concurrency=1)
+        order = []
+        with scheduler.slot():
+            threads = _run_flow(scheduler, Flow("cola"), 1, order, hold=0.2)
+            _wait_queued(scheduler, 1)
+        # El pedido en cola ya tiene el cupo liberado: no queda ninguno libre
+        with scheduler.spare_slots(None, 1) as extra:
+            assert extra == 0
+        for thread in threads:
+            thread.join()
+        assert order == ["cola"]
+
+    def test_slot_async(self):
+        scheduler = FairScheduler("test", max_concurrency=2, max_per_host=1)
+        peak = {"active": 0, "max": 0}
+
+        async def task(host):
+            async with scheduler.slot_async(host):
+                peak["active"] += 1
+                peak["max"] = max(peak["max"], peak["active"])
+                await asyncio.sleep(0.01)
+                peak["active"] -= 1
+
+        async def main():
+            await asyncio.gather(*(task(host) for host in ["a", "a", "a", "b", "b"]))
+            # Una espera cancelada por asyncio no deja el cupo tomado
+            async with scheduler.slot_async("a"):
+                pending = asyncio.ensure_future(task("a"))
+                await asyncio.sleep(0.01)
+                pending.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await pending
+
+        asyncio.run(main())
+        assert peak["max"] == 2
+        stats = scheduler.stats()
+        assert stats["in_use"] == 0 and stats["waiting"] == 0 and stats["grants"] == 6
+
+
+class TestPipelineFlow:
+    """Las etapas del pipeline piden cupos como flujo del pipeline"""
+
+    def test_workers_heredan_el_flujo(self):
+        scheduler = FairScheduler("test", max_concurrency=2)
+        seen = []
+
+        def fetch(item):
+            with scheduler.slot():
+                seen.append(scheduler.stats()["in_use"])
+            return item
+
+        pipeline = ZipPipeline(
+            list(range(10)), fetch, lambda item, content: content,
+            download_workers=4, name="zip-flow", weight=0.5,
+        )
+        assert [r.value for r in pipeline.results()] == list(range(10))
+        # Cuatro workers, pero nunca más de dos descargas a la vez, todas del flujo del pipeline
+        assert max(seen) <= 2
+        assert pipeline.flow.weight == 0.5 and scheduler.stats()["grants"] == 10
+
+    def test_descargas_y_conversiones_del_mismo_flujo(self):
+        downloads = FairScheduler("downloads", max_concurrency=1)
+        conversions = FairScheduler("conversion", max_concurrency=1)
+        flow = Flow("zip")
+        blocker = threading.Event()
+        done = []
+
+        def hold():
+            with flow_scope(flow), downloads.slot():
+                blocker.wait(timeout=5)
+
+        def download():
+            with flow_scope(flow), downloads.slot():
+                done.append("download")
+
+        def convert():
+            with flow_scope(flow), conversions.slot():
+                done.append("convert")
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        while downloads.stats()["in_use"] == 0:
+            time.sleep(0.005)
+        # Con descargas del flujo en espera, la conversión no depende de ellas
+        queued = threading.Thread(target=download)
+        queued.start()
+        _wait_queued(downloads, 1)
+        converter = threading.Thread(target=convert)
+        converter.start()
+        converter.join(timeout=5)
+        assert done == ["convert"]
+        blocker.set()
+        for thread in (holder, queued):
+            thread.join(timeout=5)
+
+        assert done == ["convert", "download"]
+        for scheduler, grants in ((downloads, 2), (conversions, 1)):
+            stats = scheduler.stats()
+            assert stats["in_use"] == 0 and stats["waiting"] == 0 and stats["grants"] == grants
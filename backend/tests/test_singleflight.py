@@ -0,0 +1,242 @@
+"""
+Tests de la coalescencia de operaciones idénticas concurrentes
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.core.memory_budget import ByteBudget
+from backend.core.singleflight import SingleFlight
+from backend.core.spool import SpooledPayload
+from backend.services import document_cache as document_cache_module
+from backend.services.archive_cache import ArchiveCache
+from backend.services.document_cache import DocumentCache
+
+
+def _run_concurrently(count, target):
+    """Lanza count threads que llaman a target() a la vez y devuelve sus resultados"""
+    results = [None] * count
+    start = threading.Barrier(count)
+
+    def worker(index):
+        start.wait()
+        results[index] = target()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results
+
+
+class TestSingleFlight:
+    """Tests de SingleFlight"""
+
+    def test_llamadas_concurrentes_se_ejecutan_una_vez(self):
+        flight = SingleFlight("test")
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return [{"id": 1}]
+
+        results = _run_concurrently(5, lambda: flight.do("k", slow, share=lambda rows: [dict(r) for r in rows]))
+        assert len(calls) == 1
+        assert all(r == [{"id": 1}] for r in results)
+        # Cada llamador recibe su propia copia
+        assert len({id(r) for r in results}) == 5
+        stats = flight.stats()
+        assert (stats["leaders"], stats["followers"], stats["in_flight"]) == (1, 4, 0)
+
+    def test_error_se_propaga_a_todos_y_no_queda_en_curso(self):
+        flight = SingleFlight("test")
+
+        def failing():
+            time.sleep(0.1)
+            raise ValueError("falló")
+
+        def call():
+            try:
+                flight.do("k", failing)
+            except ValueError as e:
+                return str(e)
+
+        assert _run_concurrently(3, call) == ["falló"] * 3
+        assert flight.do("k", lambda: "ok") == "ok"
+
+    def test_claves_distintas_no_se_coalescen(self):
+        flight = SingleFlight("test")
+        assert flight.do("a", lambda: 1) == 1
+        assert flight.do("b", lambda: 2) == 2
+        assert flight.stats()["followers"] == 0
+
+    def test_async_comparte_con_threads(self):
+        flight = SingleFlight("test")
+        calls = []
+        started = threading.Event()
+
+        async def leader():
+            calls.append(1)
+            started.set()
+            await asyncio.sleep(0.2)
+            return "resultado"
+
+        thread_result = []
+        follower = threading.Thread(
+            target=lambda: (started.wait(), thread_result.append(flight.do("k", lambda: "otro")))
+        )
+        follower.start()
+
+        async def main():
+            return await asyncio.gather(
+                flight.do_async("k", leader),
+                flight.do_async("k", leader),
+            )
+
+        assert asyncio.run(main()) == ["resultado", "resultado"]
+        follower.join(timeout=5)
+        assert thread_result == ["resultado"]
+        assert len(calls) == 1
+
+    def test_lider_cancelado_los_seguidores_reintentan(self):
+        flight = SingleFlight("test")
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return len(calls)
+
+        async def main():
+            leader = asyncio.ensure_future(flight.do_async("k", work))
+            await asyncio.sleep(0.05)
+            follower = asyncio.ensure_future(flight.do_async("k", work))
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        assert asyncio.run(main()) == 2
+
+
+class TestSharedPayloads:
+    """Descargas compartidas: cada llamador cierra su propio payload"""
+
+    @pytest.mark.parametrize("spilled", [False, True])
+    def test_share_sobrevive_al_cierre_del_original(self, spilled):
+        original = SpooledPayload.spill(b"contenido") if spilled else SpooledPayload(data=b"contenido", size=9)
+        original.validators = {"etag": '"v1"', "last_modified": None}
+        shared = original.share()
+        original.close()
+        with shared:
+            assert bytes(shared.buffer()) == b"contenido"
+            assert shared.validators["etag"] == '"v1"'
+
+    def test_share_mantiene_la_reserva_hasta_el_ultimo_cierre(self):
+        budget = ByteBudget(100)
+        original = SpooledPayload.hold(b"contenido", budget, timeout=0)
+        shared = [original.share(), original.share()]
+        original.close()
+        shared[0].close()
+        # El último payload sigue leyendo los bytes: la reserva sigue tomada
+        assert budget.in_use == 9
+        assert bytes(shared[1].buffer()) == b"contenido"
+        shared[1].close()
+        shared[1].close()
+        assert budget.in_use == 0
+
+    def test_fetch_concurrente_descarga_una_vez(self, tmp_path, monkeypatch):
+        calls = []
+
+        class _Downloads:
+            @staticmethod
+            def download(url, budget=None, validators=None):
+                calls.append(url)
+                time.sleep(0.2)
+                return SpooledPayload.spill(b"%PDF-1.4 compartido")
+
+        monkeypatch.setattr(document_cache_module, "download_service", _Downloads)
+        cache = DocumentCache(str(tmp_path), max_bytes=1024 * 1024)
+        payloads = _run_concurrently(4, lambda: cache.fetch("https://s3/x/a.pdf"))
+
+        assert calls == ["https://s3/x/a.pdf"]
+        for payload in payloads:
+            assert bytes(payload.buffer()) == b"%PDF-1.4 compartido"
+        for payload in payloads:
+            payload.close()
+        assert cache.stats()["coalesced_downloads"]["followers"] == 3
+
+
+class TestSharedArchiveBuilds:
+    """Peticiones concurrentes del mismo ZIP comparten la construcción"""
+
+    @staticmethod
+    def _slow_zip(built, release):
+        def chunks():
+            built.append(1)
+            yield b"PK"
+            release.wait(timeout=5)
+            yield b"resto"
+        return chunks()
+
+    def test_seguidor_lee_la_construccion_en_curso(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        built, release = [], threading.Event()
+
+        leader = cache.store("k", self._slow_zip(built, release), cacheable=lambda: True)
+        assert next(leader) == b"PK"
+        follower = cache.store("k", self._slow_zip(built, release), cacheable=lambda: True)
+        assert next(follower) == b"PK"
+
+        release.set()
+        assert b"".join(leader) == b"resto"
+        assert b"".join(follower) == b"resto"
+        assert built == [1]
+        assert cache.get("k") is not None
+        assert cache.stats()["coalesced"] == 1
+
+    def test_corte_del_primero_no_corta_al_seguidor(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+        built, release = [], threading.Event()
+
+        leader = cache.store("k", self._slow_zip(built, release), cacheable=lambda: True)
+        next(leader)
+        follower = cache.store("k", self._slow_zip(built, release), cacheable=lambda: True)
+        next(follower)
+        leader.close()  # el primer cliente cortó la descarga
+
+        release.set()
+        assert b"".join(follower) == b"resto"
+        assert built == [1]
+        assert cache.stats()["handoffs"] == 1
+        deadline = time.monotonic() + 5
+        while cache.get("k") is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.get("k") is not None
+
+    def test_fallo_de_la_construccion_llega_al_seguidor(self, tmp_path):
+        cache = ArchiveCache(str(tmp_path), max_bytes=1024)
+
+        def broken():
+            yield b"PK"
+            raise RuntimeError("fallo")
+
+        leader = cache.store("k", broken(), cacheable=lambda: True)
+        next(leader)
+        follower = cache.store("k", iter([b"no se usa"]), cacheable=lambda: True)
+        assert next(follower) == b"PK"
+        with pytest.raises(RuntimeError):
+            list(leader)
+        with pytest.raises(RuntimeError):
+            list(follower)
+        assert cache.get("k") is None
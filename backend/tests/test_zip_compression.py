@@ -0,0 +1,180 @@
+"""
+Tests de la política de compresión por entrada del ZIP
+"""
+import io
+import os
+import sys
+import threading
+import zipfile
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.core.cancellation import CancelToken, Cancelled, cancel_scope
+from backend.core.spool import SpooledPayload
+from backend.services import zip_service as zip_service_module
+from backend.services.zip_compression import CompressionPolicy, FAST_LEVEL
+from backend.services.zip_service import ZipService
+from backend.utils.zip_stream import CompressionReport, ZipStreamWriter, ZIP_DEFLATED, ZIP_STORED, prepare_entry
+
+RANDOM_PDF = b"%PDF-1.4\n" + os.urandom(200 * 1024)
+TEXT = ("Voucher de pago de la unidad DPTO-101\n" * 5000).encode()
+# Un 13% de ceros entre bytes aleatorios: comprime poco, pero algo
+MIXED = b"".join(os.urandom(870) + b"\0" * 130 for _ in range(200))
+JPEG = b"\xff\xd8\xff\xe0" + b"\0" * 10000
+
+
+def _policy(mode="auto"):
+    return CompressionPolicy(mode=mode, level=6, sample_bytes=64 * 1024, min_savings=0.05)
+
+
+class TestCompressionPolicy:
+    """Tests de CompressionPolicy"""
+
+    def test_decision_por_contenido(self):
+        policy = _policy()
+        report = CompressionReport()
+        assert policy.choose(RANDOM_PDF, report) == (ZIP_STORED, 0)
+        assert policy.choose(TEXT, report) == (ZIP_DEFLATED, 6)
+        assert policy.choose(MIXED, report) == (ZIP_DEFLATED, FAST_LEVEL)
+        # Formato ya comprimido: ni siquiera se muestrea
+        assert policy.choose(JPEG, report) == (ZIP_STORED, 0)
+        assert policy.choose(b"", report) == (ZIP_STORED, 0)
+        assert report.sample_seconds > 0
+
+    def test_modos_fijos(self):
+        assert _policy("store").choose(TEXT) == (ZIP_STORED, 0)
+        assert _policy("deflate").choose(RANDOM_PDF) == (ZIP_DEFLATED, 6)
+        assert _policy("otro").mode == "auto"
+
+
+class TestCompressionReport:
+    """El writer anota ahorro y CPU por entrada"""
+
+    def test_reporte_del_writer(self):
+        report = CompressionReport()
+        writer = ZipStreamWriter(report=report)
+        data = b"".join(writer.add("a.pdf", RANDOM_PDF, compress_type=ZIP_STORED))
+        data += b"".join(writer.add("b.txt", TEXT, compress_type=ZIP_DEFLATED))
+        data += b"".join(writer.close())
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.read("b.txt") == TEXT
+            saved = zf.getinfo("b.txt").file_size - zf.getinfo("b.txt").compress_size
+        stats = report.as_dict()
+        assert (stats["stored_entries"], stats["deflated_entries"]) == (1, 1)
+        assert stats["bytes_saved"] == saved > 0
+        assert stats["input_bytes"] == len(RANDOM_PDF) + len(TEXT)
+        assert stats["compress_cpu_seconds"] >= 0
+
+
+class TestPreparedEntries:
+    """Entradas comprimidas fuera del writer y agregadas ya comprimidas"""
+
+    def test_preparadas_en_paralelo_y_concatenadas(self):
+        contents = {f"doc{i}.txt": TEXT + str(i).encode() for i in range(6)}
+        contents["foto.pdf"] = RANDOM_PDF
+        prepared = {}
+
+        def prepare(name, data):
+            method = ZIP_STORED if name == "foto.pdf" else ZIP_DEFLATED
+            output = bytearray()
+            entry = prepare_entry(data, method, 6, output.extend)
+            prepared[name] = (bytes(output) if method == ZIP_DEFLATED else data, entry)
+
+        threads = [threading.Thread(target=prepare, args=item) for item in contents.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        report = CompressionReport()
+        writer = ZipStreamWriter(report=report)
+        data = b"".join(writer.add("README.txt", b"hola"))
+        for name in contents:
+            data += b"".join(writer.add_prepared(name, *prepared[name]))
+        data += b"".join(writer.close())
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.testzip() is None
+            assert zf.getinfo("foto.pdf").compress_type == zipfile.ZIP_STORED
+            for name, content in contents.items():
+                assert zf.read(name) == content
+        assert (report.stored_entries, report.deflated_entries) == (1, 7)
+        assert report.bytes_saved > 0
+
+    def test_metodo_no_soportado(self):
+        try:
+            prepare_entry(TEXT, 99)
+            assert False, "Se esperaba ValueError"
+        except ValueError:
+            pass
+
+    def test_cancelar_libera_payload_en_disco(self):
+        # El payload mapeado se cierra aunque la excepción siga referenciando las vistas
+        payload = SpooledPayload.spill(TEXT * 10)
+        path = payload._path
+        token = CancelToken()
+        token.cancel()
+        with cancel_scope(token), pytest.raises(Cancelled):
+            ZipService._prepare_entry("doc.txt", payload, CompressionReport())
+        assert not os.path.exists(path)
+
+
+class TestStreamZipCompression:
+    """stream_zip aplica la política a cada entrada y la informa en summary"""
+
+    def test_pdf_comprimido_se_guarda_sin_deflate(self, monkeypatch):
+        monkeypatch.setattr(zip_service_module.download_service, "content_length", lambda url, timeout=5: None)
+        monkeypatch.setattr(
+            zip_service_module.download_service, "download",
+            lambda url, *a, **k: SpooledPayload(data=RANDOM_PDF, size=len(RANDOM_PDF)),
+        )
+        monkeypatch.setattr(zip_service_module, "compression_policy", _policy())
+        docs = [{"codigo_proforma": "P-1", "tipo_documento": "Voucher", "url": "https://s3/x/a.pdf",
+                 "codigo_unidad": "101", "tipo_unidad": "DPTO", "nombre_cliente": "ANA", "documento_cliente": "1"}]
+        summary = {}
+        data = b"".join(ZipService.stream_zip(docs, project_code="PROY", summary=summary))
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            pdf = [info for info in zf.infolist() if info.filename.endswith(".pdf")][0]
+            assert pdf.compress_type == zipfile.ZIP_STORED
+            assert zf.getinfo("_00_INFO_TALE/README.txt").compress_type == zipfile.ZIP_DEFLATED
+        compression = summary["compression"]
+        assert (compression["stored_entries"], compression["deflated_entries"]) == (1, 1)
+        assert compression["bytes_saved"] > 0
+
+    def test_compresion_en_los_workers_de_conversion(self, monkeypatch):
+        """Cada documento se comprime en un worker de conversión; el writer solo copia"""
+        monkeypatch.setattr(zip_service_module.download_service, "content_length", lambda url, timeout=5: None)
+        body = b"%PDF-1.4\n" + TEXT
+        monkeypatch.setattr(
+            zip_service_module.download_service, "download",
+            lambda url, *a, **k: SpooledPayload(data=body, size=len(body)),
+        )
+        monkeypatch.setattr(zip_service_module, "compression_policy", _policy())
+        threads = []
+        original = zip_service_module.prepare_entry
+
+        def recording_prepare(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return original(*args, **kwargs)
+
+        monkeypatch.setattr(zip_service_module, "prepare_entry", recording_prepare)
+        docs = [
+            {"codigo_proforma": f"P-{i}", "tipo_documento": "Voucher", "url": f"https://s3/x/{i}.pdf",
+             "codigo_unidad": str(100 + i), "tipo_unidad": "DPTO", "nombre_cliente": "ANA", "documento_cliente": str(i)}
+            for i in range(4)
+        ]
+        summary = {}
+        data = b"".join(ZipService.stream_zip(docs, project_code="PROY", summary=summary))
+
+        assert len(threads) == 4 and all("-convert-" in name for name in threads)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            pdfs = [info for info in zf.infolist() if info.filename.endswith(".pdf")]
+            assert len(pdfs) == 4
+            assert all(info.compress_type == zipfile.ZIP_DEFLATED for info in pdfs)
+            assert all(zf.read(info) == body for info in pdfs)
+        assert summary["compression"]["deflated_entries"] == 5
@@ -0,0 +1,207 @@
+"""
+Tests de los trabajos de ZIP en segundo plano
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.services import zip_jobs as zip_jobs_module
+from backend.services.archive_cache import ArchiveCache
+from backend.services.zip_jobs import ZipJobManager, JobStore, load_documents, COMPLETED, FAILED, QUEUED, RUNNING
+
+DOCS = [{"codigo_proforma": "P-1"}, {"codigo_proforma": "P-2"}, {"codigo_proforma": "P-3"}]
+
+
+class _FakeZipService:
+    """stream_zip simulado: un fragmento por documento, informando el avance"""
+
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.calls = 0
+
+    def stream_zip(self, documents, project_code=None, summary=None, progress=None, cancel_token=None, weight=1.0):
+        self.calls += 1
+        self.cancel_token = cancel_token
+        yield b"PK"
+        for index, doc in enumerate(documents, start=1):
+            if self.gate is not None:
+                # Como una descarga en curso: solo el token la corta
+                deadline = time.monotonic() + 5
+                while not self.gate.wait(timeout=0.01) and time.monotonic() < deadline:
+                    cancel_token.raise_if_cancelled()
+            if progress is not None:
+                progress(index, 0, len(documents))
+            yield doc["codigo_proforma"].encode()
+        if summary is not None:
+            summary["failed"] = 0
+            summary["compression"] = {"bytes_saved": 0, "cpu_seconds": 0.0}
+
+
+@pytest.fixture
+def fake_zip(monkeypatch, tmp_path):
+    service = _FakeZipService()
+    monkeypatch.setattr(zip_jobs_module, "zip_service", service)
+    monkeypatch.setattr(zip_jobs_module, "archive_cache", ArchiveCache(str(tmp_path / "archives"), 10 * 1024 * 1024))
+    monkeypatch.setattr(zip_jobs_module, "load_documents", lambda filters, **kwargs: list(DOCS))
+    return service
+
+
+def _wait(manager, job_id, statuses=(COMPLETED, FAILED)):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        job = manager.status(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not reach {statuses}")
+
+
+class TestZipJobs:
+    """Tests de ZipJobManager"""
+
+    def test_trabajo_completo_y_descarga(self, tmp_path, fake_zip):
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        created = manager.submit({"project_code": "PROY"})
+        assert created["status"] in (QUEUED, RUNNING, COMPLETED)
+
+        job = _wait(manager, created["job_id"])
+        assert job["status"] == COMPLETED
+        assert (job["total_documents"], job["processed_documents"], job["failed_documents"]) == (3, 3, 0)
+        assert job["bytes_written"] == len(b"PKP-1P-2P-3")
+        assert job["compression"] == {"bytes_saved": 0, "cpu_seconds": 0.0}
+        with open(manager.artifact(created["job_id"]), "rb") as f:
+            assert f.read() == b"PKP-1P-2P-3"
+        assert manager.stats()["jobs"] == {COMPLETED: 1}
+        manager.shutdown()
+
+    def test_sin_filtros_o_sin_documentos(self, tmp_path, fake_zip, monkeypatch):
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        with pytest.raises(ValueError):
+            manager.submit({"project_code": None, "document_ids": []})
+
+        monkeypatch.setattr(zip_jobs_module, "load_documents", lambda filters, **kwargs: [])
+        job = _wait(manager, manager.submit({"project_code": "VACIO"})["job_id"])
+        assert job["status"] == FAILED and "No documents" in job["error"]
+        assert manager.artifact(job["job_id"]) is None
+        assert manager.status("no-existe") is None
+        manager.shutdown()
+
+    def test_avance_y_eta_mientras_corre(self, tmp_path, fake_zip):
+        fake_zip.gate = threading.Event()
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        job_id = manager.submit({"project_code": "PROY"})["job_id"]
+        running = _wait(manager, job_id, statuses=(RUNNING,))
+        assert running["total_documents"] == 3 and running["eta_seconds"] is None
+
+        fake_zip.gate.set()
+        assert _wait(manager, job_id)["status"] == COMPLETED
+        manager.shutdown()
+
+    def test_estado_sobrevive_al_reinicio(self, tmp_path, fake_zip):
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        done = _wait(manager, manager.submit({"project_code": "PROY"})["job_id"])
+        manager.shutdown()
+
+        # Un trabajo que quedó "running" cuando se cortó el proceso
+        store = JobStore(os.path.join(str(tmp_path), "jobs.sqlite3"))
+        store.create("interrumpido", {"project_code": "PROY"})
+        store.update("interrumpido", status=RUNNING, started=time.time(), processed=2)
+        store.close()
+        (tmp_path / "interrumpido.zip.part").write_bytes(b"PKP-1")
+
+        restarted = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        restarted.start()
+        assert restarted.artifact(done["job_id"]) is not None
+        resumed = _wait(restarted, "interrumpido")
+        assert resumed["status"] == COMPLETED and resumed["processed_documents"] == 3
+        with open(restarted.artifact("interrumpido"), "rb") as f:
+            assert f.read() == b"PKP-1P-2P-3"
+        restarted.shutdown()
+
+    def test_trabajos_vencidos_se_eliminan(self, tmp_path, fake_zip):
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        job_id = _wait(manager, manager.submit({"project_code": "PROY"})["job_id"])["job_id"]
+        manager.retention_seconds = -1
+        manager._purge_expired()
+        assert manager.status(job_id) is None
+        assert not os.path.exists(tmp_path / f"{job_id}.zip")
+        manager.shutdown()
+
+
+    def test_shutdown_corta_el_documento_en_curso(self, tmp_path, fake_zip):
+        fake_zip.gate = threading.Event()
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        job_id = manager.submit({"project_code": "PROY"})["job_id"]
+        _wait(manager, job_id, statuses=(RUNNING,))
+
+        start = time.monotonic()
+        manager.shutdown()
+        assert time.monotonic() - start < 1
+        assert fake_zip.cancel_token.cancelled
+        # Vuelve a la cola para el próximo arranque
+        store = JobStore(os.path.join(str(tmp_path), "jobs.sqlite3"))
+        assert store.get(job_id)["status"] == QUEUED
+        store.close()
+
+    def test_cancelar_trabajo(self, tmp_path, fake_zip):
+        fake_zip.gate = threading.Event()
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        running = manager.submit({"project_code": "PROY"})["job_id"]
+        queued = manager.submit({"project_code": "OTRO"})["job_id"]
+        _wait(manager, running, statuses=(RUNNING,))
+
+        assert manager.cancel(queued)["status"] == FAILED
+        manager.cancel(running)
+        job = _wait(manager, running)
+        assert job["status"] == FAILED and job["error"] == zip_jobs_module.CANCELLED_ERROR
+        assert manager.artifact(running) is None
+        assert manager.cancel("no-existe") is None
+        assert fake_zip.calls == 1
+        manager.shutdown()
+
+
+    def test_zip_de_proyecto_repetido_sale_de_la_cache(self, tmp_path, fake_zip):
+        manager = ZipJobManager(str(tmp_path), workers=1, retention_seconds=3600)
+        first = _wait(manager, manager.submit({"project_code": "PROY", "document_types": ["Voucher"]})["job_id"])
+        second = _wait(manager, manager.submit({"project_code": "PROY", "document_types": ["Voucher"]})["job_id"])
+        assert first["status"] == second["status"] == COMPLETED
+        # El segundo no reconstruye el ZIP: lo copia del guardado por el primero
+        assert fake_zip.calls == 1
+        assert zip_jobs_module.archive_cache.stats()["hits"] == 1
+        assert second["processed_documents"] == 3 and second["failed_documents"] == 0
+        with open(manager.artifact(second["job_id"]), "rb") as f:
+            assert f.read() == b"PKP-1P-2P-3"
+
+        # Por códigos de proforma no hay clave de caché
+        _wait(manager, manager.submit({"document_ids": ["P-1"]})["job_id"])
+        assert fake_zip.calls == 2
+        manager.shutdown()
+
+
+class TestLoadDocuments:
+    """Filtros y límite de los documentos de un ZIP"""
+
+    def test_tipos_y_limite_estricto(self, monkeypatch):
+        calls = []
+
+        def get_documents(**kwargs):
+            calls.append(kwargs)
+            return [{"codigo_proforma": f"P-{i}"} for i in range(kwargs["limit"])]
+
+        monkeypatch.setattr(zip_jobs_module.redshift_service, "get_documents", get_documents)
+        filters = {"project_code": "PROY", "document_type": "Voucher", "document_types": ["Minuta", "Voucher"]}
+        assert len(load_documents(filters, limit=5)) == 5
+        assert calls[0]["document_types"] == ["Minuta", "Voucher"]
+
+        # Un trabajo no recorta en silencio: más documentos que el límite es un error
+        with pytest.raises(ValueError, match="More than 5 documents"):
+            load_documents(filters, limit=5, strict=True)
+        assert calls[1]["limit"] == 6
+        assert load_documents({"document_types": ["Adenda"]}, limit=3) and calls[2]["project_code"] is None
+
@@ -0,0 +1,196 @@
+"""
+Tests del pipeline por etapas descarga → conversión → escritura
+"""
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.services.zip_pipeline import ZipPipeline
+
+
+def _slow_fetch(item):
+    time.sleep(random.uniform(0, 0.01))
+    if item % 7 == 3:
+        raise ValueError(f"fetch {item}")
+    return item * 10
+
+
+def _convert(item, content):
+    if item % 11 == 5:
+        raise ValueError(f"convert {item}")
+    return content + 1
+
+
+class TestZipPipeline:
+    """Tests de ZipPipeline"""
+
+    def test_resultados_en_orden_con_errores(self):
+        """Los resultados salen en el orden de entrada aunque terminen desordenados"""
+        items = list(range(60))
+        pipeline = ZipPipeline(items, _slow_fetch, _convert, download_workers=6, convert_workers=3, queue_depth=4)
+        results = list(pipeline.results())
+
+        assert [r.index for r in results] == items
+        for r in results:
+            if r.item % 7 == 3:
+                assert r.error == f"fetch {r.item}"
+            elif r.item % 11 == 5:
+                assert r.error == f"convert {r.item}"
+            else:
+                assert r.error is None and r.value == r.item * 10 + 1
+
+        stages = pipeline.stats()["stages"]
+        assert stages["download"]["processed"] == 60
+        assert stages["convert"]["processed"] == 60
+        assert stages["write"]["processed"] == 60
+        assert stages["convert"]["queue_capacity"] == 4
+
+    def test_colas_acotadas_frenan_descargas(self):
+        """Con un consumidor detenido, las descargas no avanzan más allá de las colas"""
+        fetched = []
+        lock = threading.Lock()
+
+        def fetch(item):
+            with lock:
+                fetched.append(item)
+            return item
+
+        pipeline = ZipPipeline(list(range(100)), fetch, lambda item, c: c,
+                               download_workers=2, convert_workers=1, queue_depth=2)
+        results = pipeline.results()
+        next(results)
+        time.sleep(0.3)
+        # Colas (2 + 2) + items en mano de cada worker + el entregado
+        assert len(fetched) < 12
+        results.close()
+
+    def test_cierre_libera_resultados_pendientes(self):
+        """Si se corta el consumo, los valores no entregados se liberan"""
+        released = []
+        pipeline = ZipPipeline(list(range(20)), lambda i: i, lambda i, c: c,
+                               release=released.append, download_workers=4, convert_workers=2, queue_depth=8)
+        results = pipeline.results()
+        first = next(results)
+        time.sleep(0.2)
+        results.close()
+        assert first.value not in released
+        assert released
+        assert pipeline not in ZipPipeline._active
+
+    def test_etapa_de_descarga_asyncio(self):
+        """Con fetch_async, un event loop ejecuta descargas concurrentes en orden de salida"""
+        active = {"now": 0, "max": 0}
+        cleaned = []
+
+        async def fetch_async(item):
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+            await asyncio.sleep(random.uniform(0, 0.01))
+            active["now"] -= 1
+            if item % 7 == 3:
+                raise ValueError(f"fetch {item}")
+            return item * 10
+
+        async def cleanup():
+            cleaned.append(True)
+
+        pipeline = ZipPipeline(list(range(40)), None, _convert, fetch_async=fetch_async, async_cleanup=cleanup,
+                               download_workers=8, convert_workers=2, queue_depth=4)
+        results = list(pipeline.results())
+
+        assert [r.index for r in results] == list(range(40))
+        assert all(r.error == f"fetch {r.item}" for r in results if r.item % 7 == 3)
+        assert all(r.value == r.item * 10 + 1 for r in results if r.error is None)
+        assert 1 < active["max"] <= 8
+        assert cleaned == [True]
+        assert len([t for t in pipeline._threads if "download" in t.name]) == 1
+
+    def test_plan_define_el_orden_de_proceso(self):
+        """Con plan, los items se procesan en ese orden pero se entregan en el de la lista"""
+        started = []
+
+        def fetch(item):
+            started.append(item)
+            return item
+
+        plan = lambda items: list(reversed(range(len(items))))
+        pipeline = ZipPipeline(list(range(10)), fetch, lambda item, content: content, download_workers=1, plan=plan)
+        assert [r.value for r in pipeline.results()] == list(range(10))
+        assert started == list(reversed(range(10)))
+
+        # Un plan inválido se ignora
+        started.clear()
+        pipeline = ZipPipeline(list(range(5)), fetch, lambda item, content: content, download_workers=1,
+                               plan=lambda items: [0, 0, 1])
+        assert [r.value for r in pipeline.results()] == list(range(5))
+        assert started == list(range(5))
+
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_ventana_llena_admite_el_siguiente_a_entregar(self, use_async):
+        """Con la ventana llena de items del plan, el siguiente de la lista igual empieza"""
+        started = []
+
+        def fetch(item):
+            started.append(item)
+            return item
+
+        async def fetch_async(item):
+            return fetch(item)
+
+        pipeline = ZipPipeline(
+            list(range(20)), fetch, lambda item, content: content,
+            fetch_async=fetch_async if use_async else None,
+            download_workers=2, queue_depth=1, reorder_window=3,
+            plan=lambda items: list(reversed(range(len(items)))),
+        )
+        assert [r.value for r in pipeline.results()] == list(range(20))
+        # Los más "grandes" del plan empiezan primero; luego la ventana fuerza el orden de salida
+        assert started[:3] == [19, 18, 17]
+        assert sorted(started) == list(range(20))
+
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_ventana_acota_el_reordenamiento(self, use_async):
+        """Un item lento frena las descargas nuevas en vez de acumular resultados"""
+        release = threading.Event()
+        started = []
+
+        def fetch(item):
+            started.append(item)
+            if item == 0:
+                release.wait(timeout=5)
+            return item
+
+        async def fetch_async(item):
+            started.append(item)
+            while item == 0 and not release.is_set():
+                await asyncio.sleep(0.01)
+            return item
+
+        pipeline = ZipPipeline(
+            list(range(50)), fetch, lambda item, content: content,
+            fetch_async=fetch_async if use_async else None,
+            download_workers=4, convert_workers=2, queue_depth=2, reorder_window=6,
+        )
+        values = []
+        consumer = threading.Thread(target=lambda: values.extend(r.value for r in pipeline.results()), daemon=True)
+        consumer.start()
+        try:
+            deadline = time.monotonic() + 5
+            while len(started) < 6 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.2)
+            # Con el item 0 detenido, solo empiezan los que caben en la ventana
+            assert sorted(started) == list(range(6))
+            assert pipeline.reorder_depth <= 5
+        finally:
+            release.set()
+        consumer.join(timeout=5)
+        assert values == list(range(50))
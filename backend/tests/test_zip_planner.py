@@ -0,0 +1,72 @@
+"""
+Tests de la planificación del orden de trabajo de un ZIP
+"""
+import os
+import sys
+import time
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.services import zip_planner as zip_planner_module
+from backend.services.zip_planner import ZipPlanner
+
+
+def _docs(*names):
+    return [{"url": f"https://s3/x/{name}"} for name in names]
+
+
+class TestZipPlanner:
+    """Tests de ZipPlanner"""
+
+    def test_mas_grande_primero_con_cache_y_head(self, monkeypatch):
+        cached = {"https://s3/x/cache.pdf": 40}
+        sizes = {"https://s3/x/a.pdf": 10, "https://s3/x/b.pdf": 100, "https://s3/x/foto.jpg": 30}
+        heads = []
+
+        def content_length(url, timeout):
+            heads.append(url)
+            return sizes.get(url)
+
+        monkeypatch.setattr(zip_planner_module.document_cache, "size_hint", lambda url: cached.get(url))
+        monkeypatch.setattr(zip_planner_module.download_service, "content_length", content_length)
+        planner = ZipPlanner(enabled=True, workers=4, timeout=2)
+
+        docs = _docs("a.pdf", "cache.pdf", "b.pdf", "foto.jpg", "sin-tamano.pdf")
+        order = planner.plan(docs)
+        # b (100) > foto.jpg (30 x IMAGE_CONVERSION_FACTOR) > cache (40) = sin-tamano (mediana: 35) > a (10)
+        assert order == [2, 3, 1, 4, 0]
+        assert sorted(heads) == sorted(set(sizes) | {"https://s3/x/sin-tamano.pdf"})
+        stats = planner.stats()
+        assert (stats["cache_hints"], stats["head_hints"], stats["unknown"]) == (1, 3, 1)
+
+    def test_head_lento_queda_sin_estimar(self, monkeypatch):
+        timeouts = []
+
+        def content_length(url, timeout):
+            timeouts.append(timeout)
+            if url.endswith("lento.pdf"):
+                time.sleep(0.5)
+                return 1000
+            return 10
+
+        monkeypatch.setattr(zip_planner_module.document_cache, "size_hint", lambda url: None)
+        monkeypatch.setattr(zip_planner_module.download_service, "content_length", content_length)
+        planner = ZipPlanner(enabled=True, workers=4, timeout=0.1)
+
+        start = time.monotonic()
+        assert planner.plan(_docs("lento.pdf", "a.pdf", "b.pdf")) == [0, 1, 2]
+        assert time.monotonic() - start < 0.4
+        # Cada HEAD solo dispone de lo que queda del plazo de la planificación
+        assert all(0 < timeout <= 0.1 for timeout in timeouts)
+
+    def test_sin_estimaciones_las_imagenes_primero(self, monkeypatch):
+        monkeypatch.setattr(zip_planner_module.document_cache, "size_hint", lambda url: None)
+        monkeypatch.setattr(zip_planner_module.download_service, "content_length", lambda url, timeout: None)
+        planner = ZipPlanner(enabled=True, workers=4, timeout=1)
+        assert planner.plan(_docs("a.pdf", "foto.png", "b.pdf", "scan.jpg")) == [1, 3, 0, 2]
+
+    def test_desactivado_conserva_el_orden(self, monkeypatch):
+        monkeypatch.setattr(zip_planner_module.download_service, "content_length", lambda url, timeout: 1 / 0)
+        planner = ZipPlanner(enabled=False, workers=4, timeout=1)
+        assert planner.plan(_docs("a.pdf", "b.pdf", "c.pdf")) == [0, 1, 2]
@@ -0,0 +1,202 @@
+"""
+Tests del escritor de ZIP en streaming y de ZipService.stream_zip
+"""
+import io
+import sys
+import os
+import zipfile
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar módulos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.core.negative_cache import NegativeCache
+from backend.core.spool import SpooledPayload
+from backend.utils.zip_stream import ZipStreamWriter, ZIP_STORED, ZIP_DEFLATED
+from backend.services import zip_service as zip_service_module
+from backend.services.zip_service import ZipService
+
+
+def _build(entries):
+    writer = ZipStreamWriter()
+    chunks = []
+    for name, data, method in entries:
+        chunks.extend(writer.add(name, data, compress_type=method))
+    chunks.extend(writer.close())
+    return b"".join(chunks), writer
+
+
+class TestZipStreamWriter:
+    """Tests del formato generado por ZipStreamWriter"""
+
+    def test_stored_y_deflated_legibles(self):
+        """Entradas STORED y DEFLATED se leen correctamente con zipfile"""
+        payload = os.urandom(200_000)
+        text = b"hola " * 50_000
+        data, writer = _build([
+            ("a/stored.bin", payload, ZIP_STORED),
+            ("b/texto.txt", text, ZIP_DEFLATED),
+        ])
+        assert writer.bytes_written == len(data)
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.testzip() is None
+            assert zf.read("a/stored.bin") == payload
+            assert zf.read("b/texto.txt") == text
+            assert zf.getinfo("a/stored.bin").compress_type == zipfile.ZIP_STORED
+            assert zf.getinfo("b/texto.txt").compress_size < len(text)
+
+    def test_nombres_utf8(self):
+        """Nombres con tildes y eñes se preservan"""
+        name = "DPTO-101 - JOSÉ PEÑA/archivo_año.pdf"
+        data, _ = _build([(name, b"%PDF-1.4", ZIP_DEFLATED)])
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.namelist() == [name]
+
+    def test_entrada_vacia(self):
+        """Una entrada vacía es válida"""
+        data, _ = _build([("vacio.txt", b"", ZIP_DEFLATED), ("vacio2.txt", b"", ZIP_STORED)])
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.read("vacio.txt") == b""
+            assert zf.read("vacio2.txt") == b""
+
+    def test_zip64_por_cantidad_de_entradas(self):
+        """Más de 65535 entradas activa el registro ZIP64"""
+        entries = [(f"f{i}.txt", b"", ZIP_STORED) for i in range(70_000)]
+        data, _ = _build(entries)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert len(zf.infolist()) == 70_000
+
+    def test_no_admite_entradas_tras_cerrar(self):
+        """Agregar luego de close() es un error"""
+        writer = ZipStreamWriter()
+        list(writer.close())
+        try:
+            list(writer.add("x", b"x"))
+            assert False, "Se esperaba ValueError"
+        except ValueError:
+            pass
+
+
+class TestStreamZip:
+    """Tests de ZipService.stream_zip con descargas simuladas"""
+
+    DOCS = [
+        {"codigo_proforma": "P-1", "tipo_documento": "Voucher", "url": "https://s3/x/a.pdf",
+         "codigo_unidad": "101", "tipo_unidad": "DPTO", "nombre_cliente": "ANA", "documento_cliente": "1"},
+        {"codigo_proforma": "P-2", "tipo_documento": "Minuta", "url": "https://s3/x/b.pdf",
+         "codigo_unidad": "102", "tipo_unidad": "DPTO", "nombre_cliente": "LUIS", "documento_cliente": "2"},
+        {"codigo_proforma": "P-3", "tipo_documento": "Otro", "url": "https://s3/x/c.pdf",
+         "codigo_unidad": "103", "tipo_unidad": "DPTO", "nombre_cliente": "EVA", "documento_cliente": "3"},
+    ]
+
+    @pytest.fixture(autouse=True)
+    def _sin_head(self, monkeypatch):
+        """La planificación no sale a la red: sin estimaciones de tamaño"""
+        monkeypatch.setattr(zip_service_module.download_service, "content_length", lambda url, timeout=5: None)
+
+    def test_stream_emite_readme_primero_y_registra_fallos(self, monkeypatch):
+        """El README sale antes de cualquier descarga y los fallos van a FAILED_FILES.txt"""
+        def fake_download(url, *args, **kwargs):
+            if url.endswith("c.pdf"):
+                return None
+            return SpooledPayload(data=b"%PDF-1.4 " + url.encode(), size=9 + len(url))
+
+        monkeypatch.setattr(zip_service_module.download_service, "download", fake_download)
+
+        stream = ZipService.stream_zip(self.DOCS, project_code="PROY")
+        first_chunk = next(stream)
+        assert first_chunk.startswith(b"PK\x03\x04")
+        data = first_chunk + b"".join(stream)
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            names = zf.namelist()
+            assert names[0] == "_00_INFO_TALE/README.txt"
+            assert names[-1] == "FAILED_FILES.txt"
+            assert len([n for n in names if n.endswith(".pdf")]) == 2
+            assert b"P-3" in zf.read("FAILED_FILES.txt")
+
+    def test_create_zip_compatible(self, monkeypatch):
+        """create_zip sigue devolviendo un BytesIO con el ZIP completo"""
+        monkeypatch.setattr(
+            zip_service_module.download_service, "download",
+            lambda url, *a, **k: SpooledPayload(data=b"%PDF-1.4", size=8),
+        )
+        buffer = ZipService.create_zip(self.DOCS[:1], project_code="PROY")
+        with zipfile.ZipFile(buffer) as zf:
+            assert len(zf.namelist()) == 2
+
+    def test_descarga_en_disco_se_escribe_sin_copiar(self, monkeypatch):
+        """Un PDF descargado a disco pasa al ZIP desde el mismo archivo y luego se elimina"""
+        spilled = []
+
+        def fake_download(url, *args, **kwargs):
+            payload = SpooledPayload.spill(b"%PDF-1.4 " + b"z" * 5000)
+            spilled.append(payload._path)
+            return payload
+
+        monkeypatch.setattr(zip_service_module.download_service, "download", fake_download)
+        data = b"".join(ZipService.stream_zip(self.DOCS[:2], project_code="PROY"))
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            pdfs = [n for n in zf.namelist() if n.endswith(".pdf")]
+            assert len(pdfs) == 2
+            assert zf.read(pdfs[0]).endswith(b"z" * 5000)
+        assert spilled and not any(os.path.exists(path) for path in spilled)
+
+    def test_descargas_asyncio(self, monkeypatch):
+        """Con ZIP_ASYNC_DOWNLOADS la etapa de descarga usa download_async"""
+        async def fake_download_async(url, *args, **kwargs):
+            if url.endswith("c.pdf"):
+                return None
+            return SpooledPayload(data=b"%PDF-1.4 " + url.encode(), size=9 + len(url))
+
+        monkeypatch.setattr(zip_service_module.settings, "ZIP_ASYNC_DOWNLOADS", True)
+        monkeypatch.setattr(zip_service_module.download_service, "download_async", fake_download_async)
+        data = b"".join(ZipService.stream_zip(self.DOCS, project_code="PROY"))
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert len([n for n in zf.namelist() if n.endswith(".pdf")]) == 2
+            assert b"P-3" in zf.read("FAILED_FILES.txt")
+
+    def test_cache_negativa_va_directo_a_failed_files(self, monkeypatch):
+        """Las URLs con un 403 reciente no se descargan y se informan como 'cached 403'"""
+        cache = NegativeCache(ttl_seconds=60, max_entries=10)
+        cache.add("https://s3/x/b.pdf", 403)
+        downloaded = []
+
+        def fake_download(url, *args, **kwargs):
+            downloaded.append(url)
+            return SpooledPayload(data=b"%PDF-1.4", size=8)
+
+        monkeypatch.setattr(zip_service_module.download_service, "negative_cache", cache)
+        monkeypatch.setattr(zip_service_module.download_service, "download", fake_download)
+        data = b"".join(ZipService.stream_zip(self.DOCS, project_code="PROY"))
+
+        assert "https://s3/x/b.pdf" not in downloaded
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert len([n for n in zf.namelist() if n.endswith(".pdf")]) == 2
+            assert "P-2 | Minuta | cached 403 Forbidden" in zf.read("FAILED_FILES.txt").decode()
+
+    def test_el_mas_grande_se_descarga_primero_y_se_escribe_en_orden_tale(self, monkeypatch):
+        """La planificación cambia el orden de descarga, no el de las entradas del ZIP"""
+        sizes = {"https://s3/x/a.pdf": 10, "https://s3/x/b.pdf": 5000, "https://s3/x/c.pdf": 700}
+        downloaded = []
+
+        def fake_download(url, *args, **kwargs):
+            downloaded.append(url)
+            return SpooledPayload(data=b"%PDF-1.4 " + url.encode(), size=9 + len(url))
+
+        monkeypatch.setattr(zip_service_module.download_service, "content_length", lambda url, timeout=5: sizes[url])
+        monkeypatch.setattr(zip_service_module.download_service, "download", fake_download)
+        monkeypatch.setattr(zip_service_module.settings, "ZIP_DOWNLOAD_WORKERS", 1)
+        data = b"".join(ZipService.stream_zip(self.DOCS, project_code="PROY"))
+
+        assert downloaded == ["https://s3/x/b.pdf", "https://s3/x/c.pdf", "https://s3/x/a.pdf"]
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            pdfs = [n for n in zf.namelist() if n.endswith(".pdf")]
+            assert [zf.read(n).split(b" ")[1][-5:] for n in pdfs] == [b"a.pdf", b"b.pdf", b"c.pdf"]
+            # Cada documento queda en la carpeta TALE de su unidad
+            units = {b"a.pdf": "101", b"b.pdf": "102", b"c.pdf": "103"}
+            assert all(units[zf.read(n).split(b" ")[1][-5:]] in n.split("/")[-2] for n in pdfs)
@@ -0,0 +1,270 @@
+"""
+Detección del tipo de archivo por sus bytes de cabecera (sin decodificar)
+
+Clasifica PDF, OOXML (docx/xlsx/pptx, por los nombres del central directory),
+OLE (doc/xls/ppt), JPEG, PNG, WEBP, TIFF y HEIC leyendo solo cabeceras, y para
+las imágenes devuelve además sus dimensiones (y, para JPEG, el tipo de SOF, la
+precisión y la orientación EXIF). Trabaja sobre memoryview: acepta
+bytes, bytearray, memoryview o mmap sin copiarlos.
+"""
+import struct
+from dataclasses import dataclass
+from typing import Optional, Union
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+# Extensión que se reporta para cada tipo detectado
+KIND_EXTENSIONS = {
+    "pdf": ".pdf",
+    "docx": ".docx",
+    "xlsx": ".xlsx",
+    "pptx": ".pptx",
+    "doc": ".doc",
+    "jpeg": ".jpg",
+    "png": ".png",
+    "webp": ".webp",
+    "tiff": ".tiff",
+    "heic": ".heic",
+}
+
+IMAGE_KINDS = {"jpeg", "png", "webp", "tiff", "heic"}
+
+# Prefijos de OOXML dentro del ZIP
+_OOXML_PREFIXES = ((b"word/", "docx"), (b"xl/", "xlsx"), (b"ppt/", "pptx"))
+
+# Nombres de streams OLE (UTF-16LE en el directorio)
+_OLE_STREAMS = (("WordDocument", "doc"), ("Workbook", "xls"), ("Book", "xls"), ("PowerPoint Document", "ppt"))
+
+_HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+
+# Markers SOF de JPEG que contienen las dimensiones
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Límite de bytes que se inspeccionan al buscar cajas o directorios
+_SCAN_LIMIT = 64 * 1024
+
+
+@dataclass(frozen=True)
+class ContentInfo:
+    """Resultado de la detección"""
+    kind: str = ""
+    width: Optional[int] = None
+    height: Optional[int] = None
+    # Componentes de color (JPEG: 1 = gris, 3 = YCbCr/RGB, 4 = CMYK)
+    components: Optional[int] = None
+    # Solo JPEG: marker SOF (0xC0 baseline, 0xC2 progresivo...), bits por muestra y orientación EXIF
+    sof_marker: Optional[int] = None
+    precision: Optional[int] = None
+    orientation: Optional[int] = None
+
+    @property
+    def extension(self) -> str:
+        """Extensión correspondiente ('' si no se reconoce)"""
+        return KIND_EXTENSIONS.get(self.kind, "")
+
+    @property
+    def is_image(self) -> bool:
+        return self.kind in IMAGE_KINDS
+
+    @property
+    def pixels(self) -> Optional[int]:
+        if self.width is None or self.height is None:
+            return None
+        return self.width * self.height
+
+
+def _view(content: BytesLike) -> memoryview:
+    view = memoryview(content)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast("B")
+    return view
+
+
+def _exif_orientation(view: memoryview, start: int, end: int) -> Optional[int]:
+    """Orientación (tag 0x0112 del IFD0) de un segmento APP1 Exif, o None si no la tiene"""
+    if bytes(view[start:start + 6]) != b"Exif\x00\x00":
+        return None
+    tiff = start + 6
+    endian = "<" if bytes(view[tiff:tiff + 2]) == b"II" else ">"
+    (ifd_offset,) = struct.unpack_from(endian + "I", view, tiff + 4)
+    ifd = tiff + ifd_offset
+    if ifd + 2 > end:
+        return None
+    (count,) = struct.unpack_from(endian + "H", view, ifd)
+    for i in range(count):
+        entry = ifd + 2 + i * 12
+        if entry + 12 > end:
+            break
+        tag, field_type = struct.unpack_from(endian + "HH", view, entry)
+        if tag == 0x0112 and field_type == 3:
+            (value,) = struct.unpack_from(endian + "H", view, entry + 8)
+            return value
+    return None
+
+
+def _sniff_jpeg(view: memoryview) -> ContentInfo:
+    offset = 2
+    orientation = None
+    size = len(view)
+    while offset + 4 <= size:
+        if view[offset] != 0xFF:
+            break
+        marker = view[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # byte de relleno
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            break
+        (length,) = struct.unpack_from(">H", view, offset + 2)
+        if marker == 0xE1 and orientation is None:
+            orientation = _exif_orientation(view, offset + 4, min(size, offset + 2 + length))
+        if marker in _JPEG_SOF_MARKERS and offset + 10 <= size:
+            precision, height, width, components = struct.unpack_from(">BHHB", view, offset + 4)
+            return ContentInfo("jpeg", width, height, components, marker, precision, orientation)
+        offset += 2 + length
+    return ContentInfo("jpeg", orientation=orientation)
+
+
+def _sniff_png(view: memoryview) -> ContentInfo:
+    if len(view) >= 24 and view[12:16] == b"IHDR":
+        width, height = struct.unpack_from(">II", view, 16)
+        return ContentInfo("png", width, height)
+    return ContentInfo("png")
+
+
+def _sniff_webp(view: memoryview) -> ContentInfo:
+    chunk = bytes(view[12:16])
+    if chunk == b"VP8 " and len(view) >= 30:
+        width, height = struct.unpack_from("<HH", view, 26)
+        return ContentInfo("webp", width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L" and len(view) >= 25 and view[20] == 0x2F:
+        (bits,) = struct.unpack_from("<I", view, 21)
+        return ContentInfo("webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b"VP8X" and len(view) >= 30:
+        width = int.from_bytes(view[24:27], "little") + 1
+        height = int.from_bytes(view[27:30], "little") + 1
+        return ContentInfo("webp", width, height)
+    return ContentInfo("webp")
+
+
+def _sniff_tiff(view: memoryview) -> ContentInfo:
+    endian = "<" if view[:2] == b"II" else ">"
+    size = len(view)
+    if size < 8:
+        return ContentInfo("tiff")
+    (ifd_offset,) = struct.unpack_from(endian + "I", view, 4)
+    if ifd_offset + 2 > size:
+        return ContentInfo("tiff")
+    (count,) = struct.unpack_from(endian + "H", view, ifd_offset)
+    dims = {}
+    for i in range(count):
+        entry = ifd_offset + 2 + i * 12
+        if entry + 12 > size:
+            break
+        tag, field_type = struct.unpack_from(endian + "HH", view, entry)
+        if tag in (256, 257):
+            fmt = "H" if field_type == 3 else "I"
+            (dims[tag],) = struct.unpack_from(endian + fmt, view, entry + 8)
+    return ContentInfo("tiff", dims.get(256), dims.get(257))
+
+
+def _sniff_heic(view: memoryview) -> ContentInfo:
+    head = bytes(view[:_SCAN_LIMIT])
+    index = head.find(b"ispe")
+    if index >= 0 and index + 16 <= len(head):
+        width, height = struct.unpack_from(">II", head, index + 8)
+        return ContentInfo("heic", width, height)
+    return ContentInfo("heic")
+
+
+def _zip_entry_names(view: memoryview):
+    """Recorre los nombres del central directory de un ZIP (None si no se puede leer)"""
+    size = len(view)
+    tail_start = max(0, size - (_SCAN_LIMIT + 22))
+    tail = bytes(view[tail_start:])
+    eocd = tail.rfind(b"PK\x05\x06")
+    if eocd < 0 or eocd + 22 > len(tail):
+        return None
+    entries, cd_size, cd_offset = struct.unpack_from("<HII", tail, eocd + 10)
+    if cd_offset + cd_size > size:
+        return None
+    names = []
+    offset = cd_offset
+    for _ in range(entries):
+        if offset + 46 > size or view[offset:offset + 4] != b"PK\x01\x02":
+            break
+        name_len, extra_len, comment_len = struct.unpack_from("<HHH", view, offset + 28)
+        names.append(bytes(view[offset + 46:offset + 46 + name_len]))
+        offset += 46 + name_len + extra_len + comment_len
+    return names
+
+
+def _sniff_zip(view: memoryview) -> ContentInfo:
+    names = _zip_entry_names(view)
+    if names is None:
+        # ZIP truncado o sin central directory: buscar en los primeros local headers
+        head = bytes(view[:2000])
+        names = [prefix for prefix, _ in _OOXML_PREFIXES if prefix in head]
+    for prefix, kind in _OOXML_PREFIXES:
+        if any(name.startswith(prefix) for name in names):
+            return ContentInfo(kind)
+    return ContentInfo("zip")
+
+
+def _sniff_ole(view: memoryview) -> ContentInfo:
+    size = len(view)
+    if size < 512:
+        return ContentInfo("ole")
+    (sector_shift,) = struct.unpack_from("<H", view, 30)
+    (dir_sector,) = struct.unpack_from("<I", view, 48)
+    sector_size = 1 << sector_shift
+    start = (dir_sector + 1) * sector_size
+    directory = bytes(view[start:start + sector_size])
+    for i in range(0, len(directory) - 127, 128):
+        (name_len,) = struct.unpack_from("<H", directory, i + 64)
+        name = directory[i:i + max(0, name_len - 2)].decode("utf-16-le", errors="ignore")
+        for stream, kind in _OLE_STREAMS:
+            if name == stream:
+                return ContentInfo(kind)
+    return ContentInfo("ole")
+
+
+def sniff_content(content: BytesLike) -> ContentInfo:
+    """
+    Detecta el tipo de archivo y, si es imagen, sus dimensiones.
+
+    Args:
+        content: Contenido del archivo (bytes, memoryview, mmap...)
+
+    Returns:
+        ContentInfo con kind vacío si no se reconoce
+    """
+    view = _view(content)
+    if view[:4] == b"%PDF":
+        return ContentInfo("pdf")
+
+    if view[:4] == b"PK\x03\x04":
+        kind, parser = "zip", _sniff_zip
+    elif view[:8] == b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1":
+        kind, parser = "ole", _sniff_ole
+    elif view[:3] == b"\xff\xd8\xff":
+        kind, parser = "jpeg", _sniff_jpeg
+    elif view[:8] == b"\x89PNG\r\n\x1a\n":
+        kind, parser = "png", _sniff_png
+    elif view[:4] == b"RIFF" and view[8:12] == b"WEBP":
+        kind, parser = "webp", _sniff_webp
+    elif view[:4] in (b"II*\x00", b"MM\x00*"):
+        kind, parser = "tiff", _sniff_tiff
+    elif view[4:8] == b"ftyp" and bytes(view[8:12]) in _HEIF_BRANDS:
+        kind, parser = "heic", _sniff_heic
+    else:
+        return ContentInfo()
+
+    try:
+        return parser(view)
+    except struct.error:
+        # Cabecera truncada: se reporta el tipo sin dimensiones
+        return ContentInfo(kind)
@@ -0,0 +1,464 @@
+"""
+Escritor de ZIP en streaming (sin seek) para respuestas HTTP progresivas
+
+Emite el local header y los datos de cada entrada apenas se agrega, y el
+central directory al cerrar. El archivo completo nunca se mantiene en memoria:
+solo se guarda la metadata de cada entrada (nombre, CRC, tamaños, offset).
+Soporta ZIP64 (más de 65535 entradas o archivos/offsets mayores a 4 GB).
+
+Con un CompressionReport, el writer anota por entrada el método, los tamaños y
+la CPU gastada en deflate.
+
+prepare_entry calcula el CRC y comprime una entrada fuera del writer (zlib
+libera el GIL, así que varios threads comprimen en paralelo); add_prepared la
+agrega ya comprimida y el writer solo copia los bytes.
+"""
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Tamaño de los fragmentos emitidos hacia el cliente
+CHUNK_SIZE = 64 * 1024
+
+# Tamaño de los fragmentos que comprime prepare_entry (menos llamadas a zlib)
+PREPARE_CHUNK_SIZE = 1024 * 1024
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX_ENTRIES = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_END_RECORD = struct.Struct("<4s4H2LH")
+_END_RECORD64 = struct.Struct("<4sQ2H2L4Q")
+_END_LOCATOR64 = struct.Struct("<4sLQL")
+
+_SIG_LOCAL = b"PK\003\004"
+_SIG_CENTRAL = b"PK\001\002"
+_SIG_DESCRIPTOR = b"PK\007\010"
+_SIG_END = b"PK\005\006"
+_SIG_END64 = b"PK\006\006"
+_SIG_LOCATOR64 = b"PK\006\007"
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_CREATE_SYSTEM_UNIX = 3
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class CompressionReport:
+    """Bytes ahorrados frente a CPU gastada por la compresión de un ZIP (thread-safe)"""
+
+    def __init__(self):
+        self.stored_entries = 0
+        self.deflated_entries = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.sample_seconds = 0.0
+        self.compress_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, compress_type: int, file_size: int, compress_size: int, seconds: float = 0.0) -> None:
+        """Anota una entrada escrita"""
+        with self._lock:
+            if compress_type == ZIP_STORED:
+                self.stored_entries += 1
+            else:
+                self.deflated_entries += 1
+            self.input_bytes += file_size
+            self.output_bytes += compress_size
+            self.compress_seconds += seconds
+
+    def add_sample_time(self, seconds: float) -> None:
+        """Anota la CPU gastada en decidir el método de una entrada"""
+        with self._lock:
+            self.sample_seconds += seconds
+
+    def merge(self, other: "CompressionReport") -> None:
+        with other._lock:
+            values = (
+                other.stored_entries, other.deflated_entries, other.input_bytes,
+                other.output_bytes, other.sample_seconds, other.compress_seconds,
+            )
+        with self._lock:
+            self.stored_entries += values[0]
+            self.deflated_entries += values[1]
+            self.input_bytes += values[2]
+            self.output_bytes += values[3]
+            self.sample_seconds += values[4]
+            self.compress_seconds += values[5]
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.input_bytes - self.output_bytes
+
+    @property
+    def cpu_seconds(self) -> float:
+        return self.sample_seconds + self.compress_seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        cpu = self.cpu_seconds
+        return {
+            "stored_entries": self.stored_entries,
+            "deflated_entries": self.deflated_entries,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "bytes_saved": self.bytes_saved,
+            "sample_cpu_seconds": round(self.sample_seconds, 3),
+            "compress_cpu_seconds": round(self.compress_seconds, 3),
+            "cpu_seconds": round(cpu, 3),
+            # Rendimiento de la CPU invertida: bytes ahorrados por segundo de CPU
+            "bytes_saved_per_cpu_second": int(self.bytes_saved / cpu) if cpu > 0 else None,
+        }
+
+
+@dataclass
+class PreparedEntry:
+    """Metadata de una entrada comprimida (o con el CRC calculado) fuera del writer"""
+    compress_type: int
+    crc: int
+    file_size: int
+    compress_seconds: float = 0.0
+
+
+def prepare_entry(
+    data: BytesLike,
+    compress_type: int,
+    compresslevel: int = 6,
+    write: Optional[Callable[[BytesLike], None]] = None,
+) -> PreparedEntry:
+    """
+    Calcula el CRC de una entrada y, si es DEFLATED, la comprime.
+
+    Pensada para los workers: crc32 y deflate liberan el GIL, así que varias
+    entradas se preparan en paralelo. La salida comprimida se entrega por
+    fragmentos a write; una entrada STORED no produce salida (se escribe el
+    contenido original).
+
+    Args:
+        data: Contenido de la entrada
+        compress_type: ZIP_STORED o ZIP_DEFLATED
+        compresslevel: Nivel de deflate
+        write: Recibe los fragmentos comprimidos (obligatorio con ZIP_DEFLATED)
+    """
+    if compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+        raise ValueError(f"Unsupported compression method: {compress_type}")
+    # Las vistas se liberan al salir aunque write falle: el llamador puede
+    # cerrar un payload mapeado (mmap) con la excepción todavía viva
+    with memoryview(data) as raw, (raw if raw.ndim == 1 and raw.itemsize == 1 else raw.cast("B")) as view:
+        file_size = len(view)
+        if compress_type == ZIP_STORED:
+            started = time.thread_time()
+            crc = zlib.crc32(view)
+            return PreparedEntry(ZIP_STORED, crc, file_size, time.thread_time() - started)
+
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        crc = 0
+        seconds = 0.0
+        for start in range(0, file_size, PREPARE_CHUNK_SIZE):
+            with view[start:start + PREPARE_CHUNK_SIZE] as chunk:
+                started = time.thread_time()
+                crc = zlib.crc32(chunk, crc)
+                compressed = compressor.compress(chunk)
+                seconds += time.thread_time() - started
+            if compressed:
+                write(compressed)
+    started = time.thread_time()
+    compressed = compressor.flush()
+    seconds += time.thread_time() - started
+    if compressed:
+        write(compressed)
+    return PreparedEntry(ZIP_DEFLATED, crc, file_size, seconds)
+
+
+@dataclass
+class _ZipEntry:
+    """Metadata de una entrada ya escrita (necesaria para el central directory)"""
+    name: bytes
+    flags: int
+    compress_type: int
+    dostime: int
+    dosdate: int
+    crc: int
+    compress_size: int
+    file_size: int
+    offset: int
+    version: int
+
+
+def _dos_datetime(date_time: datetime) -> Tuple[int, int]:
+    """Convierte un datetime al par (hora, fecha) en formato MS-DOS"""
+    year = max(date_time.year, 1980)
+    dosdate = (year - 1980) << 9 | date_time.month << 5 | date_time.day
+    dostime = date_time.hour << 11 | date_time.minute << 5 | (date_time.second // 2)
+    return dostime, dosdate
+
+
+def _encode_name(name: str) -> Tuple[bytes, int]:
+    """Codifica el nombre en ASCII o UTF-8 (con el flag correspondiente)"""
+    try:
+        return name.encode("ascii"), 0
+    except UnicodeEncodeError:
+        return name.encode("utf-8"), _FLAG_UTF8
+
+
+def iter_chunks(data: BytesLike, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Recorre un buffer en fragmentos de bytes sin copiarlo completo"""
+    view = memoryview(data)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast("B")
+    for start in range(0, len(view), chunk_size):
+        yield bytes(view[start:start + chunk_size])
+
+
+class ZipStreamWriter:
+    """
+    Genera un ZIP por fragmentos para enviarlo mientras se construye.
+
+    Uso:
+        writer = ZipStreamWriter()
+        yield from writer.add("carpeta/archivo.pdf", contenido)
+        yield from writer.close()
+    """
+
+    def __init__(self, compresslevel: int = 6, report: Optional[CompressionReport] = None):
+        self.compresslevel = compresslevel
+        self.report = report
+        self._entries: List[_ZipEntry] = []
+        self._offset = 0
+        self._closed = False
+
+    @property
+    def bytes_written(self) -> int:
+        """Total de bytes emitidos hasta el momento"""
+        return self._offset
+
+    @property
+    def entry_count(self) -> int:
+        """Cantidad de entradas escritas"""
+        return len(self._entries)
+
+    def _emit(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def add(
+        self,
+        name: str,
+        data: BytesLike,
+        compress_type: int = ZIP_DEFLATED,
+        compresslevel: Optional[int] = None,
+        date_time: Optional[datetime] = None,
+    ) -> Iterator[bytes]:
+        """
+        Agrega una entrada y emite su local header y sus datos.
+
+        Las entradas STORED llevan CRC y tamaños en el local header. Las DEFLATED
+        se comprimen por fragmentos y usan data descriptor al final.
+
+        Args:
+            name: Ruta dentro del ZIP
+            data: Contenido de la entrada (bytes o buffer)
+            compress_type: ZIP_STORED o ZIP_DEFLATED
+            compresslevel: Nivel de deflate (por defecto el del writer)
+            date_time: Fecha de modificación (por defecto ahora)
+        """
+        if self._closed:
+            raise ValueError("ZipStreamWriter already closed")
+        if compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ValueError(f"Unsupported compression method: {compress_type}")
+
+        name_bytes, flags = _encode_name(name)
+        dostime, dosdate = _dos_datetime(date_time or datetime.now())
+        file_size = memoryview(data).nbytes
+        offset = self._offset
+        compress_seconds = 0.0
+
+        if compress_type == ZIP_STORED:
+            crc = zlib.crc32(data)
+            zip64 = file_size > ZIP64_LIMIT
+            version = _VERSION_ZIP64 if zip64 else _VERSION_DEFAULT
+            yield self._emit(self._local_header(
+                name_bytes, flags, compress_type, dostime, dosdate, crc, file_size, file_size, zip64, version
+            ))
+            for chunk in iter_chunks(data):
+                yield self._emit(chunk)
+            compress_size = file_size
+        else:
+            flags |= _FLAG_DATA_DESCRIPTOR
+            # Igual que zipfile: se reserva ZIP64 si la salida podría superar el límite
+            zip64 = file_size * 1.05 > ZIP64_LIMIT
+            version = _VERSION_ZIP64 if zip64 else _VERSION_DEFAULT
+            yield self._emit(self._local_header(
+                name_bytes, flags, compress_type, dostime, dosdate, 0, 0, 0, zip64, version
+            ))
+            level = self.compresslevel if compresslevel is None else compresslevel
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            crc = 0
+            compress_size = 0
+            for chunk in iter_chunks(data):
+                # CPU del thread: no cuenta el tiempo que el consumidor tarda en pedir el siguiente fragmento
+                started = time.thread_time()
+                crc = zlib.crc32(chunk, crc)
+                compressed = compressor.compress(chunk)
+                compress_seconds += time.thread_time() - started
+                if compressed:
+                    compress_size += len(compressed)
+                    yield self._emit(compressed)
+            started = time.thread_time()
+            compressed = compressor.flush()
+            compress_seconds += time.thread_time() - started
+            if compressed:
+                compress_size += len(compressed)
+                yield self._emit(compressed)
+            fmt = "<4sLQQ" if zip64 else "<4sLLL"
+            yield self._emit(struct.pack(fmt, _SIG_DESCRIPTOR, crc, compress_size, file_size))
+
+        self._record(_ZipEntry(
+            name=name_bytes,
+            flags=flags,
+            compress_type=compress_type,
+            dostime=dostime,
+            dosdate=dosdate,
+            crc=crc,
+            compress_size=compress_size,
+            file_size=file_size,
+            offset=offset,
+            version=version,
+        ), compress_seconds)
+
+    def add_prepared(
+        self,
+        name: str,
+        data: BytesLike,
+        entry: PreparedEntry,
+        date_time: Optional[datetime] = None,
+    ) -> Iterator[bytes]:
+        """
+        Agrega una entrada preparada con prepare_entry.
+
+        CRC y tamaños ya se conocen: van en el local header (sin data
+        descriptor) y el writer solo copia los datos.
+
+        Args:
+            name: Ruta dentro del ZIP
+            data: Salida de prepare_entry (el contenido original si es STORED)
+            entry: Metadata devuelta por prepare_entry
+            date_time: Fecha de modificación (por defecto ahora)
+        """
+        if self._closed:
+            raise ValueError("ZipStreamWriter already closed")
+
+        name_bytes, flags = _encode_name(name)
+        dostime, dosdate = _dos_datetime(date_time or datetime.now())
+        compress_size = memoryview(data).nbytes
+        offset = self._offset
+        zip64 = entry.file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT
+        version = _VERSION_ZIP64 if zip64 else _VERSION_DEFAULT
+        yield self._emit(self._local_header(
+            name_bytes, flags, entry.compress_type, dostime, dosdate,
+            entry.crc, compress_size, entry.file_size, zip64, version,
+        ))
+        for chunk in iter_chunks(data):
+            yield self._emit(chunk)
+
+        self._record(_ZipEntry(
+            name=name_bytes,
+            flags=flags,
+            compress_type=entry.compress_type,
+            dostime=dostime,
+            dosdate=dosdate,
+            crc=entry.crc,
+            compress_size=compress_size,
+            file_size=entry.file_size,
+            offset=offset,
+            version=version,
+        ), entry.compress_seconds)
+
+    def _record(self, entry: _ZipEntry, compress_seconds: float) -> None:
+        self._entries.append(entry)
+        if self.report is not None:
+            self.report.record(entry.compress_type, entry.file_size, entry.compress_size, compress_seconds)
+
+    @staticmethod
+    def _local_header(
+        name: bytes, flags: int, compress_type: int, dostime: int, dosdate: int,
+        crc: int, compress_size: int, file_size: int, zip64: bool, version: int,
+    ) -> bytes:
+        extra = b""
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+            file_size = compress_size = 0xFFFFFFFF
+        header = _LOCAL_HEADER.pack(
+            _SIG_LOCAL, version, 0, flags, compress_type, dostime, dosdate,
+            crc, compress_size, file_size, len(name), len(extra),
+        )
+        return header + name + extra
+
+    @staticmethod
+    def _central_header(entry: _ZipEntry) -> bytes:
+        extra_fields = []
+        file_size = entry.file_size
+        compress_size = entry.compress_size
+        offset = entry.offset
+        if file_size > ZIP64_LIMIT:
+            extra_fields.append(file_size)
+            file_size = 0xFFFFFFFF
+        if compress_size > ZIP64_LIMIT:
+            extra_fields.append(compress_size)
+            compress_size = 0xFFFFFFFF
+        if offset > ZIP64_LIMIT:
+            extra_fields.append(offset)
+            offset = 0xFFFFFFFF
+
+        extra = b""
+        version = entry.version
+        if extra_fields:
+            extra = struct.pack(f"<HH{len(extra_fields)}Q", 1, 8 * len(extra_fields), *extra_fields)
+            version = _VERSION_ZIP64
+
+        header = _CENTRAL_HEADER.pack(
+            _SIG_CENTRAL, version, _CREATE_SYSTEM_UNIX, version, 0,
+            entry.flags, entry.compress_type, entry.dostime, entry.dosdate,
+            entry.crc, compress_size, file_size,
+            len(entry.name), len(extra), 0, 0, 0,
+            0o644 << 16, offset,
+        )
+        return header + entry.name + extra
+
+    def close(self) -> Iterator[bytes]:
+        """Emite el central directory y el registro de fin de archivo"""
+        if self._closed:
+            return
+        self._closed = True
+
+        cd_offset = self._offset
+        for entry in self._entries:
+            yield self._emit(self._central_header(entry))
+        cd_size = self._offset - cd_offset
+        count = len(self._entries)
+
+        if count >= ZIP_MAX_ENTRIES or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+            end64_offset = self._offset
+            yield self._emit(_END_RECORD64.pack(
+                _SIG_END64, _END_RECORD64.size - 12, _VERSION_ZIP64, _VERSION_ZIP64,
+                0, 0, count, count, cd_size, cd_offset,
+            ))
+            yield self._emit(_END_LOCATOR64.pack(_SIG_LOCATOR64, 0, end64_offset, 1))
+            count = min(count, ZIP_MAX_ENTRIES)
+            if cd_size > ZIP64_LIMIT:
+                cd_size = 0xFFFFFFFF
+            if cd_offset > ZIP64_LIMIT:
+                cd_offset = 0xFFFFFFFF
+
+        yield self._emit(_END_RECORD.pack(_SIG_END, 0, 0, count, count, cd_size, cd_offset, 0))
@@ -130,11 +130,42 @@ export interface DocumentFilters {
 export interface DownloadZipRequest {
   project_code?: string;
   document_type?: string;
+  document_types?: string[];
   start_date?: string;
   end_date?: string;
   document_ids?: string[];
 }
 
+export type ZipJobStatus = 'queued' | 'running' | 'completed' | 'failed';
+
+export interface ZipCompressionReport {
+  stored_entries: number;
+  deflated_entries: number;
+  input_bytes: number;
+  output_bytes: number;
+  bytes_saved: number;
+  sample_cpu_seconds: number;
+  compress_cpu_seconds: number;
+  cpu_seconds: number;
+  bytes_saved_per_cpu_second: number | null;
+}
+
+export interface ZipJob {
+  job_id: string;
+  status: ZipJobStatus;
+  project_code?: string | null;
+  total_documents: number;
+  processed_documents: number;
+  failed_documents: number;
+  bytes_written: number;
+  eta_seconds?: number | null;
+  error?: string | null;
+  created_at: number;
+  started_at?: number | null;
+  finished_at?: number | null;
+  compression?: ZipCompressionReport | null;
+}
+
 // ============================================================================
 // API FUNCTIONS
 // ============================================================================
@@ -247,6 +278,21 @@ export async function downloadZip(request: DownloadZipRequest): Promise<void> {
   window.URL.revokeObjectURL(url);
 }
 
+// ZIP en segundo plano: el servidor lo genera aunque se cierre la pestaña
+export async function createZipJob(request: DownloadZipRequest): Promise<ZipJob> {
+  const response = await apiClient.post<ZipJob>('/jobs/zip', request);
+  return response.data;
+}
+
+export async function getZipJob(jobId: string): Promise<ZipJob> {
+  const response = await apiClient.get<ZipJob>(`/jobs/zip/${jobId}`);
+  return response.data;
+}
+
+export function getZipJobDownloadUrl(jobId: string): string {
+  return `${API_BASE_URL}/jobs/zip/${jobId}/download`;
+}
+
 export async function downloadProjectZip(projectCode: string, queryString?: string): Promise<void> {
   const url = `/download/zip/project/${projectCode}${queryString ? queryString : ''}`;
   const response = await apiClient.get(url, {
@@ -10,12 +10,17 @@ import { DownloadIcon, FileTextIcon, CalendarIcon, SearchIcon, FilterIcon, XIcon
 import {
   getProjectsList,
   getDocuments,
-  downloadProjectZip,
+  createZipJob,
+  getZipJob,
+  getZipJobDownloadUrl,
   handleApiError,
   type Document,
   type Project,
 } from '@/lib/api';
 
+// Intervalo de consulta del avance de un ZIP en segundo plano
+const ZIP_JOB_POLL_MS = 2000;
+
 interface FilterState {
   documentTypes: string[];
   startDate: string;
@@ -98,24 +103,40 @@ export default function Home() {
     setDownloading(projectCode);
     const toastId = toast.loading(`Generando ZIP del proyecto ${projectCode}... Esto puede tardar varios minutos dependiendo del tamaño.`);
     try {
-      // Construir query params CON los filtros APLICADOS
-      const params = new URLSearchParams();
+      // El ZIP se genera en segundo plano CON los filtros APLICADOS: un timeout o
+      // un refresh no descartan el trabajo
+      let job = await createZipJob({
+        project_code: projectCode,
+        document_types: appliedFilters.documentTypes.length > 0 ? appliedFilters.documentTypes : undefined,
+        start_date: appliedFilters.startDate || undefined,
+        end_date: appliedFilters.endDate || undefined,
+      });
       
-      if (appliedFilters.documentTypes.length > 0) {
-        params.append('document_types', appliedFilters.documentTypes.join(','));
-      }
-      if (appliedFilters.startDate) {
-        params.append('start_date', appliedFilters.startDate);
-      }
-      if (appliedFilters.endDate) {
-        params.append('end_date', appliedFilters.endDate);
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise((resolve) => setTimeout(resolve, ZIP_JOB_POLL_MS));
+        job = await getZipJob(job.job_id);
+        if (job.status === 'running' && job.total_documents > 0) {
+          const eta = job.eta_seconds != null ? ` (~${Math.ceil(job.eta_seconds)}s restantes)` : '';
+          toast.loading(
+            `Generando ZIP del proyecto ${projectCode}: ${job.processed_documents}/${job.total_documents} documentos${eta}`,
+            { id: toastId }
+          );
+        }
       }
       
-      const queryString = params.toString();
-      const url = queryString ? `?${queryString}` : '';
+      if (job.status === 'failed') {
+        toast.error(job.error || `Error generando el ZIP del proyecto ${projectCode}`, { id: toastId });
+        return;
+      }
       
-      await downloadProjectZip(projectCode, url);
-      toast.success(`ZIP del proyecto ${projectCode} descargado exitosamente`, { id: toastId });
+      const link = document.createElement('a');
+      link.href = getZipJobDownloadUrl(job.job_id);
+      link.download = `${projectCode}.zip`;
+      document.body.appendChild(link);
+      link.click();
+      document.body.removeChild(link);
+      const failed = job.failed_documents > 0 ? ` (${job.failed_documents} con error, ver FAILED_FILES.txt)` : '';
+      toast.success(`ZIP del proyecto ${projectCode} descargado exitosamente${failed}`, { id: toastId });
     } catch (error) {
       toast.error(handleApiError(error), { id: toastId });
     } finally {